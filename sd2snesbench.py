@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+""" counts the bytes curses sends to the terminal
+
+runs sd2snestool.py in a pseudo terminal on a made up library, presses
+keys and measures how much output each one causes, so changes to the
+drawing can be compared without a real ssh session. scroll compares
+hardware scrolling with redrawing the list, frames the low bandwidth mode
+with the normal one in bytes per frame
+
+    python sd2snesbench.py scroll frames --python python2
+
+replay plays a session recorded with SD2SNES_RECORD=session.jsonl back
+into sd2snestool.py and reports how long every event took to draw,
+--save keeps the numbers and --baseline fails when they got slower
+
+    python sd2snesbench.py replay session.jsonl --fast --save base.json
+    python sd2snesbench.py replay session.jsonl --fast --baseline base.json
+"""
+from __future__ import print_function
+
+import os
+import argparse
+import curses
+import errno
+import json
+import fcntl
+import pty
+import select
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import termios
+import time
+
+ROWS = 40
+COLS = 120
+QUIET = 0.15  # output is done when nothing arrives for this long
+FRAME_GAP = 0.005  # output closer together than this is one frame
+GAMES = 5000  # roms in the big pak of the made up library
+TERM = 'xterm-256color'
+TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'sd2snestool.py')
+
+# --------------------------------------------------------------------------- #
+# - Pty                                                                     - #
+# --------------------------------------------------------------------------- #
+
+class PtySession(object):
+    """ a program running in a pseudo terminal of rows x cols """
+
+    def __init__(self, argv, rows=ROWS, cols=COLS, term=TERM, env=None):
+
+        self.argv = argv
+        self.bytesRead = 0
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            size = struct.pack('HHHH', rows, cols, 0, 0)
+            fcntl.ioctl(sys.stdin.fileno(), termios.TIOCSWINSZ, size)
+            env = dict(os.environ, TERM=term, ESCDELAY='25', **(env or {}))
+            try:
+                os.execvpe(argv[0], argv, env)
+            finally:
+                os._exit(127)
+
+    def send(self, keys):
+        if not isinstance(keys, bytes):
+            keys = keys.encode('latin-1')
+        os.write(self.fd, keys)
+
+    def read(self, quiet=QUIET, timeout=10):
+        """ everything written until the program goes quiet """
+        return self.timedRead(quiet, timeout)[0]
+
+    def timedRead(self, quiet=QUIET, timeout=10, chunks=None):
+        """ (output, time of its first byte, time of its last byte) until
+        the program goes quiet or timeout, the times are None without
+        output. chunks gets a (time, size) for every read
+        """
+        output = []
+        first = last = None
+        end = time.time() + timeout
+        while time.time() < end:
+            wait = min(quiet, max(end - time.time(), 0))
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if not ready:
+                break
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno != errno.EIO:
+                    raise
+                data = b''
+            if not data:  # the program exited
+                break
+            last = time.time()
+            first = first or last
+            output.append(data)
+            if chunks is not None:
+                chunks.append((last, len(data)))
+        data = b''.join(output)
+        self.bytesRead += len(data)
+        return data, first, last
+
+    def readFrames(self, quiet=QUIET, chunks=None):
+        """ bytes of every frame written until the program goes quiet, reads
+        less than FRAME_GAP apart are one frame. chunks are reads from
+        before to count in
+        """
+        chunks = list(chunks or [])
+        self.timedRead(quiet, chunks=chunks)
+        frames = []
+        last = None
+        for t, size in chunks:
+            if last is None or t - last > FRAME_GAP:
+                frames.append(0)
+            frames[-1] += size
+            last = t
+        return frames
+
+    def resize(self, rows, cols):
+        """ the kernel tells the program with a SIGWINCH """
+        size = struct.pack('HHHH', rows, cols, 0, 0)
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, size)
+        try:
+            os.kill(self.pid, signal.SIGWINCH)
+        except OSError:
+            pass
+
+    def press(self, keys, quiet=QUIET):
+        """ bytes of output caused by keys """
+        self.send(keys)
+        return len(self.read(quiet))
+
+    def close(self):
+        try:
+            os.kill(self.pid, 15)
+        except OSError:
+            pass
+        os.waitpid(self.pid, 0)
+        os.close(self.fd)
+
+# --------------------------------------------------------------------------- #
+# - The tool in the pty                                                     - #
+# --------------------------------------------------------------------------- #
+
+def makeLibrary(root, games=GAMES):
+    """ a library of one pak of empty roms under root, the tool only lists
+    them. returns (library, home)
+    """
+    library = os.path.join(root, 'roms')
+    home = os.path.join(root, 'home')
+    pak = os.path.join(library, 'A big pak')
+    os.makedirs(pak)
+    os.makedirs(home)
+    for i in range(games):
+        with open(os.path.join(
+                pak, '%05d some game name (USA).sfc' % i), 'w'):
+            pass
+    return library, home
+
+class ToolSession(PtySession):
+    """ sd2snestool.py on a library from makeLibrary, env is added to its
+    environment
+    """
+
+    def __init__(self, python, library, home, **env):
+        env.update(HOME=home, SD2SNES_LIBRARY=library,
+                   SD2SNES_CARD=os.path.join(home, 'no card'))
+        PtySession.__init__(self, [python, TOOL], env=env)
+        self.sequences = keySequences(TERM, self.fd)
+        self.paint = len(self.read(1.0))
+
+    def key(self, name):
+        """ what the terminal sends for a curses key name like KEY_NPAGE """
+        return self.sequences[getattr(curses, name)]
+
+    def openPak(self):
+        """ the library itself is the first row, the pak the second """
+        self.press('j')
+        return self.press('\r')
+
+    def quit(self):
+        self.send('q')
+        self.read()
+        self.close()
+
+# --------------------------------------------------------------------------- #
+# - Benchmarks                                                              - #
+# --------------------------------------------------------------------------- #
+
+def benchScroll(python, library, home, presses=50):
+    """ bytes sent to scroll the games pane a line and a page at a time,
+    redraw is the tool with SD2SNES_HARDWARE_SCROLL=0
+    """
+    print('%-8s %10s %10s %10s' % ('mode', 'paint', 'per line', 'per page'))
+    for mode, flag in (('redraw', '0'), ('idlok', '1')):
+        session = ToolSession(python, library, home,
+                              SD2SNES_HARDWARE_SCROLL=flag)
+        session.openPak()
+        # the cursor to the bottom of the page, from here j scrolls
+        session.press(session.key('KEY_NPAGE'))
+        lines = [session.press('j') for _ in range(presses)]
+        pages = [session.press(session.key('KEY_NPAGE')) for _ in range(5)]
+        session.quit()
+        print('%-8s %10d %10.1f %10.1f' % (
+            mode, session.paint, sum(lines) / float(len(lines)),
+            sum(pages) / float(len(pages))))
+
+def benchFrames(python, library, home, presses=20):
+    """ bytes sent for a key, a held down key and focus changes, and the
+    bytes per frame over all of them. low is SD2SNES_LOW_BANDWIDTH=1
+    """
+    print('%-8s %8s %9s %9s %7s %9s %9s' % (
+        'mode', 'paint', 'per key', 'held key', 'frames', 'focus',
+        'per frame'))
+    for mode, flag in (('normal', '0'), ('low', '1')):
+        session = ToolSession(python, library, home,
+                              SD2SNES_LOW_BANDWIDTH=flag)
+        session.openPak()
+        frames = []
+        keys = []
+        for _ in range(presses):
+            session.send('j')
+            keys.append(session.readFrames())
+        # a held key, the keys come in faster than frames go out
+        held = []
+        for _ in range(5):
+            chunks = []
+            for _ in range(10):
+                session.send('j')
+                session.timedRead(0.01, 0.01, chunks)
+            held.append(session.readFrames(chunks=chunks))
+        focus = []
+        for i in range(10):
+            session.send('hl'[i % 2])
+            focus.append(session.readFrames())
+        session.quit()
+        for found in keys + held + focus:
+            frames.extend(found)
+        mean = lambda runs: sum(sum(r) for r in runs) / float(len(runs))
+        print('%-8s %8d %9.1f %9.1f %7.1f %9.1f %9.1f' % (
+            mode, session.paint, mean(keys), mean(held),
+            sum(len(h) for h in held) / float(len(held)), mean(focus),
+            sum(frames) / float(len(frames) or 1)))
+
+BENCHMARKS = {
+    'scroll': benchScroll,
+    'frames': benchFrames,
+}
+
+# --------------------------------------------------------------------------- #
+# - Replay                                                                  - #
+# --------------------------------------------------------------------------- #
+
+# curses key codes and the terminfo strings a terminal sends for them
+TERMINFO_KEYS = (
+    ('KEY_UP', 'kcuu1'), ('KEY_DOWN', 'kcud1'),
+    ('KEY_LEFT', 'kcub1'), ('KEY_RIGHT', 'kcuf1'),
+    ('KEY_HOME', 'khome'), ('KEY_END', 'kend'),
+    ('KEY_PPAGE', 'kpp'), ('KEY_NPAGE', 'knp'),
+    ('KEY_IC', 'kich1'), ('KEY_DC', 'kdch1'),
+    ('KEY_BACKSPACE', 'kbs'), ('KEY_BTAB', 'kcbt'),
+)
+# what sd2snestool takes as the wheel, Keys.KEY_WHEEL_UP and _DOWN there
+WHEEL_UP = (curses.BUTTON4_PRESSED, 524288)
+WHEEL_DOWN = (getattr(curses, 'BUTTON5_PRESSED', 0x200000), 134217728)
+
+def keySequences(term, fd):
+    """ {curses key code: bytes} for term, in keypad mode like the tool """
+    curses.setupterm(term, fd)
+    sequences = {}
+    for name, cap in TERMINFO_KEYS:
+        sequence = curses.tigetstr(cap)
+        if sequence and hasattr(curses, name):
+            sequences[getattr(curses, name)] = sequence
+    for n in range(1, 13):
+        sequence = curses.tigetstr('kf%d' % n)
+        if sequence:
+            sequences[curses.KEY_F0 + n] = sequence
+    sequences[None] = curses.tigetstr('kmous') or b'\x1b[M'
+    return sequences
+
+def mouseBytes(mouse, kmous):
+    """ what a terminal sends for a getmouse() tuple, sgr or x10 style """
+    _id, x, y, z, bstate = mouse
+    if bstate in WHEEL_UP:
+        buttons = [(64, True)]
+    elif bstate in WHEEL_DOWN:
+        buttons = [(65, True)]
+    else:
+        buttons = []
+        for button, number in ((0, 1), (1, 2), (2, 3)):
+            mask = lambda kind: getattr(
+                curses, 'BUTTON%d_%s' % (number, kind), 0)
+            if bstate & mask('PRESSED'):
+                buttons.append((button, True))
+            if bstate & mask('RELEASED'):
+                buttons.append((button, False))
+            clicks = (1 if bstate & mask('CLICKED') else
+                      2 if bstate & mask('DOUBLE_CLICKED') else
+                      3 if bstate & mask('TRIPLE_CLICKED') else 0)
+            buttons.extend([(button, True), (button, False)] * clicks)
+    out = []
+    for button, press in buttons:
+        if kmous.endswith(b'<'):
+            out.append(kmous + ('%d;%d;%d%s' % (
+                button, x + 1, y + 1, 'M' if press else 'm')).encode())
+        else:
+            code = button if press else 3
+            out.append(kmous + bytearray((32 + code, 33 + x, 33 + y)))
+    return b''.join(bytes(o) for o in out)
+
+def eventBytes(event, sequences):
+    key = event['key']
+    if key == curses.KEY_MOUSE:
+        return mouseBytes(event.get('mouse', (0, 0, 0, 0, 0)),
+                          sequences[None])
+    if key in sequences:
+        return sequences[key]
+    if 0 <= key < 256:
+        return bytearray((key,))
+    return b''
+
+def keyName(key):
+    if key == curses.KEY_RESIZE:
+        return 'resize'
+    if key == curses.KEY_MOUSE:
+        return 'mouse'
+    if key == 32:
+        return 'space'
+    if 32 < key < 127:
+        return chr(key)
+    for name, _ in TERMINFO_KEYS:
+        if getattr(curses, name, None) == key:
+            return name[4:].lower()
+    return str(key)
+
+def loadSession(path):
+    """ (header, events) of a recorded session """
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    return lines[0], lines[1:]
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def replaySession(path, fast=False, argv=None, quiet=QUIET):
+    """ [(event, bytes drawn, ms to the first byte, ms until done)]
+
+    events are sent when they happened unless fast, then each one goes
+    as soon as the last one is drawn. resizes resize the pty
+    """
+    header, events = loadSession(path)
+    rows, cols = header.get('size') or (ROWS, COLS)
+    term = header.get('term') or TERM
+    session = PtySession(argv or [sys.executable, TOOL], rows, cols, term)
+    results = []
+    try:
+        sequences = keySequences(term, session.fd)
+        session.read(0.5)
+        start = time.time()
+        for i, event in enumerate(events):
+            if not fast:
+                wait = start + event['t'] - time.time()
+                if wait > 0:
+                    session.read(quiet, wait)
+            sent = time.time()
+            if event['key'] == curses.KEY_RESIZE and 'size' in event:
+                session.resize(*event['size'])
+            else:
+                session.send(bytes(eventBytes(event, sequences)))
+            timeout = 10
+            if not fast and i + 1 < len(events):
+                timeout = max(start + events[i + 1]['t'] - sent, quiet)
+            data, first, last = session.timedRead(quiet, timeout)
+            ms = lambda t: None if t is None else (t - sent) * 1000
+            results.append((event, len(data), ms(first), ms(last)))
+    finally:
+        session.close()
+    return results
+
+def replay(argv):
+    """ replays a session, the exit code is 1 when it got slower """
+    parser = argparse.ArgumentParser(prog='sd2snesbench.py replay')
+    parser.add_argument('session')
+    parser.add_argument('--fast', action='store_true',
+                        help='no waiting between events')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for sd2snestool.py')
+    parser.add_argument('--quiet', type=float, default=QUIET,
+                        help='seconds without output that end an event')
+    parser.add_argument('--save', help='write the summary here')
+    parser.add_argument('--baseline', help='compare with a saved summary')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown allowed against the baseline')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='a line per event')
+    args = parser.parse_args(argv)
+
+    results = replaySession(args.session, args.fast,
+                            [args.python, TOOL], args.quiet)
+    byKey = {}
+    for i, (event, size, first, done) in enumerate(results):
+        if args.verbose:
+            print('%5d %-10s %8d %10s %10s' % (
+                i, keyName(event['key']), size,
+                '-' if first is None else '%.1f' % first,
+                '-' if done is None else '%.1f' % done))
+        if done is not None:
+            byKey.setdefault(keyName(event['key']), []).append(done)
+    done = [d for values in byKey.values() for d in values]
+
+    summary = {'events': len(results), 'p50': percentile(done, 0.5),
+               'p95': percentile(done, 0.95), 'max': max(done or [0])}
+    print('%-10s %6s %10s %10s %10s' % ('key', 'count', 'p50 ms',
+                                         'p95 ms', 'max ms'))
+    for name, values in sorted(byKey.items()):
+        print('%-10s %6d %10.1f %10.1f %10.1f' % (
+            name, len(values), percentile(values, 0.5),
+            percentile(values, 0.95), max(values)))
+    print('%-10s %6d %10.1f %10.1f %10.1f' % (
+        'all', len(done), summary['p50'], summary['p95'], summary['max']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f)
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)
+        slower = [k for k in ('p50', 'p95')
+                  if summary[k] > base[k] * (1 + args.tolerance)]
+        for k in slower:
+            print('%s went from %.1f to %.1f ms' % (k, base[k], summary[k]))
+        return 1 if slower else 0
+    return 0
+
+def main(argv):
+
+    if argv[:1] == ['replay']:
+        return replay(argv[1:])
+    parser = argparse.ArgumentParser(prog='sd2snesbench.py')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=' '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for sd2snestool.py')
+    args = parser.parse_args(argv)
+    names = args.benchmarks or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print('unknown benchmark %s, try %s' % (
+                name, ' '.join(sorted(BENCHMARKS))))
+            return 2
+    root = tempfile.mkdtemp()
+    try:
+        library, home = makeLibrary(root)
+        for name in names:
+            print('# %s' % name)
+            BENCHMARKS[name](args.python, library, home)
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+""" sd2snestool without the ui, for cron jobs and shell loops
+
+every command writes one json object per line to stdout as it goes and
+never touches curses
+
+    sd2snescli.py scan ~/roms
+    sd2snescli.py index ~/roms /media/sd2snes
+    sd2snescli.py verify /media/sd2snes
+    sd2snescli.py sync ~/roms /media/sd2snes --dry-run
+    sd2snescli.py sync ~/roms /media/sd2snes --fit 4 --regions USA,Japan
+    sd2snescli.py dedupe /media/sd2snes --delete
+    sd2snescli.py diff ~/roms /media/sd2snes --hash
+    sd2snescli.py bench /media/sd2snes
+    sd2snescli.py shard /media/sd2snes --by letter --apply
+
+exit codes: 0 all good, 1 something was found (a bad rom, duplicates),
+2 bad arguments, 3 some files could not be read or written
+"""
+
+import os
+import argparse
+import errno
+import json
+import sys
+import zipfile
+
+import sd2snescore as core
+
+EXIT_OK = 0
+EXIT_FOUND = 1
+EXIT_USAGE = 2
+EXIT_ERROR = 3
+
+# what a bad file can throw at the engines
+FILE_ERRORS = (OSError, IOError, KeyError, ValueError, zipfile.BadZipfile)
+
+# --------------------------------------------------------------------------- #
+# - Output                                                                  - #
+# --------------------------------------------------------------------------- #
+
+def emit(**record):
+    """ one json line, flushed so a pipe sees it right away """
+    sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+    sys.stdout.flush()
+
+class Run(object):
+    """ the exit code of a command, the worst thing that happened wins """
+
+    def __init__(self):
+        self.code = EXIT_OK
+
+    def found(self):
+        self.code = max(self.code, EXIT_FOUND)
+
+    def error(self, path, e):
+        self.code = max(self.code, EXIT_ERROR)
+        emit(path=path, error='%s: %s' % (e.__class__.__name__, e))
+
+def iterRoms(paths, run, zips=True):
+    """ roms named in paths, folders are walked and zips opened """
+    for path in paths:
+        archive, member = core.splitZipPath(path)
+        if member is not None:
+            yield path
+        elif os.path.isdir(path):
+            for rom in core.walkRoms(path, zips):
+                yield rom
+        elif zips and core.isZip(path):
+            try:
+                members = core.listZip(path)
+            except FILE_ERRORS as e:
+                run.error(path, e)
+                continue
+            for rom in members:
+                yield rom
+        elif os.path.isfile(path):
+            yield path
+        else:
+            run.error(path, IOError('No such file or folder'))
+
+# --------------------------------------------------------------------------- #
+# - Commands                                                                - #
+# --------------------------------------------------------------------------- #
+
+def scan(args, run):
+    """ size and internal header of every rom """
+    for rom in iterRoms(args.paths, run):
+        try:
+            size = core.romSize(rom)
+            info = core.readHeader(rom)
+        except FILE_ERRORS as e:
+            run.error(rom, e)
+            continue
+        record = {'path': rom, 'size': size}
+        if info:
+            record.update(
+                title=info.title, mapping=info.mapping, region=info.region,
+                coprocessor=info.coprocessor, hasSave=info.hasSave)
+        emit(**record)
+
+def hashRoms(args, run):
+    """ sha1 of the rom data of every rom, copier headers skipped """
+    for rom in iterRoms(args.paths, run):
+        try:
+            emit(path=rom, sha1=core.hashRom(rom))
+        except FILE_ERRORS as e:
+            run.error(rom, e)
+
+def index(args, run):
+    """ adds new and changed roms to the index and forgets missing ones """
+    idx = core.RomIndex(args.index)
+    try:
+        for rom in iterRoms(args.paths, run):
+            try:
+                state, entry = idx.update(rom)
+            except FILE_ERRORS as e:
+                run.error(rom, e)
+                continue
+            emit(path=idx.key(rom), state=state, **entry)
+        for path in idx.prune(args.paths):
+            emit(path=path, state='removed')
+    finally:
+        idx.save()
+
+def verify(args, run):
+    """ hashes indexed roms again and compares, missing and changed roms
+    are found
+    """
+    idx = core.RomIndex(args.index)
+    for path in idx.under(args.paths):
+        try:
+            state, sha1 = idx.verify(path)
+        except FILE_ERRORS as e:
+            run.error(path, e)
+            continue
+        if state != idx.OK:
+            run.found()
+        emit(path=path, state=state, sha1=sha1,
+             expected=idx.roms[path]['sha1'])
+
+def fit(args, run):
+    """ the entries of src that fit in --fit GB, the card's size for 0,
+    None when the card can't be read
+    """
+    if args.fit:
+        capacity = int(args.fit * 1024 ** 3)
+        cluster = core.defaultCluster(capacity)
+    else:
+        try:
+            capacity, _, cluster = core.cardSpace(args.dst)
+        except OSError as e:
+            run.error(args.dst, e)
+            return None
+    favorites = set()
+    if args.favorites:
+        with open(args.favorites) as f:
+            favorites = set(os.path.abspath(os.path.join(args.src, line))
+                            for line in f.read().splitlines() if line)
+    regions = tuple(args.regions.split(','))
+    plan = core.CapacityPlan(
+        core.capacityEntries(args.src, cluster, core.RomIndex(args.index)),
+        capacity, lambda e: core.regionPriority(e, favorites, regions))
+    emit(capacity=capacity, cluster=cluster, used=plan.used,
+         games=len(plan.chosen), left=len(plan.entries) - len(plan.chosen))
+    return plan.chosenEntries()
+
+def sync(args, run):
+    """ copies the games in src that dst is missing or has a different
+    size of, msu-1 packs included
+    """
+    only = None
+    if args.fit is not None:
+        only = fit(args, run)
+        if only is None:
+            return
+    for entry, target, state in core.planSync(args.src, args.dst, only):
+        if state == core.SYNC_SAME:
+            if args.verbose:
+                emit(path=entry, target=target, state=state)
+            continue
+        if args.dry_run:
+            emit(path=entry, target=target, state=state, action='copy')
+            continue
+        try:
+            core.syncEntry(entry, target)
+        except FILE_ERRORS as e:
+            run.error(entry, e)
+            continue
+        emit(path=entry, target=target, state=state, action='copied')
+
+def diff(args, run):
+    """ what a card is missing, has extra or different from the library,
+    compared by the library index and the card's own profile
+    """
+    card = core.cardIndex(args.card)
+    stale = core.reconcile(card, args.card)
+    if args.hash:
+        for key in stale:
+            try:
+                card.update(key)
+            except FILE_ERRORS as e:
+                run.error(key, e)
+    card.save()
+    library = core.RomIndex(args.index)
+    for state, rel, libPath, cardPath in core.diffCard(
+            library, args.library, card, args.card):
+        run.found()
+        emit(path=rel, state=state, library=libPath, card=cardPath)
+    emit(card=core.cardId(args.card), roms=len(card.under([args.card])),
+         unhashed=0 if args.hash else len(stale))
+
+def dedupe(args, run):
+    """ groups of identical roms, the first of a group is the one kept """
+    stats = core.DupeStats()
+    roms = iterRoms(args.paths, run, zips=False)
+    for group in core.findDuplicates(roms, stats):
+        size = core.romSize(group[0])
+        removed = []
+        if args.delete:
+            try:
+                removed = core.deleteExtras([group])
+            except FILE_ERRORS as e:
+                run.error(group[0], e)
+        if len(removed) < len(group) - 1:
+            run.found()
+        emit(keep=group[0], duplicates=group[1:], removed=removed,
+             size=size)
+    emit(files=stats.files, bytesTotal=stats.bytesTotal,
+         bytesRead=stats.bytesRead)
+
+def bench(args, run):
+    """ measures the card a folder is on, copies to it get tuned by it """
+    stats = core.benchmarkCard(args.folder, args.size * 1024 * 1024)
+    core.saveCard(stats)
+    tuning = core.copyTuning(args.folder)
+    emit(tuning={'bufsize': tuning.bufsize, 'workers': tuning.workers,
+                 'syncBytes': tuning.syncBytes}, **stats)
+
+def shard(args, run):
+    """ splits a big rom folder into folders of at most --cap roms """
+    idx = core.RomIndex(args.index)
+    paths = idx.under([args.root]) or list(core.walkRoms(args.root))
+    plan = core.planLayout(args.root, paths, args.cap, args.by)
+    for src, dst in plan.conflicts:
+        run.found()
+        emit(path=src, target=dst, error='target exists')
+    if args.apply:
+        try:
+            moves = core.applyLayout(plan, index=idx)
+        except FILE_ERRORS as e:
+            run.error(args.root, e)
+            return
+        finally:
+            idx.save()
+    else:
+        moves = plan.moves
+    for src, dst in moves:
+        emit(path=src, target=dst, action='moved' if args.apply else 'move')
+    emit(folders=plan.folders)
+
+COMMANDS = (
+    ('scan', scan),
+    ('index', index),
+    ('hash', hashRoms),
+    ('verify', verify),
+    ('sync', sync),
+    ('diff', diff),
+    ('dedupe', dedupe),
+    ('bench', bench),
+    ('shard', shard),
+)
+
+# --------------------------------------------------------------------------- #
+# - Main                                                                    - #
+# --------------------------------------------------------------------------- #
+
+def parser():
+
+    parser = argparse.ArgumentParser(
+        description='sd2snestool for scripts, prints json lines')
+    parser.add_argument(
+        '--index', default=core.INDEX_PATH,
+        help='rom index file (default %(default)s)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+    funcs = dict(COMMANDS)
+
+    def add(name, paths='+'):
+        sub = commands.add_parser(
+            name, help=funcs[name].__doc__.strip().split('\n')[0])
+        sub.set_defaults(func=funcs[name])
+        if paths:
+            sub.add_argument('paths', nargs=paths, metavar='path')
+        return sub
+
+    add('scan')
+    add('index')
+    add('hash')
+    add('verify', '*')
+    sub = add('sync', None)
+    sub.add_argument('src')
+    sub.add_argument('dst')
+    sub.add_argument('-n', '--dry-run', action='store_true',
+                     help='only print what would be copied')
+    sub.add_argument('-v', '--verbose', action='store_true',
+                     help='print games that are up to date too')
+    sub.add_argument('--fit', type=float, metavar='GB',
+                     help='only the games that fit in GB, 0 for the card')
+    sub.add_argument('--regions', default=','.join(core.PREFERRED_REGIONS),
+                     help='regions to fit first (default %(default)s)')
+    sub.add_argument('--favorites', metavar='FILE',
+                     help='paths below src to fit before anything else')
+    sub = add('diff', None)
+    sub.add_argument('library')
+    sub.add_argument('card')
+    sub.add_argument('--hash', action='store_true',
+                     help='hash card roms that changed instead of '
+                          'comparing their size')
+    sub = add('dedupe')
+    sub.add_argument('--delete', action='store_true',
+                     help='remove all but the first rom of each group')
+    sub = add('bench', None)
+    sub.add_argument('folder', help='a folder on the card')
+    sub.add_argument('--size', type=int, default=core.BENCH_SIZE >> 20,
+                     help='MB written per test (default %(default)s)')
+    sub = add('shard', None)
+    sub.add_argument('root', help='the folder to split')
+    sub.add_argument('--cap', type=int, default=core.SHARD_CAP,
+                     help='roms per folder (default %(default)s)')
+    sub.add_argument('--by', choices=core.SHARD_BY, default='range')
+    sub.add_argument('--apply', action='store_true',
+                     help='move the files, without it the moves are printed')
+    return parser
+
+def main(argv):
+
+    try:
+        args = parser().parse_args(argv)
+    except SystemExit as e:
+        return EXIT_USAGE if e.code else EXIT_OK
+    run = Run()
+    try:
+        args.func(args, run)
+    except KeyboardInterrupt:
+        return EXIT_ERROR
+    except FILE_ERRORS as e:
+        # the reader of the pipe went away, like head does
+        if getattr(e, 'errno', None) == errno.EPIPE:
+            return run.code
+        run.error(getattr(e, 'filename', None), e)
+    return run.code
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,3142 @@
+#!/usr/bin/env python2
+""" file side of sd2snestool
+
+nothing in here may import curses, the ui in sd2snestool.py sits on top of it
+"""
+
+import os
+import array
+import base64
+import binascii
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+import mmap
+import posixpath
+import random
+import re
+import shutil
+import socket
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+try:
+    from os import cpu_count
+except ImportError:  # python 2, multiprocessing is slow to import
+    from multiprocessing import cpu_count
+
+ROM_EXTS = ('.sfc', '.smc', '.swc', '.fig', '.bs')
+ZIP_EXTS = ('.zip',)
+ZIP_SEP = '::'
+COPIER_HEADER = 512
+HASH_BLOCK = 64 * 1024
+COPY_BLOCK = 1024 * 1024
+CONFIG_DIR = os.path.expanduser('~/.sd2snestool')
+
+# --------------------------------------------------------------------------- #
+# - Roms                                                                    - #
+# --------------------------------------------------------------------------- #
+
+def isRom(name):
+    return os.path.splitext(name)[1].lower() in ROM_EXTS
+
+def copierHeaderSize(size):
+    """ copier dumps have a 512 byte header in front of a 1k aligned rom """
+    return COPIER_HEADER if size % 1024 == COPIER_HEADER else 0
+
+def isZip(name):
+    return os.path.splitext(name)[1].lower() in ZIP_EXTS
+
+def walkRoms(root, zips=False):
+    """ yields every rom path under root, and the roms in zips with zips """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if isRom(name):
+                yield path
+            elif zips and isZip(name):
+                try:
+                    members = listZip(path)
+                except (zipfile.BadZipfile, IOError, OSError):
+                    continue
+                for member in members:
+                    yield member
+
+def romSize(path):
+    """ size of the rom data without a copier header """
+    size = fileSize(path)
+    return size - copierHeaderSize(size)
+
+# --------------------------------------------------------------------------- #
+# - Zip archives                                                            - #
+# --------------------------------------------------------------------------- #
+
+# roms inside a zip are addressed as "path/to/archive.zip::member.sfc"
+
+def zipPath(archive, member):
+    return archive + ZIP_SEP + member
+
+def splitZipPath(path):
+    """ (archive, member) for a rom inside a zip, (path, None) otherwise """
+    if ZIP_SEP in path:
+        archive, member = path.split(ZIP_SEP, 1)
+        if isZip(archive):
+            return archive, member
+    return path, None
+
+def listZip(archive):
+    """ virtual paths of the roms in a zip
+
+    only the central directory is read, never the compressed data
+    """
+    zf = zipfile.ZipFile(archive)
+    try:
+        return [zipPath(archive, i.filename) for i in zf.infolist()
+                if isRom(i.filename)]
+    finally:
+        zf.close()
+
+def listFolder(folder, zips=True):
+    """ roms and patches directly in folder, zip contents as virtual entries
+
+    an msu-1 pack is listed once, as its .msu file, instead of its rom
+    """
+    entries = []
+    names = sorted(os.listdir(folder))
+    packs = set(os.path.splitext(n)[0] for n in names if isMsu(n))
+    for name in names:
+        path = os.path.join(folder, name)
+        if isMsu(name) or isPatch(name):
+            entries.append(path)
+        elif isRom(name):
+            if os.path.splitext(name)[0] not in packs:
+                entries.append(path)
+        elif zips and isZip(name):
+            try:
+                entries.extend(listZip(path))
+            except (zipfile.BadZipfile, IOError, OSError):
+                continue
+    return entries
+
+def listFolders(root):
+    """ root and the folders below it """
+    folders = [root]
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames.sort()
+        folders.extend(os.path.join(dirpath, d) for d in dirnames)
+    return folders
+
+def fileSize(path):
+    """ size on disk, or the uncompressed size of a zip member """
+    archive, member = splitZipPath(path)
+    if member is None:
+        return os.path.getsize(path)
+    zf = zipfile.ZipFile(archive)
+    try:
+        return zf.getinfo(member).file_size
+    finally:
+        zf.close()
+
+class ZipMember(object):
+    """ read only stream of a zip member, decompressed as it is read """
+
+    def __init__(self, archive, member):
+        self._zip = zipfile.ZipFile(archive)
+        try:
+            self._fo = self._zip.open(member)
+        except Exception:
+            self._zip.close()
+            raise
+
+    def read(self, size=-1):
+        return self._fo.read(size)
+
+    def seek(self, offset):
+        """ forward only, skipped data still has to be decompressed """
+        self.read(offset)
+
+    def close(self):
+        self._fo.close()
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def openRom(path):
+    """ binary read stream for a rom on disk or inside a zip """
+    archive, member = splitZipPath(path)
+    if member is None:
+        return open(path, 'rb')
+    return ZipMember(archive, member)
+
+def _pump(fi, fo, bufsize, done, total, progress=None, syncBytes=None):
+    """ copies the rest of fi to fo, returns the bytes copied
+
+    with syncBytes fo is fsynced every syncBytes and at the end, so the
+    progress is what is really on the card
+    """
+    copied = unsynced = 0
+    while True:
+        block = fi.read(bufsize)
+        if not block:
+            break
+        fo.write(block)
+        copied += len(block)
+        unsynced += len(block)
+        if syncBytes and unsynced >= syncBytes:
+            fo.flush()
+            os.fsync(fo.fileno())
+            unsynced = 0
+        if progress:
+            progress(done + copied, total)
+    if syncBytes and unsynced:
+        fo.flush()
+        os.fsync(fo.fileno())
+    return copied
+
+def copyRom(src, dst, bufsize=COPY_BLOCK, progress=None, syncBytes=None):
+    """ streams src to dst, zip members are decompressed on the way
+
+    progress(done, total) is called after every block
+    """
+    dirname = os.path.dirname(dst)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    total = fileSize(src)
+    try:
+        with openRom(src) as fi:
+            with open(dst, 'wb') as fo:
+                _pump(fi, fo, bufsize, 0, total, progress, syncBytes)
+    except Exception:
+        if os.path.exists(dst):
+            os.remove(dst)
+        raise
+    return dst
+
+def romName(path):
+    """ file name of a rom, zip members included """
+    archive, member = splitZipPath(path)
+    return os.path.basename(member if member is not None else archive)
+
+# --------------------------------------------------------------------------- #
+# - Headers                                                                 - #
+# --------------------------------------------------------------------------- #
+
+HEADER_OFFSETS = (('LoROM', 0x7FC0), ('HiROM', 0xFFC0))
+
+# high nibble of the chipset byte, only used when there is a coprocessor
+COPROCESSORS = {
+    0x0: 'DSP', 0x1: 'SuperFX', 0x2: 'OBC1', 0x3: 'SA-1', 0x4: 'S-DD1',
+    0x5: 'S-RTC', 0xE: 'Other', 0xF: 'Custom',
+}
+
+REGIONS = {
+    0x00: 'Japan', 0x01: 'USA', 0x02: 'Europe', 0x03: 'Sweden',
+    0x04: 'Finland', 0x05: 'Denmark', 0x06: 'France', 0x07: 'Holland',
+    0x08: 'Spain', 0x09: 'Germany', 0x0A: 'Italy', 0x0B: 'China',
+    0x0D: 'Korea', 0x0F: 'Canada', 0x10: 'Brazil', 0x11: 'Australia',
+}
+
+class RomInfo(object):
+    """ the interesting bits of the snes internal header """
+
+    def __init__(self, path, offset, mapping, raw):
+        self.path = path
+        self.offset = offset
+        self.mapping = mapping
+        self.title = raw[:21].decode('ascii', 'replace').strip()
+        mode, chipset, romsize, sramsize, region = struct.unpack(
+            '<5B', raw[21:26])
+        self.fast = bool(mode & 0x10)
+        self.coprocessor = ''
+        if chipset & 0x0F >= 0x03:
+            self.coprocessor = COPROCESSORS.get(chipset >> 4, '')
+        # low nibble 2, 5 and 6 are the chipsets with a battery
+        self.hasSave = sramsize > 0 and chipset & 0x0F in (0x02, 0x05, 0x06)
+        self.romSize = 1024 << romsize if romsize < 16 else 0
+        self.sramSize = 1024 << sramsize if 0 < sramsize < 16 else 0
+        self.region = REGIONS.get(region, 'Unknown')
+        self.checksum, = struct.unpack('<H', raw[30:32])
+
+    def __repr__(self):
+        return '<RomInfo %r %s %s>' % (self.title, self.mapping, self.region)
+
+def _scoreHeader(raw, mapping):
+    """ higher is more likely to be a real header """
+    if len(raw) < 32:
+        return -1
+    score = 0
+    complement, checksum = struct.unpack('<HH', raw[28:32])
+    if complement ^ checksum == 0xFFFF:
+        score += 4
+    mode = raw[21] if isinstance(raw[21], int) else ord(raw[21])
+    if mode & 0x0F == (0 if mapping == 'LoROM' else 1):
+        score += 2
+    if all(32 <= (c if isinstance(c, int) else ord(c)) < 127
+           for c in raw[:21]):
+        score += 1
+    return score
+
+def readHeader(path):
+    """ RomInfo for a rom on disk or in a zip, None if it is too small
+
+    the rom is streamed up to the end of the hirom header, zip members are
+    never extracted.
+    """
+    size = fileSize(path)
+    skip = copierHeaderSize(size)
+    with openRom(path) as f:
+        f.seek(skip)
+        data = f.read(HEADER_OFFSETS[-1][1] + 32)
+
+    best = None
+    for mapping, offset in HEADER_OFFSETS:
+        raw = data[offset:offset + 32]
+        score = _scoreHeader(raw, mapping)
+        if score >= 0 and (best is None or score > best[0]):
+            best = score, mapping, offset, raw
+    if best is None:
+        return None
+    score, mapping, offset, raw = best
+    return RomInfo(path, offset + skip, mapping, raw)
+
+def hashRom(path, limit=None, start=0, stats=None):
+    """ sha1 of the rom data, copier header skipped
+
+    start and limit hash a slice of the rom data instead of all of it
+    """
+    size = fileSize(path)
+    sha = hashlib.sha1()
+    remaining = size - copierHeaderSize(size) - start
+    if limit is not None:
+        remaining = min(remaining, limit)
+
+    with openRom(path) as f:
+        f.seek(copierHeaderSize(size) + start)
+        while remaining > 0:
+            block = f.read(min(HASH_BLOCK, remaining))
+            if not block:
+                break
+            sha.update(block)
+            remaining -= len(block)
+            if stats is not None:
+                stats.bytesRead += len(block)
+
+    return sha.hexdigest()
+
+# --------------------------------------------------------------------------- #
+# - Duplicates                                                              - #
+# --------------------------------------------------------------------------- #
+
+class DupeStats(object):
+    """ how much work findDuplicates did vs a naive hash everything pass """
+
+    def __init__(self):
+        self.files = 0
+        self.bytesTotal = 0
+        self.bytesRead = 0
+
+    def __repr__(self):
+        return '<DupeStats files=%s read=%s/%s>' % (
+            self.files, self.bytesRead, self.bytesTotal)
+
+def _bucket(paths, key):
+    buckets = {}
+    for path in paths:
+        buckets.setdefault(key(path), []).append(path)
+    return [b for b in buckets.values() if len(b) > 1]
+
+def findDuplicates(paths, stats=None, progress=None):
+    """ groups of roms with the same data, headered or not
+
+    files are bucketed by header-less size first, only sizes that collide get
+    hashed. a prefix hash splits most same-size buckets before a full hash
+    has to read the rest of the file. progress(files) is called while
+    sizing and progress(bytesRead, bytesTotal) while hashing
+    """
+    stats = DupeStats() if stats is None else stats
+    report = progress or (lambda *args: None)
+    sizes = {}
+    for path in paths:
+        report(stats.files)
+        try:
+            sizes[path] = romSize(path)
+        except (OSError, IOError, KeyError, zipfile.BadZipfile):
+            continue
+        stats.files += 1
+        stats.bytesTotal += sizes[path]
+
+    groups = []
+    for bucket in _bucket(sizes, sizes.get):
+        report(stats.bytesRead, stats.bytesTotal)
+        prefix = lambda p: hashRom(p, HASH_BLOCK, stats=stats)
+        for heads in _bucket(bucket, prefix):
+            if sizes[heads[0]] <= HASH_BLOCK:
+                groups.append(sorted(heads))
+                continue
+            rest = lambda p: hashRom(p, start=HASH_BLOCK, stats=stats)
+            groups.extend(sorted(g) for g in _bucket(heads, rest))
+
+    return sorted(groups)
+
+def deleteExtras(groups):
+    """ removes all but the first file in each group, returns removed paths
+    """
+    removed = []
+    for group in groups:
+        for path in group[1:]:
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+def formatSize(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return '%d %s' % (size, unit) if unit == 'B' else '%.1f %s' % (size, unit)
+
+# --------------------------------------------------------------------------- #
+# - Tracing                                                                 - #
+# --------------------------------------------------------------------------- #
+
+TRACE_PATH = os.path.join(CONFIG_DIR, 'trace.json')
+TRACE_EVENTS = 200000  # the oldest spans are dropped past this
+
+class Tracer(object):
+    """ spans kept in memory and written out as chrome trace event json,
+    for chrome://tracing or ui.perfetto.dev
+
+    off unless on is set, span sites are written as
+
+        span = TRACER.on and TRACER.begin('draw')
+        ...
+        if span:
+            TRACER.end(span)
+
+    so when it is off all a site costs is looking up on
+    """
+
+    def __init__(self, size=TRACE_EVENTS):
+        self.on = False
+        # appending to a deque is thread safe, jobs trace from workers
+        self.events = collections.deque(maxlen=size)
+        self._threads = {}
+
+    @staticmethod
+    def begin(name, cat='ui', **args):
+        return name, cat, time.time(), args
+
+    def end(self, span, **args):
+        name, cat, start, first = span
+        if args:
+            first = dict(first, **args)
+        self.add(name, start, time.time(), cat, **first)
+
+    def add(self, name, start, end, cat='ui', **args):
+        """ a span timed somewhere else, like the wait in a queue """
+        thread = threading.current_thread()
+        self._threads[thread.ident] = thread.name
+        self.events.append((name, cat, start, end - start, thread.ident,
+                            args))
+
+    def export(self, path=TRACE_PATH):
+        """ writes the trace, returns how many spans it has """
+        pid = os.getpid()
+        events = [{'name': name, 'cat': cat, 'ph': 'X', 'pid': pid,
+                   'tid': tid, 'ts': int(start * 1e6),
+                   'dur': int(duration * 1e6), 'args': args}
+                  for name, cat, start, duration, tid, args
+                  in list(self.events)]
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': name}}
+                      for tid, name in list(self._threads.items()))
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(path + PART_EXT, 'w') as fo:
+            json.dump({'traceEvents': events}, fo)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + PART_EXT, path)
+        return len(self.events)
+
+TRACER = Tracer()
+
+# --------------------------------------------------------------------------- #
+# - Jobs                                                                    - #
+# --------------------------------------------------------------------------- #
+
+class Cancelled(Exception):
+    pass
+
+class Job(object):
+    """ one unit of work for the JobScheduler
+
+    func is called as func(job, *args), long running funcs should call
+    job.update() now and then so they can report progress and be cancelled
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name, func, args=(), resource='cpu', priority=0,
+                 retries=0, onDone=None):
+        self.id = next(self._ids)
+        self.name = name
+        self.func = func
+        self.args = args
+        self.resource = resource
+        self.priority = priority
+        self.retries = retries
+        self.onDone = onDone
+        self.batch = None
+        self.scheduler = None
+
+        self.state = self.QUEUED
+        self.attempts = 0
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.queued = None  # when it last went in the queue
+        self._cancel = threading.Event()
+        self._phase = None
+
+    def __repr__(self):
+        return '<Job %s %r %s>' % (self.id, self.name, self.state)
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def finished(self):
+        return self.state in self.FINISHED
+
+    def cancel(self):
+        if self.scheduler:
+            self.scheduler.cancel(self)
+        else:
+            self._cancel.set()
+
+    def phase(self, name):
+        """ marks a long job moving on to its next step, each step is a
+        span of its own when tracing
+        """
+        if self._phase:
+            TRACER.end(self._phase)
+        self._phase = TRACER.on and TRACER.begin(
+            '%s: %s' % (self.name, name), 'phase')
+
+    def update(self, done=None, total=None):
+        """ progress report from inside func, raises Cancelled when the job
+        was cancelled
+        """
+        if self._cancel.is_set():
+            raise Cancelled(self.name)
+        if done is not None:
+            self.progress = (done, total)
+            if self.scheduler:
+                self.scheduler._changed()
+
+class Batch(object):
+    """ jobs submitted together, onDone runs once all of them finished """
+
+    def __init__(self, name, jobs, onDone=None):
+        self.name = name
+        self.jobs = jobs
+        self.onDone = onDone
+        for job in jobs:
+            job.batch = self
+
+    @property
+    def finished(self):
+        return all(j.finished for j in self.jobs)
+
+    def cancel(self):
+        for job in self.jobs:
+            job.cancel()
+
+DEFAULT_LIMITS = {
+    'card': 1,
+    'usb': 1,
+    'cpu': cpu_count(),
+}
+
+class JobScheduler(object):
+    """ runs jobs highest priority first on a pool of workers per
+    resource, as many workers as the resource's limit (one writer on the
+    card, a hash per core on the host...)
+
+    callbacks never run on the worker threads, they are posted and run by
+    whoever calls runPosted, the ui event loop in sd2snestool
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.jobs = []
+        # bumped on every state change, cheap to poll from the ui
+        self.version = 0
+        self._queue = []
+        self._running = {}
+        self._workers = {}
+        self._posted = []
+        self._lock = threading.Condition()
+
+    def _changed(self):
+        with self._lock:
+            self.version += 1
+
+    def post(self, func, *args):
+        """ queues func(*args) for runPosted """
+        with self._lock:
+            self._posted.append((func, args))
+            self._changed()
+
+    def runPosted(self):
+        with self._lock:
+            posted, self._posted = self._posted, []
+        for func, args in posted:
+            func(*args)
+        return len(posted)
+
+    def submit(self, job):
+        with self._lock:
+            job.scheduler = self
+            self.jobs.append(job)
+            self._enqueue(job)
+            self._dispatch()
+        return job
+
+    def submitBatch(self, name, jobs, onDone=None):
+        batch = Batch(name, jobs, onDone)
+        with self._lock:
+            for job in jobs:
+                job.scheduler = self
+                self.jobs.append(job)
+                self._enqueue(job)
+            self._dispatch()
+        return batch
+
+    def cancel(self, job):
+        """ queued jobs are dropped, running ones stop at their next update
+        """
+        with self._lock:
+            job._cancel.set()
+            if job.state == Job.QUEUED:
+                self._queue.remove(job)
+                self._finish(job, Job.CANCELLED)
+
+    def cancelAll(self):
+        for job in list(self.jobs):
+            if not job.finished:
+                self.cancel(job)
+
+    def retry(self, job):
+        """ requeues a failed or cancelled job """
+        with self._lock:
+            if job.state not in (Job.FAILED, Job.CANCELLED):
+                return
+            job._cancel.clear()
+            job.attempts = 0
+            job.error = None
+            self._enqueue(job)
+            self._dispatch()
+
+    def clearFinished(self):
+        with self._lock:
+            self.jobs = [j for j in self.jobs if not j.finished]
+            self._changed()
+
+    def active(self):
+        return [j for j in self.jobs if not j.finished]
+
+    def wait(self, timeout=None):
+        """ blocks until nothing is queued or running """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._queue or any(self._running.values()):
+                remaining = None if deadline is None else (
+                    deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def _enqueue(self, job):
+        job.state = Job.QUEUED
+        job.queued = time.time()
+        self._queue.append(job)
+        # stable, so equal priorities keep their submit order
+        self._queue.sort(key=lambda j: -j.priority)
+        self._changed()
+
+    def _dispatch(self):
+        """ starts workers for queued jobs, up to each resource's limit """
+        waiting = collections.Counter(j.resource for j in self._queue)
+        for resource, count in waiting.items():
+            workers = self._workers.get(resource, 0)
+            idle = workers - self._running.get(resource, 0)
+            start = min(count - idle, self.limits.get(resource, 1) - workers)
+            for _ in range(start):
+                self._workers[resource] = self._workers.get(resource, 0) + 1
+                thread = threading.Thread(target=self._work, args=(resource,))
+                thread.daemon = True
+                thread.start()
+
+    def _take(self, resource):
+        """ the next queued job for resource, marked running """
+        for job in self._queue:
+            if job.resource == resource:
+                self._queue.remove(job)
+                self._running[resource] = self._running.get(resource, 0) + 1
+                job.state = Job.RUNNING
+                job.attempts += 1
+                self._changed()
+                return job
+        return None
+
+    def runNow(self, job):
+        """ runs a quick job on the calling thread, no resource is held and
+        its callbacks are still posted
+        """
+        with self._lock:
+            job.scheduler = self
+            self.jobs.append(job)
+            job.state = Job.RUNNING
+            job.attempts += 1
+            self._changed()
+        state = self._traced(job)
+        with self._lock:
+            self._finish(job, state)
+            self._lock.notify_all()
+        return job
+
+    def _traced(self, job):
+        span = TRACER.on and TRACER.begin(job.name, 'job')
+        if span and job.queued:
+            TRACER.add('queued', job.queued, span[2], 'queue',
+                       job=job.name, resource=job.resource)
+        state = self._call(job)
+        if job._phase:
+            TRACER.end(job._phase)
+            job._phase = None
+        if span:
+            TRACER.end(span, state=state, resource=job.resource)
+        return state
+
+    @staticmethod
+    def _call(job):
+        try:
+            job.result = job.func(job, *job.args)
+        except Cancelled:
+            return Job.CANCELLED
+        except Exception as e:
+            job.error = e
+            return Job.FAILED
+        return Job.DONE
+
+    def _work(self, resource):
+        """ a worker runs jobs for its resource until none are queued """
+        while True:
+            with self._lock:
+                job = self._take(resource)
+                if job is None:
+                    self._workers[resource] -= 1
+                    self._lock.notify_all()
+                    return
+            state = self._traced(job)
+            with self._lock:
+                self._running[resource] -= 1
+                if state == Job.FAILED and job.attempts <= job.retries:
+                    self._enqueue(job)
+                else:
+                    self._finish(job, state)
+                self._lock.notify_all()
+
+    def _finish(self, job, state):
+        job.state = state
+        self._changed()
+        if job.onDone:
+            self._posted.append((job.onDone, (job,)))
+        batch = job.batch
+        if batch and batch.onDone and batch.finished:
+            self._posted.append((batch.onDone, (batch,)))
+
+# --------------------------------------------------------------------------- #
+# - Usb2Snes                                                                - #
+# --------------------------------------------------------------------------- #
+
+USB2SNES_PORT = 23074
+USB2SNES_CHUNK = 1024
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+class Usb2SnesError(IOError):
+    pass
+
+def parseAddress(text, port=USB2SNES_PORT):
+    """ (host, port) of "host:port", port is optional. a port that isn't a
+    number raises ValueError
+    """
+    host, _, number = text.strip().rpartition(':')
+    if not host:
+        return text.strip() or 'localhost', port
+    try:
+        return host, int(number)
+    except ValueError:
+        raise ValueError('bad usb2snes port in %r' % text)
+
+def _wsAccept(key):
+    digest = hashlib.sha1((key + WS_GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+def _wsMask(data, key):
+    """ xor data with the repeating 4 byte key, one big int op """
+    if not data:
+        return data
+    size = len(data)
+    key = (key * (size // 4 + 1))[:size]
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify('%0*x' % (size * 2, value))
+
+class WebSocket(object):
+    """ just enough of rfc 6455 for usb2snes, clients mask, servers don't
+    """
+
+    TEXT = 0x1
+    BINARY = 0x2
+    CLOSE = 0x8
+    PING = 0x9
+    PONG = 0xA
+
+    def __init__(self, sock, client=True):
+        self.sock = sock
+        self.client = client
+        self._buffer = b''
+
+    @classmethod
+    def connect(cls, host, port, timeout=10):
+        sock = socket.create_connection((host, port), timeout)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = (
+            'GET / HTTP/1.1\r\n'
+            'Host: %s:%s\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: %s\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n' % (host, port, key))
+        sock.sendall(request.encode('ascii'))
+
+        ws = cls(sock)
+        status, headers = ws._readHeaders()
+        accept = headers.get('sec-websocket-accept')
+        if ' 101 ' not in status or accept != _wsAccept(key):
+            sock.close()
+            raise Usb2SnesError('websocket handshake failed: %s' % status)
+        return ws
+
+    @classmethod
+    def accept(cls, sock):
+        """ server side handshake """
+        ws = cls(sock, client=False)
+        status, headers = ws._readHeaders()
+        key = headers.get('sec-websocket-key', '')
+        response = (
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: %s\r\n\r\n' % _wsAccept(key))
+        sock.sendall(response.encode('ascii'))
+        return ws
+
+    def _readHeaders(self):
+        """ (status line, {lower case name: value}) of an http head """
+        while b'\r\n\r\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise Usb2SnesError('connection closed during handshake')
+            self._buffer += data
+        head, self._buffer = self._buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return lines[0], headers
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            data = self.sock.recv(max(65536, size - len(self._buffer)))
+            if not data:
+                raise Usb2SnesError('connection closed')
+            self._buffer += data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def frame(self, opcode, payload):
+        """ the bytes of one frame, lets callers send several at once """
+        size = len(payload)
+        maskbit = 0x80 if self.client else 0
+        head = struct.pack('!B', 0x80 | opcode)
+        if size < 126:
+            head += struct.pack('!B', maskbit | size)
+        elif size < 65536:
+            head += struct.pack('!BH', maskbit | 126, size)
+        else:
+            head += struct.pack('!BQ', maskbit | 127, size)
+        if self.client:
+            key = os.urandom(4)
+            return head + key + _wsMask(payload, key)
+        return head + payload
+
+    def send(self, payload, opcode=TEXT):
+        if opcode == self.TEXT and not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        self.sock.sendall(self.frame(opcode, payload))
+
+    def recv(self):
+        """ (opcode, payload) of the next data message, pings answered """
+        message = b''
+        first = None
+        while True:
+            b0, b1 = struct.unpack('!BB', self._read(2))
+            opcode = b0 & 0x0F
+            size = b1 & 0x7F
+            if size == 126:
+                size, = struct.unpack('!H', self._read(2))
+            elif size == 127:
+                size, = struct.unpack('!Q', self._read(8))
+            key = self._read(4) if b1 & 0x80 else None
+            payload = self._read(size)
+            if key:
+                payload = _wsMask(payload, key)
+
+            if opcode == self.PING:
+                self.send(payload, self.PONG)
+                continue
+            elif opcode == self.PONG:
+                continue
+            elif opcode == self.CLOSE:
+                raise Usb2SnesError('connection closed by peer')
+
+            if first is None:
+                first = opcode
+            message += payload
+            if b0 & 0x80:
+                return first, message
+
+    def close(self):
+        try:
+            self.send(b'', self.CLOSE)
+        except (socket.error, IOError):
+            pass
+        self.sock.close()
+
+class Usb2Snes(object):
+    """ client for the QUsb2Snes/usb2snes websocket protocol
+
+    one connection is kept open, commands that get a reply can be pipelined
+    through batch() and remote listings are cached until something changes
+    the remote folder
+    """
+
+    def __init__(self, host='localhost', port=USB2SNES_PORT,
+                 name='sd2snestool'):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.device = None
+        self._ws = None
+        self._listings = {}
+        self._lock = threading.RLock()
+
+    @property
+    def connected(self):
+        return self._ws is not None
+
+    def connect(self, device=None):
+        """ connects and attaches to device, or the first one found """
+        with self._lock:
+            if self._ws is not None:
+                return self.device
+            self._ws = WebSocket.connect(self.host, self.port)
+            try:
+                devices = self.command('DeviceList')
+                if not devices:
+                    raise Usb2SnesError('no usb2snes devices found')
+                self.device = device or devices[0]
+                self._send('Attach', [self.device])
+                self._send('Name', [self.name])
+            except Exception:
+                self.close()
+                raise
+            return self.device
+
+    def close(self):
+        with self._lock:
+            if self._ws is not None:
+                self._ws.close()
+            self._ws = None
+            self.device = None
+            self._listings = {}
+
+    def _send(self, opcode, operands=(), space='SNES'):
+        message = {'Opcode': opcode, 'Space': space,
+                   'Operands': list(operands)}
+        self._ws.send(json.dumps(message))
+
+    def _reply(self):
+        opcode, payload = self._ws.recv()
+        if opcode != WebSocket.TEXT:
+            raise Usb2SnesError('expected a text reply')
+        return json.loads(payload.decode('utf-8')).get('Results', [])
+
+    def command(self, opcode, *operands):
+        """ sends a command that gets a reply and returns its results """
+        return self.batch([(opcode,) + operands])[0]
+
+    def batch(self, commands):
+        """ sends every (opcode, operands...) before reading any reply
+
+        saves a round trip per command, every command has to be one that
+        the server replies to (List, Info, DeviceList...)
+        """
+        with self._lock:
+            if self._ws is None:
+                self.connect()
+            try:
+                for command in commands:
+                    self._send(command[0], command[1:])
+                return [self._reply() for _ in commands]
+            except (socket.error, IOError):
+                self.close()
+                raise
+
+    def info(self):
+        return self.command('Info')
+
+    @staticmethod
+    def _parseList(results):
+        """ [(isDir, name)], usb2snes sends a flat [type, name, ...] list """
+        entries = []
+        for kind, name in zip(results[::2], results[1::2]):
+            if name not in ('.', '..'):
+                entries.append((kind == '0', name))
+        return sorted(entries)
+
+    def list(self, path, fresh=False):
+        return self.listMany([path], fresh)[path]
+
+    def listMany(self, paths, fresh=False):
+        """ {path: listing}, uncached folders are fetched in one batch """
+        with self._lock:
+            missing = [p for p in paths if fresh or p not in self._listings]
+            if missing:
+                results = self.batch([('List', p) for p in missing])
+                for path, result in zip(missing, results):
+                    self._listings[path] = self._parseList(result)
+            return dict((p, self._listings[p]) for p in paths)
+
+    def exists(self, path):
+        folder, name = posixpath.split(path.rstrip('/'))
+        try:
+            entries = self.list(folder or '/')
+        except Usb2SnesError:
+            return False
+        return name in [n for _, n in entries]
+
+    def _invalidate(self, path):
+        self._listings.pop(posixpath.dirname(path.rstrip('/')) or '/', None)
+        self._listings.pop(path, None)
+
+    def makeDirs(self, path):
+        """ creates path and any missing parent folders """
+        with self._lock:
+            parts = [p for p in path.split('/') if p]
+            current = '/'
+            for part in parts:
+                child = posixpath.join(current, part)
+                if (True, part) not in self.list(current):
+                    self._send('MakeDir', [child])
+                    self._invalidate(child)
+                current = child
+
+    def remove(self, path):
+        with self._lock:
+            self._send('Remove', [path])
+            self._invalidate(path)
+
+    def boot(self, path):
+        with self._lock:
+            self._send('Boot', [path])
+
+    def putFile(self, src, dst, progress=None, chunk=USB2SNES_CHUNK):
+        """ uploads a local rom, zip members included, to dst on the cart
+
+        chunks are streamed without waiting on the cart, an Info round trip
+        at the end makes sure the server has taken all of them
+        """
+        with self._lock:
+            if self._ws is None:
+                self.connect()
+            self.makeDirs(posixpath.dirname(dst))
+            total = fileSize(src)
+            done = 0
+            try:
+                self._send('PutFile', [dst, '%X' % total])
+                with openRom(src) as f:
+                    while done < total:
+                        # a few chunks per send keeps the syscalls down
+                        frames = []
+                        for _ in range(16):
+                            block = f.read(chunk)
+                            if not block:
+                                break
+                            frames.append(
+                                self._ws.frame(WebSocket.BINARY, block))
+                            done += len(block)
+                        if not frames:
+                            break
+                        self._ws.sock.sendall(b''.join(frames))
+                        if progress:
+                            progress(done, total)
+                self._send('Info')
+                self._reply()
+            except Exception:
+                # a half sent file leaves the server waiting for data
+                self.close()
+                raise
+            self._invalidate(dst)
+        return dst
+
+    def getFile(self, src, progress=None):
+        """ the bytes of src on the cart, the size comes first as hex """
+        with self._lock:
+            if self._ws is None:
+                self.connect()
+            try:
+                self._send('GetFile', [src])
+                total = int(self._reply()[0], 16)
+                data = b''
+                while len(data) < total:
+                    opcode, block = self._ws.recv()
+                    if opcode != WebSocket.BINARY:
+                        raise Usb2SnesError('expected file data')
+                    data += block
+                    if progress:
+                        progress(len(data), total)
+            except Exception:
+                self.close()
+                raise
+        return data
+
+class MockUsb2Snes(object):
+    """ local stand-in for QUsb2Snes that keeps the cart in a dict
+
+    speaks the same websocket protocol, so the client can be tried out
+    without hardware:
+
+        server = MockUsb2Snes().start()
+        client = Usb2Snes(port=server.port)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.files = {}
+        self.dirs = set(['/'])
+        self.booted = None
+        self.commands = []
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(5)
+        self.host, self.port = self._server.getsockname()
+
+    def start(self):
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        # close alone leaves a python 2 accept() listening on the socket
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self._server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except (socket.error, OSError):
+                return
+            thread = threading.Thread(target=self._client, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _client(self, sock):
+        try:
+            ws = WebSocket.accept(sock)
+            while True:
+                opcode, payload = ws.recv()
+                if opcode != WebSocket.TEXT:
+                    continue
+                message = json.loads(payload.decode('utf-8'))
+                self.commands.append(message['Opcode'])
+                reply = self.handle(ws, message['Opcode'],
+                                    message.get('Operands', []))
+                if reply is not None:
+                    ws.send(json.dumps({'Results': reply}))
+        except (Usb2SnesError, socket.error, IOError, ValueError):
+            sock.close()
+
+    def handle(self, ws, opcode, operands):
+        """ the reply results for a command, None when there is no reply """
+        if opcode == 'DeviceList':
+            return ['MOCK SD2SNES']
+        elif opcode == 'Info':
+            return ['1.10.3', 'MOCK', self.booted or '/sd2snes/menu.bin']
+        elif opcode == 'List':
+            folder = operands[0].rstrip('/') or '/'
+            if folder not in self.dirs:
+                return []
+            result = ['0', '.', '0', '..']
+            for path in sorted(self.dirs | set(self.files)):
+                if path != '/' and posixpath.dirname(path) == folder:
+                    kind = '0' if path in self.dirs else '1'
+                    result.extend([kind, posixpath.basename(path)])
+            return result
+        elif opcode == 'MakeDir':
+            self.dirs.add(operands[0].rstrip('/'))
+        elif opcode == 'Remove':
+            self.files.pop(operands[0], None)
+            self.dirs.discard(operands[0])
+        elif opcode == 'PutFile':
+            size = int(operands[1], 16)
+            data = b''
+            while len(data) < size:
+                _, block = ws.recv()
+                data += block
+            self.files[operands[0]] = data
+        elif opcode == 'GetFile':
+            data = self.files.get(operands[0], b'')
+            ws.send(json.dumps({'Results': ['%X' % len(data)]}))
+            for start in range(0, len(data), USB2SNES_CHUNK):
+                ws.send(data[start:start + USB2SNES_CHUNK], WebSocket.BINARY)
+        elif opcode == 'Boot':
+            self.booted = operands[0]
+
+# --------------------------------------------------------------------------- #
+# - Viewers                                                                 - #
+# --------------------------------------------------------------------------- #
+
+SEARCH_CHUNK = 4 * 1024 * 1024
+
+def _printable(c):
+    return chr(c) if 32 <= c < 127 else '.'
+
+class HexDump(object):
+    """ hex/ascii rows of a file that is mmapped, not read
+
+    rows are formatted when asked for, so memory stays flat no matter how
+    big the file is
+    """
+
+    WIDTH = 16
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size:
+            self.data = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+    def __len__(self):
+        return (self.size + self.WIDTH - 1) // self.WIDTH
+
+    def rowOf(self, offset):
+        return offset // self.WIDTH
+
+    def row(self, index):
+        offset = index * self.WIDTH
+        chunk = bytearray(self.data[offset:offset + self.WIDTH])
+        hexes = ' '.join('%02X' % c for c in chunk)
+        text = ''.join(_printable(c) for c in chunk)
+        return '%08X  %-*s  %s' % (offset, self.WIDTH * 3 - 1, hexes, text)
+
+    __getitem__ = row
+
+    def close(self):
+        if self.size:
+            self.data.close()
+        self._file.close()
+
+def parsePattern(text):
+    """ bytes to search for, a9 00 8d is hex, "quoted" or non hex is ascii
+    """
+    if len(text) > 1 and text[0] == text[-1] == '"':
+        return text[1:-1].encode('latin-1')
+    compact = text.replace(' ', '')
+    if compact and len(compact) % 2 == 0:
+        try:
+            return binascii.unhexlify(compact)
+        except (TypeError, ValueError, binascii.Error):
+            pass
+    return text.encode('latin-1')
+
+class Search(object):
+    """ every offset of pattern in data, found by a background thread
+
+    matches is filled in as they are found, so it can be read while the
+    search is still running. data can be anything with find(), a mmap is
+    searched a chunk at a time so cancel() stops it quickly
+    """
+
+    def __init__(self, data, pattern, chunk=SEARCH_CHUNK):
+        self.pattern = pattern
+        self._data = data
+        self._chunk = max(chunk, len(pattern))
+        self._start()
+
+    def _start(self):
+        self.matches = []
+        self.done = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.done
+
+    def _run(self):
+        data, pattern = self._data, self.pattern
+        size = len(data)
+        start = 0
+        while pattern and start < size and not self._stop.is_set():
+            # overlap the chunks so a match across the boundary is found
+            end = min(start + self._chunk + len(pattern) - 1, size)
+            found = data.find(pattern, start, end)
+            while found != -1:
+                self.matches.append(found)
+                found = data.find(pattern, found + 1, end)
+            start += self._chunk
+        self.done = True
+
+    # matches only ever grows at the end, so reading it up to a length
+    # taken first is safe while the thread is still appending
+
+    def nextMatch(self, offset):
+        """ first match after offset, wrapping around """
+        matches, count = self.matches, len(self.matches)
+        if not count:
+            return None
+        i = bisect.bisect_right(matches, offset, 0, count)
+        return matches[i % count]
+
+    def prevMatch(self, offset):
+        matches, count = self.matches, len(self.matches)
+        if not count:
+            return None
+        i = bisect.bisect_left(matches, offset, 0, count) - 1
+        return matches[i % count]
+
+    def between(self, start, end):
+        """ matches in [start, end) """
+        matches, count = self.matches, len(self.matches)
+        lo = bisect.bisect_left(matches, start, 0, count)
+        hi = bisect.bisect_left(matches, end, lo, count)
+        return matches[lo:hi]
+
+class LineSearch(Search):
+    """ numbers of the lines of source that contain text, any case
+
+    source is a list of lines or a LineIndex, one that is still being
+    indexed is followed until it is done
+    """
+
+    def __init__(self, source, text):
+        self.text = text.lower()
+        self.source = source
+        self._start()
+
+    def _run(self):
+        if isinstance(self.source, LineIndex):
+            self._runIndex()
+        else:
+            for i, line in enumerate(self.source):
+                if self._stop.is_set():
+                    break
+                if self.text and self.text in line.lower():
+                    self.matches.append(i)
+        self.done = True
+
+    def _runIndex(self, lines=65536):
+        """ searches a block of lines at a time straight from the mmap and
+        maps the hits back to line numbers through the line offsets
+        """
+        source, matches = self.source, self.matches
+        offsets = source.offsets
+        needle = self.text
+        if not isinstance(needle, bytes):
+            needle = needle.encode('utf-8')
+        i = 0
+        while needle and not self._stop.is_set():
+            count = len(source)
+            if i >= count:
+                if source.done:
+                    break
+                time.sleep(0.05)
+                continue
+            j = min(i + lines, count)
+            start = offsets[i]
+            end = offsets[j] if j < len(offsets) else source.size
+            block = source.data[start:end].lower()
+            found = block.find(needle)
+            while found != -1:
+                line = bisect.bisect_right(offsets, start + found, i, j) - 1
+                if not matches or matches[-1] != line:
+                    matches.append(line)
+                found = block.find(needle, found + 1)
+            i = j
+
+class LineIndex(object):
+    """ lines of a big text file found by offset, not held in memory
+
+    the file is mmapped and a background thread builds an array of line
+    start offsets in one pass, lines that are already indexed can be read
+    while it is still going
+    """
+
+    def __init__(self, path, chunk=SEARCH_CHUNK):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.data = b''
+        if self.size:
+            self.data = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = array.array('L', [0])
+        self.done = False
+        self._chunk = chunk
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._build)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _build(self):
+        data, size = self.data, self.size
+        offsets = self.offsets
+        start = 0
+        while start < size and not self._stop.is_set():
+            end = min(start + self._chunk, size)
+            found = data.find(b'\n', start, end)
+            while found != -1:
+                offsets.append(found + 1)
+                found = data.find(b'\n', found + 1, end)
+            start = end
+        self.done = True
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.done
+
+    def __len__(self):
+        count = len(self.offsets)
+        if not self.done:
+            # the end of the last line isn't known yet
+            return count - 1
+        return count - 1 if self.offsets[-1] == self.size else count
+
+    def line(self, index):
+        """ raw bytes of a line without the line break """
+        start = self.offsets[index]
+        if index + 1 < len(self.offsets):
+            end = self.offsets[index + 1] - 1
+        else:
+            end = self.size
+        return self.data[start:end].rstrip(b'\r')
+
+    def __getitem__(self, index):
+        return self.line(index).decode('utf-8', 'replace').expandtabs()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        if self.size:
+            self.data.close()
+        self._file.close()
+
+# --------------------------------------------------------------------------- #
+# - Item lists                                                              - #
+# --------------------------------------------------------------------------- #
+
+# undecodable file names round trip on python 3, python 2 strs are bytes
+_TEXT_ERRORS = 'strict' if str is bytes else 'surrogateescape'
+
+def _packText(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8', _TEXT_ERRORS)
+
+def _unpackText(raw):
+    return raw if str is bytes else raw.decode('utf-8', _TEXT_ERRORS)
+
+class PackedItems(object):
+    """ a read only list of strings kept in one utf-8 buffer
+
+    item i is data[offsets[i]:offsets[i + 1]], so a million names cost
+    one buffer and one array instead of a million str objects, strings
+    are only made for the items that get asked for
+    """
+
+    def __init__(self, items=()):
+        data = bytearray()
+        offsets = array.array('L', [0])
+        for item in items:
+            data += _packText(item)
+            offsets.append(len(data))
+        self.data = bytes(data)
+        self.offsets = offsets
+        self._lower = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return _unpackText(self.data[start:end])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def filter(self, match):
+        """ array of the indices of the items match(item) is true for """
+        return array.array('I', (i for i, item in enumerate(self)
+                                 if match(item)))
+
+    def find(self, text):
+        """ array of the indices of the items containing text, ignoring
+        case, ascii text is found by searching the whole buffer at once
+        """
+        text = text.lower()
+        if not text:
+            return array.array('I', range(len(self)))
+        needle = _packText(text)
+        try:
+            needle.decode('ascii')
+        except UnicodeDecodeError:
+            return self.filter(lambda item: text in item.lower())
+
+        if self._lower is None:
+            self._lower = self.data.lower()
+        data, offsets = self._lower, self.offsets
+        found = array.array('I')
+        pos = data.find(needle)
+        while pos != -1:
+            index = bisect.bisect_right(offsets, pos) - 1
+            end = offsets[index + 1]
+            if pos + len(needle) <= end:
+                found.append(index)
+                pos = data.find(needle, end)
+            else:  # ran into the next item
+                pos = data.find(needle, pos + 1)
+        return found
+
+# --------------------------------------------------------------------------- #
+# - MSU-1                                                                   - #
+# --------------------------------------------------------------------------- #
+
+MSU_EXT = '.msu'
+PCM_EXT = '.pcm'
+PCM_MAGIC = b'MSU1'
+PART_EXT = '.part'
+# how much to copy one way and the other before settling on a strategy
+PROBE_BYTES = 64 * 1024 * 1024
+
+def isMsu(name):
+    return os.path.splitext(name)[1].lower() == MSU_EXT
+
+def readPcmHeader(path):
+    """ loop point of an msu-1 track, None if the 8 byte header is bad """
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if len(head) < 8 or head[:4] != PCM_MAGIC:
+        return None
+    loop, = struct.unpack('<I', head[4:])
+    return loop
+
+class MsuPack(object):
+    """ an msu-1 game, the rom, its .msu data file and the -N.pcm tracks
+
+    names is the folder listing, pass it in when looking at several packs
+    in one folder so it is only read once
+    """
+
+    def __init__(self, msu, names=None):
+        self.msu = msu
+        self.folder, name = os.path.split(msu)
+        self.name = os.path.splitext(name)[0]
+        self.rom = None
+        self.tracks = {}
+
+        prefix = self.name + '-'
+        names = os.listdir(self.folder) if names is None else names
+        for entry in names:
+            stem, ext = os.path.splitext(entry)
+            path = os.path.join(self.folder, entry)
+            if stem == self.name and isRom(entry):
+                self.rom = path
+            elif (ext.lower() == PCM_EXT and stem.startswith(prefix)
+                  and stem[len(prefix):].isdigit()):
+                self.tracks[int(stem[len(prefix):])] = path
+        self._size = None
+
+    def files(self):
+        """ rom and data file first, then the tracks in order """
+        files = [self.rom] if self.rom else []
+        files.append(self.msu)
+        files.extend(self.tracks[i] for i in sorted(self.tracks))
+        return files
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = sum(os.path.getsize(f) for f in self.files())
+        return self._size
+
+    def missingTracks(self):
+        """ gaps in the track numbers, trailing tracks can't be known """
+        if not self.tracks:
+            return []
+        return [i for i in range(1, max(self.tracks))
+                if i not in self.tracks]
+
+    def badTracks(self):
+        """ tracks whose header is wrong, only 8 bytes of each are read """
+        bad = []
+        for number, path in sorted(self.tracks.items()):
+            loop = readPcmHeader(path)
+            samples = (os.path.getsize(path) - 8) // 4
+            if loop is None or loop > samples:
+                bad.append(number)
+        return bad
+
+    def problems(self):
+        problems = []
+        if not self.rom:
+            problems.append('no rom')
+        missing = self.missingTracks()
+        if missing:
+            problems.append('missing tracks %s' % _ranges(missing))
+        bad = self.badTracks()
+        if bad:
+            problems.append('bad tracks %s' % _ranges(bad))
+        return problems
+
+def _ranges(numbers):
+    """ "1-3,7" for [1, 2, 3, 7] """
+    ranges = []
+    for number in sorted(numbers):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(
+        '%s-%s' % (a, b) if a != b else str(a) for a, b in ranges)
+
+def copyResumable(src, dst, bufsize=COPY_BLOCK, progress=None,
+                  syncBytes=None):
+    """ copies a file through dst.part, returns how many bytes were written
+
+    an interrupted copy carries on from the end of the .part file, a dst
+    that is already complete is skipped
+    """
+    total = os.path.getsize(src)
+    if os.path.isfile(dst) and os.path.getsize(dst) == total:
+        if progress:
+            progress(total, total)
+        return 0
+
+    dirname = os.path.dirname(dst)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    part = dst + PART_EXT
+    done = os.path.getsize(part) if os.path.isfile(part) else 0
+    if done > total:
+        done = 0
+
+    with open(src, 'rb') as fi:
+        with open(part, 'ab' if done else 'wb') as fo:
+            fi.seek(done)
+            written = _pump(
+                fi, fo, bufsize, done, total, progress, syncBytes)
+
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(part, dst)
+    return written
+
+def _copyMany(pairs, workers, bufsize, report, syncBytes=None):
+    """ copies (src, dst) pairs on workers threads, returns (bytes, secs)
+    """
+    pairs = list(pairs)
+    lock = threading.Lock()
+    errors = []
+    written = [0]
+
+    def work():
+        while not errors:
+            with lock:
+                if not pairs:
+                    return
+                src, dst = pairs.pop(0)
+            try:
+                count = copyResumable(
+                    src, dst, bufsize, report(src), syncBytes)
+            except Exception as e:
+                errors.append(e)
+                return
+            with lock:
+                written[0] += count
+
+    start = time.time()
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return written[0], time.time() - start
+
+def _takeBytes(pairs, size):
+    """ pops pairs off the front until they add up to size """
+    taken = []
+    while pairs and size > 0:
+        taken.append(pairs.pop(0))
+        size -= os.path.getsize(taken[-1][0])
+    return taken
+
+def copyMsuPack(pack, folder, progress=None, workers=None,
+                bufsize=COPY_BLOCK, syncBytes=None):
+    """ copies every file of pack into folder, returns the workers used
+
+    without workers the first PROBE_BYTES are copied one file at a time
+    and the next PROBE_BYTES two at a time, whichever the card takes
+    faster is used for the rest. files already on the card are skipped
+    and half copied ones resumed.
+    """
+    pairs = [(f, os.path.join(folder, os.path.basename(f)))
+             for f in pack.files()]
+    total = sum(os.path.getsize(src) for src, _ in pairs)
+    copied = dict((src, 0) for src, _ in pairs)
+    lock = threading.Lock()
+
+    def report(src):
+        def update(done, _):
+            with lock:
+                copied[src] = done
+                current = sum(copied.values())
+            if progress:
+                progress(current, total)
+        return update
+
+    if workers is None:
+        written, secs = _copyMany(
+            _takeBytes(pairs, PROBE_BYTES), 1, bufsize, report, syncBytes)
+        serial = written / secs if written and secs else 0
+        written, secs = _copyMany(
+            _takeBytes(pairs, PROBE_BYTES), 2, bufsize, report, syncBytes)
+        parallel = written / secs if written and secs else 0
+        # only go parallel when the card clearly likes it
+        workers = 2 if serial and parallel > serial * 1.1 else 1
+
+    _copyMany(pairs, workers, bufsize, report, syncBytes)
+    return workers
+
+# --------------------------------------------------------------------------- #
+# - Patches                                                                 - #
+# --------------------------------------------------------------------------- #
+
+PATCH_EXTS = ('.ips', '.bps')
+IPS_MAGIC = b'PATCH'
+IPS_EOF = b'EOF'
+BPS_MAGIC = b'BPS1'
+
+class PatchError(ValueError):
+    pass
+
+def isPatch(name):
+    return os.path.splitext(name)[1].lower() in PATCH_EXTS
+
+def _blocks(data):
+    """ data a block at a time as bytes, works for mmaps and bytearrays """
+    for start in range(0, len(data), COPY_BLOCK):
+        yield bytes(data[start:start + COPY_BLOCK])
+
+def _crc32(data):
+    crc = 0
+    for block in _blocks(data):
+        crc = zlib.crc32(block, crc)
+    return crc & 0xFFFFFFFF
+
+class _PatchStream(object):
+    """ reads a patch front to back, keeping a crc32 of what was read """
+
+    def __init__(self, fo):
+        self._fo = fo
+        self.crc = 0
+        self.pos = 0
+
+    def read(self, size):
+        data = self._fo.read(size)
+        if len(data) != size:
+            raise PatchError('patch is truncated')
+        self.crc = zlib.crc32(data, self.crc)
+        self.pos += size
+        return data
+
+    def byte(self):
+        return bytearray(self.read(1))[0]
+
+    def varint(self):
+        """ bps number, 7 bits at a time with an implicit +1 per byte """
+        value, shift = 0, 1
+        while True:
+            byte = self.byte()
+            value += (byte & 0x7F) * shift
+            if byte & 0x80:
+                return value
+            shift <<= 7
+            value += shift
+
+def applyIps(source, fo):
+    """ target bytes for an ips patch read from fo """
+    patch = _PatchStream(fo)
+    if patch.read(5) != IPS_MAGIC:
+        raise PatchError('not an ips patch')
+    target = bytearray(source)
+    while True:
+        head = fo.read(3)
+        if head == IPS_EOF:
+            break
+        if len(head) < 3:
+            raise PatchError('ips patch ends without EOF, truncated?')
+        offset, = struct.unpack('>I', b'\0' + head)
+        size, = struct.unpack('>H', patch.read(2))
+        if size:
+            data = patch.read(size)
+        else:
+            count, = struct.unpack('>H', patch.read(2))
+            data = patch.read(1) * count
+        end = offset + len(data)
+        if end > len(target):
+            target.extend(b'\0' * (end - len(target)))
+        target[offset:end] = data
+    # lunar ips can truncate the target after the eof marker
+    tail = fo.read(3)
+    if len(tail) == 3:
+        size, = struct.unpack('>I', b'\0' + tail)
+        del target[size:]
+    return target
+
+def applyBps(source, fo, patchSize, sourceCrc=None):
+    """ target bytes for a bps patch of patchSize bytes read from fo
+
+    the source, target and patch crcs are all checked, pass sourceCrc when
+    it is known already to save a pass over the source
+    """
+    patch = _PatchStream(fo)
+    if patch.read(4) != BPS_MAGIC:
+        raise PatchError('not a bps patch')
+    sourceSize = patch.varint()
+    targetSize = patch.varint()
+    patch.read(patch.varint())  # metadata
+    if sourceSize != len(source):
+        raise PatchError('source is %s bytes, the patch wants %s' % (
+            len(source), sourceSize))
+    if sourceCrc is None:
+        sourceCrc = _crc32(source)
+
+    target = bytearray(targetSize)
+    out = sourceRel = targetRel = 0
+    end = patchSize - 12
+    while patch.pos < end:
+        data = patch.varint()
+        action, length = data & 3, (data >> 2) + 1
+        if action == 0:  # source read
+            target[out:out + length] = source[out:out + length]
+        elif action == 1:  # target read
+            target[out:out + length] = patch.read(length)
+        else:
+            offset = patch.varint()
+            offset = -(offset >> 1) if offset & 1 else offset >> 1
+            if action == 2:  # source copy
+                sourceRel += offset
+                target[out:out + length] = (
+                    source[sourceRel:sourceRel + length])
+                sourceRel += length
+            else:  # target copy, may overlap what it is writing
+                targetRel += offset
+                for i in range(length):
+                    target[out + i] = target[targetRel + i]
+                targetRel += length
+        out += length
+
+    crcs = patch.read(8)
+    patchCrc = patch.crc
+    expectSource, expectTarget = struct.unpack('<II', crcs)
+    tail = fo.read(4)
+    if len(tail) != 4:
+        raise PatchError('patch is truncated')
+    expectPatch, = struct.unpack('<I', tail)
+    if expectPatch != patchCrc & 0xFFFFFFFF:
+        raise PatchError('patch crc mismatch')
+    if expectSource != sourceCrc:
+        raise PatchError('source crc mismatch, wrong base rom?')
+    if expectTarget != _crc32(target):
+        raise PatchError('target crc mismatch')
+    return target
+
+def applyPatch(source, path, sourceCrc=None):
+    """ target bytes for source patched with the ips or bps file at path """
+    with openRom(path) as fo:
+        if path.lower().endswith('.bps'):
+            return applyBps(source, fo, fileSize(path), sourceCrc)
+        return applyIps(source, fo)
+
+def hashFile(path):
+    """ sha1 of a whole file, copier header and all """
+    sha = hashlib.sha1()
+    with openRom(path) as f:
+        while True:
+            block = f.read(COPY_BLOCK)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+def findPatchBase(patch):
+    """ the rom next to a patch whose name it starts with, longest first """
+    archive, _ = splitZipPath(patch)
+    folder = os.path.dirname(archive)
+    stem = os.path.splitext(romName(patch))[0].lower()
+    best = None
+    for name in os.listdir(folder):
+        romStem = os.path.splitext(name)[0].lower()
+        if isRom(name) and stem.startswith(romStem):
+            if best is None or len(romStem) > len(best[0]):
+                best = romStem, os.path.join(folder, name)
+    return best[1] if best else None
+
+class PatchCache(object):
+    """ patched roms kept by (base hash, patch hash) so a patch is only ever
+    applied once
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder or os.path.join(CONFIG_DIR, 'patches')
+
+    def path(self, baseHash, patchHash):
+        return os.path.join(
+            self.folder, '%s-%s.bin' % (baseHash[:20], patchHash[:20]))
+
+    def get(self, baseHash, patchHash):
+        path = self.path(baseHash, patchHash)
+        return path if os.path.isfile(path) else None
+
+    def put(self, baseHash, patchHash, data):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        path = self.path(baseHash, patchHash)
+        with open(path + PART_EXT, 'wb') as fo:
+            fo.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + PART_EXT, path)
+        return path
+
+def _sourceBuffer(path):
+    """ (buffer, closer) for a base rom, plain files are mmapped """
+    archive, member = splitZipPath(path)
+    if member is not None or not os.path.getsize(path):
+        with openRom(path) as f:
+            return f.read(), lambda: None
+    fo = open(path, 'rb')
+    data = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close():
+        data.close()
+        fo.close()
+    return data, close
+
+def patchMany(base, patches, cache=None, progress=None):
+    """ {patch: cached output} for every patch applied to base
+
+    the base is mapped and hashed once for all of the patches, patches that
+    were applied to the same base before come straight from the cache
+    """
+    cache = cache or PatchCache()
+    results = {}
+    data, close = _sourceBuffer(base)
+    try:
+        # the one full read of the base, bps patches need its crc
+        sha, crc = hashlib.sha1(), 0
+        for block in _blocks(data):
+            sha.update(block)
+            crc = zlib.crc32(block, crc)
+        baseHash, sourceCrc = sha.hexdigest(), crc & 0xFFFFFFFF
+
+        for i, patch in enumerate(patches):
+            patchHash = hashFile(patch)
+            cached = cache.get(baseHash, patchHash)
+            if not cached:
+                target = applyPatch(data, patch, sourceCrc)
+                cached = cache.put(baseHash, patchHash, target)
+            results[patch] = cached
+            if progress:
+                progress(i + 1, len(patches))
+    finally:
+        close()
+    return results
+
+PATCHED_SUFFIX = ' (patched)'
+
+def patchedPath(base, patch):
+    """ where writePatched puts base patched with patch, next to the patch
+    and named after it, Game.ips makes "Game (patched).sfc"
+    """
+    archive, _ = splitZipPath(patch)
+    name = os.path.splitext(romName(patch))[0] + PATCHED_SUFFIX + \
+        os.path.splitext(romName(base))[1]
+    return os.path.join(os.path.dirname(os.path.abspath(archive)), name)
+
+def writePatched(base, patches, progress=None, cache=None, overwrite=False):
+    """ patches base with every patch, each result goes to patchedPath
+
+    nothing is written when a result would land on the base, or on a file
+    that exists and overwrite isn't set
+    """
+    targets = dict((patch, patchedPath(base, patch)) for patch in patches)
+    baseFile = os.path.abspath(splitZipPath(base)[0])
+    for dst in targets.values():
+        if dst == baseFile:
+            raise ValueError('Patched rom would replace the base %s' % dst)
+        if os.path.exists(dst) and not overwrite:
+            raise ValueError('Patched rom exists %s' % dst)
+    outputs = []
+    for patch, cached in sorted(
+            patchMany(base, patches, cache, progress).items()):
+        shutil.copyfile(cached, targets[patch])
+        outputs.append(targets[patch])
+    return outputs
+
+# --------------------------------------------------------------------------- #
+# - Index                                                                   - #
+# --------------------------------------------------------------------------- #
+
+INDEX_PATH = os.path.join(CONFIG_DIR, 'index.json')
+INDEX_VERSION = 1
+
+def statRom(path):
+    """ (size, mtime) of a rom, zip members get the mtime of their zip """
+    archive, _ = splitZipPath(path)
+    return fileSize(path), int(os.path.getmtime(archive))
+
+class RomIndex(object):
+    """ size, mtime and sha1 of roms, kept between runs
+
+    roms are keyed by absolute path, one whose size and mtime are the same
+    as last time isn't hashed again. an index of a card has a root, the
+    keys follow it when the card is mounted somewhere else. internal
+    headers are kept apart from the hashes, a rom can have one without
+    the other
+    """
+
+    NEW = 'new'
+    CHANGED = 'changed'
+    SAME = 'same'
+    OK = 'ok'
+    MISMATCH = 'mismatch'
+    MISSING = 'missing'
+
+    def __init__(self, path=INDEX_PATH, root=None):
+        self.path = path
+        self.root = root
+        self.roms = {}
+        self.headers = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.roms = data['roms']
+                self.headers = data.get('headers', {})
+                old = data.get('root')
+                if root and old and old != root:
+                    self.rebase(old, root)
+
+    @staticmethod
+    def key(path):
+        archive, member = splitZipPath(path)
+        archive = os.path.abspath(archive)
+        return archive if member is None else zipPath(archive, member)
+
+    def get(self, path):
+        return self.roms.get(self.key(path))
+
+    def update(self, path, stats=None):
+        """ (state, entry) after bringing path up to date, only new and
+        changed roms are hashed
+        """
+        key = self.key(path)
+        size, mtime = statRom(key)
+        entry = self.roms.get(key)
+        if entry and entry['size'] == size and entry['mtime'] == mtime \
+                and entry['sha1']:
+            return self.SAME, entry
+        state = self.CHANGED if entry else self.NEW
+        entry = {'size': size, 'mtime': mtime,
+                 'sha1': hashRom(key, stats=stats)}
+        self.roms[key] = entry
+        return state, entry
+
+    def header(self, path):
+        """ {size, mtime, info} of a rom, info is the RomInfo of its
+        header as a dict or None. read once and kept until the rom changes
+        """
+        key = self.key(path)
+        size, mtime = statRom(key)
+        record = self.headers.get(key)
+        if record and record['size'] == size and record['mtime'] == mtime:
+            return record
+        info = readHeader(key)
+        if info:
+            info = {'title': info.title, 'mapping': info.mapping,
+                    'region': info.region, 'coprocessor': info.coprocessor,
+                    'hasSave': info.hasSave}
+        record = {'size': size, 'mtime': mtime, 'info': info}
+        self.headers[key] = record
+        return record
+
+    def verify(self, path, stats=None):
+        """ (state, sha1) with the rom hashed again, whatever its mtime """
+        key = self.key(path)
+        entry = self.roms[key]
+        try:
+            sha1 = hashRom(key, stats=stats)
+        except (OSError, IOError, KeyError):
+            return self.MISSING, None
+        return (self.OK if sha1 == entry['sha1'] else self.MISMATCH), sha1
+
+    def rebase(self, old, new):
+        """ moves the keys below old to below new """
+        old = os.path.join(os.path.abspath(old), '')
+        new = os.path.join(os.path.abspath(new), '')
+
+        def moved(roms):
+            return dict(
+                (new + k[len(old):] if k.startswith(old) else k, entry)
+                for k, entry in roms.items())
+
+        self.roms = moved(self.roms)
+        self.headers = moved(self.headers)
+        self.root = new.rstrip(os.sep) or os.sep
+
+    def under(self, roots=None):
+        """ indexed paths below any of roots, all of them without roots """
+        keys = sorted(self.roms)
+        if not roots:
+            return keys
+        prefixes = [os.path.join(os.path.abspath(r), '') for r in roots]
+        return [k for k in keys if any(k.startswith(p) for p in prefixes)]
+
+    def prune(self, roots=None):
+        """ forgets roms below roots that are gone, returns their paths """
+        gone = []
+        for key in self.under(roots):
+            try:
+                statRom(key)
+            except (OSError, IOError, KeyError, zipfile.BadZipfile):
+                del self.roms[key]
+                self.headers.pop(key, None)
+                gone.append(key)
+        return gone
+
+    def save(self):
+        """ written to a temporary file first so a crash can't eat it """
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(self.path + PART_EXT, 'w') as fo:
+            json.dump({'version': INDEX_VERSION, 'root': self.root,
+                       'roms': self.roms, 'headers': self.headers}, fo)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path + PART_EXT, self.path)
+
+# --------------------------------------------------------------------------- #
+# - Sync                                                                    - #
+# --------------------------------------------------------------------------- #
+
+SYNC_SAME = 'same'
+SYNC_MISSING = 'missing'
+SYNC_DIFFERENT = 'different'
+
+def planSync(src, dst, only=None):
+    """ yields (entry, target, state) for every game under src
+
+    target is where the entry goes below dst, msu-1 packs are one entry
+    whose target is a folder, zip members are decompressed to a plain rom
+    and patches are left alone. sizes decide if a copy is up to date.
+    only limits it to some entries, like the ones a CapacityPlan chose
+    """
+    if only is not None:
+        only = set(only)
+    for folder in listFolders(src):
+        target = os.path.normpath(
+            os.path.join(dst, os.path.relpath(folder, src)))
+        for entry in listFolder(folder):
+            if isPatch(entry) or (only is not None and entry not in only):
+                continue
+            if isMsu(entry):
+                files = MsuPack(entry).files()
+                pairs = [(f, os.path.join(target, os.path.basename(f)))
+                         for f in files]
+                yield entry, target, _syncState(pairs)
+            else:
+                dest = os.path.join(target, romName(entry))
+                yield entry, dest, _syncState([(entry, dest)])
+
+def _syncState(pairs):
+    present = 0
+    for src, dst in pairs:
+        if os.path.isfile(dst):
+            present += 1
+            if os.path.getsize(dst) != fileSize(src):
+                return SYNC_DIFFERENT
+    if present == len(pairs):
+        return SYNC_SAME
+    return SYNC_DIFFERENT if present else SYNC_MISSING
+
+def syncEntry(entry, target, progress=None, tuning=None):
+    """ copies one entry of planSync to its target, tuned for the card """
+    if isMsu(entry):
+        pack = MsuPack(entry)
+        tuning = tuning or copyTuning(target, pack.size)
+        copyMsuPack(pack, target, progress, tuning.workers,
+                    tuning.bufsize, tuning.syncBytes)
+    else:
+        tuning = tuning or copyTuning(target, fileSize(entry))
+        copyRom(entry, target, tuning.bufsize, progress, tuning.syncBytes)
+    return target
+
+# --------------------------------------------------------------------------- #
+# - Card                                                                    - #
+# --------------------------------------------------------------------------- #
+
+CARDS_PATH = os.path.join(CONFIG_DIR, 'cards.json')
+BENCH_SIZE = 32 * 1024 * 1024
+BENCH_BLOCKS = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+BENCH_RANDOM_OPS = 256
+BENCH_RANDOM_BLOCK = 4096
+BENCH_SMALL_FILES = 64
+BENCH_SMALL_SIZE = 32 * 1024
+SYNC_SECONDS = 2  # fsync about this often when copying to a benched card
+
+def mountPoint(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def cardId(path):
+    """ volume uuid of the card path is on, its mount point if the uuid
+    can't be found, stats are stored under this
+    """
+    mount = mountPoint(path)
+    device = None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if fields[1].replace('\\040', ' ') == mount:
+                    device = os.path.realpath(fields[0])
+    except (IOError, OSError, IndexError):
+        pass
+    byUuid = '/dev/disk/by-uuid'
+    if device and os.path.isdir(byUuid):
+        for uuid in sorted(os.listdir(byUuid)):
+            if os.path.realpath(os.path.join(byUuid, uuid)) == device:
+                return 'uuid:' + uuid
+    return 'mount:' + mount
+
+def _dropCache(fo):
+    """ asks the os to forget a file so reading it comes off the card """
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise:
+        fadvise(fo.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def _rate(amount, start):
+    return amount / max(time.time() - start, 1e-6)
+
+def _benchWrite(path, size, block):
+    data = os.urandom(block)
+    start = time.time()
+    with open(path, 'wb') as fo:
+        for _ in range(max(size // block, 1)):
+            fo.write(data)
+        fo.flush()
+        os.fsync(fo.fileno())
+        _dropCache(fo)
+    return _rate(max(size // block, 1) * block, start)
+
+def _benchRead(path, block):
+    start = time.time()
+    done = 0
+    with open(path, 'rb') as fi:
+        _dropCache(fi)
+        while True:
+            data = fi.read(block)
+            if not data:
+                break
+            done += len(data)
+    return _rate(done, start)
+
+def _benchRandom(path, write, ops=BENCH_RANDOM_OPS,
+                 block=BENCH_RANDOM_BLOCK):
+    """ block sized reads or writes at random offsets, ops a second """
+    slots = max(os.path.getsize(path) // block, 1)
+    offsets = [random.randrange(slots) * block for _ in range(ops)]
+    data = os.urandom(block)
+    start = time.time()
+    with open(path, 'r+b' if write else 'rb') as fo:
+        _dropCache(fo)
+        for offset in offsets:
+            fo.seek(offset)
+            if write:
+                fo.write(data)
+            else:
+                fo.read(block)
+        if write:
+            fo.flush()
+            os.fsync(fo.fileno())
+    return _rate(ops, start)
+
+def _benchParallel(folder, size, block, workers=2):
+    """ workers files written at once, bytes a second over all of them """
+    threads = [threading.Thread(
+        target=_benchWrite,
+        args=(os.path.join(folder, 'parallel%s.bin' % i), size // workers,
+              block)) for i in range(workers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return _rate(size, start)
+
+def _benchSmallFiles(folder, count=BENCH_SMALL_FILES,
+                     size=BENCH_SMALL_SIZE):
+    """ small files created and fsynced, files a second """
+    data = os.urandom(size)
+    start = time.time()
+    for i in range(count):
+        with open(os.path.join(folder, 'small%s.bin' % i), 'wb') as fo:
+            fo.write(data)
+            fo.flush()
+            os.fsync(fo.fileno())
+    return _rate(count, start)
+
+def benchmarkCard(folder, size=BENCH_SIZE, progress=None):
+    """ sequential and random throughput and small file creation on the
+    card folder is on, measured in a scratch folder that is removed after
+
+    rates are bytes a second for sequential io and ops a second otherwise
+    """
+    scratch = os.path.join(folder, '.sd2snestool-bench-%s' % os.getpid())
+    os.makedirs(scratch)
+    stats = {'card': cardId(folder), 'time': int(time.time()),
+             'size': size, 'write': {}, 'read': {}}
+    steps = len(BENCH_BLOCKS) + 4
+    step = [0]
+
+    def advance():
+        step[0] += 1
+        if progress:
+            progress(step[0], steps)
+
+    try:
+        path = os.path.join(scratch, 'sequential.bin')
+        for block in BENCH_BLOCKS:
+            stats['write'][str(block)] = _benchWrite(path, size, block)
+            stats['read'][str(block)] = _benchRead(path, block)
+            advance()
+        stats['randomRead'] = _benchRandom(path, False)
+        advance()
+        stats['randomWrite'] = _benchRandom(path, True)
+        advance()
+        stats['parallelWrite'] = _benchParallel(
+            scratch, size, bestBlock(stats))
+        advance()
+        stats['smallFiles'] = _benchSmallFiles(scratch)
+        advance()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return stats
+
+def bestBlock(stats):
+    """ the block size that wrote fastest in a benchmark """
+    write = stats['write']
+    return int(max(write, key=lambda b: (write[b], -int(b))))
+
+def loadCards(path=CARDS_PATH):
+    """ {card id: benchmark stats} of every card benchmarked so far """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def saveCard(stats, path=CARDS_PATH):
+    cards = loadCards(path)
+    cards[stats['card']] = stats
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path + PART_EXT, 'w') as fo:
+        json.dump(cards, fo, indent=1, sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + PART_EXT, path)
+
+def cardStats(folder, path=CARDS_PATH):
+    """ the last benchmark of the card folder is on, None if never run """
+    try:
+        return loadCards(path).get(cardId(folder))
+    except (IOError, OSError, ValueError):
+        return None
+
+class CopyTuning(object):
+    """ how to copy to a card, bufsize, msu-1 workers and fsync batching
+
+    workers None lets copyMsuPack find out itself, syncBytes None leaves
+    flushing to the os
+    """
+
+    def __init__(self, bufsize=COPY_BLOCK, workers=None, syncBytes=None):
+        self.bufsize = bufsize
+        self.workers = workers
+        self.syncBytes = syncBytes
+
+    def __repr__(self):
+        return '<CopyTuning bufsize=%s workers=%s syncBytes=%s>' % (
+            self.bufsize, self.workers, self.syncBytes)
+
+def copyTuning(folder, size=None, path=CARDS_PATH):
+    """ CopyTuning for copying size bytes to the card folder is on
+
+    the block size the card wrote fastest, but never much more than the
+    file, two msu-1 workers only if the card took parallel writes
+    clearly faster, and an fsync every SYNC_SECONDS worth of writing
+    """
+    stats = cardStats(folder, path)
+    if not stats:
+        return CopyTuning()
+    bufsize = bestBlock(stats)
+    if size:
+        while bufsize > BENCH_BLOCKS[0] and bufsize // 2 >= size:
+            bufsize //= 2
+    serial = stats['write'][str(bestBlock(stats))]
+    workers = 2 if stats.get('parallelWrite', 0) > serial * 1.1 else 1
+    syncBytes = max(int(serial * SYNC_SECONDS), bufsize)
+    return CopyTuning(bufsize, workers, syncBytes)
+
+# --------------------------------------------------------------------------- #
+# - Layout                                                                  - #
+# --------------------------------------------------------------------------- #
+
+# the cart menu and fat32 lookups crawl past a few hundred entries a folder
+SHARD_CAP = 500
+SHARD_BY = ('range', 'letter', 'region')
+NAME_REGIONS = frozenset(REGIONS.values()) | frozenset(
+    ('World', 'Europe', 'Asia', 'Japan', 'USA'))
+
+def nameRegion(name):
+    """ the first region in the (tags) of a no-intro style name """
+    start = name.find('(')
+    while start != -1:
+        end = name.find(')', start)
+        if end == -1:
+            break
+        for tag in name[start + 1:end].split(','):
+            if tag.strip() in NAME_REGIONS:
+                return tag.strip()
+        start = name.find('(', end)
+    return 'Other'
+
+def _letter(name):
+    """ the letter a name is filed under, # for digits and symbols """
+    for c in name:
+        if c.isalpha():
+            return c.upper()
+        if c.isdigit():
+            return '#'
+    return '#'
+
+def _prefix(name, length):
+    chars = [c for c in name if c.isalnum()][:length]
+    return ''.join(chars).title() or '#'
+
+def _chunks(names, cap):
+    """ (label, names) runs of at most cap, labelled by the start of their
+    first and last names, as long as it takes to tell the runs apart
+    """
+    runs = [names[i:i + cap] for i in range(0, len(names), cap)]
+    for length in range(2, 9):
+        labels = ['%s-%s' % (_prefix(run[0], length),
+                             _prefix(run[-1], length)) for run in runs]
+        if len(set(labels)) == len(labels):
+            break
+    else:
+        labels = ['%s %d' % (label, i + 1) for i, label in enumerate(labels)]
+    return list(zip(labels, runs))
+
+def _letterRuns(groups, cap):
+    """ consecutive letter groups merged into runs of at most cap names,
+    a letter with more than cap names is split on its own
+    """
+    runs = []
+    letters, names = [], []
+    for letter, group in groups:
+        if letters and (len(group) > cap or len(names) + len(group) > cap):
+            label = letters[0] if len(letters) == 1 else '%s-%s' % (
+                letters[0], letters[-1])
+            runs.append((label, names))
+            letters, names = [], []
+        if len(group) > cap:
+            runs.extend(_chunks(group, cap))
+            continue
+        letters.append(letter)
+        names.extend(group)
+    if letters:
+        label = letters[0] if len(letters) == 1 else '%s-%s' % (
+            letters[0], letters[-1])
+        runs.append((label, names))
+    return runs
+
+def _byLetter(names):
+    groups = []
+    for letter, group in itertools.groupby(names, key=_letter):
+        groups.append((letter, list(group)))
+    return groups
+
+def shardFolders(names, cap=SHARD_CAP, by='range'):
+    """ {name: folder} filing names into folders of at most cap entries
+
+    range merges neighbouring letters (A-C, D-F), letter gives every
+    letter its own folder and region files by the (USA) style tags, any
+    folder still over cap is split further
+    """
+    names = sorted(names, key=lambda n: (_letter(n), n.lower()))
+    if by == 'range':
+        runs = _letterRuns(_byLetter(names), cap)
+    elif by == 'letter':
+        runs = []
+        for letter, group in _byLetter(names):
+            runs.extend(_chunks(group, cap) if len(group) > cap
+                        else [(letter, group)])
+    elif by == 'region':
+        regions = {}
+        for name in names:
+            regions.setdefault(nameRegion(name), []).append(name)
+        runs = []
+        for region, group in sorted(regions.items()):
+            if len(group) <= cap:
+                runs.append((region, group))
+            else:
+                runs.extend(
+                    (posixpath.join(region, label), run)
+                    for label, run in _letterRuns(_byLetter(group), cap))
+    else:
+        raise ValueError('Unknown shard mode %r, use one of %s' % (
+            by, ', '.join(SHARD_BY)))
+
+    folders = {}
+    for label, run in runs:
+        # fat32 doesn't like some characters
+        label = label.replace('#', '0-9')
+        for name in run:
+            folders[name] = label
+    return folders
+
+def _stems(names):
+    """ {stem: names} of a folder listing, msu-1 tracks (name-N.pcm) are
+    filed under the name they belong to
+    """
+    stems = {}
+    for name in names:
+        stem, dot, ext = name.rpartition('.')
+        if not dot:
+            stem = name
+        elif '.' + ext.lower() == PCM_EXT:
+            base, _, track = stem.rpartition('-')
+            if base and track.isdigit():
+                stem = base
+        stems.setdefault(stem, []).append(name)
+    return stems
+
+def _listFolder(folder):
+    try:
+        return os.listdir(folder)
+    except OSError:
+        return []
+
+class LayoutPlan(object):
+    """ the moves that file the roms under root into shard folders
+
+    moves are (src, dst) pairs of whole paths on the same card, roms
+    already in the right folder are left where they are
+    """
+
+    def __init__(self, root, cap, by):
+        self.root = root
+        self.cap = cap
+        self.by = by
+        self.moves = []
+        self.folders = {}  # folder -> roms filed there
+        self.conflicts = []  # (src, dst) that would overwrite something
+
+    def movedRoms(self):
+        return [(s, d) for s, d in self.moves if isRom(s)]
+
+def planLayout(root, paths, cap=SHARD_CAP, by='range'):
+    """ LayoutPlan for the roms in paths, the index's paths under root
+
+    only paths are sorted and folders listed, nothing is read or hashed
+    so planning from the index is quick even for huge libraries
+    """
+    plan = LayoutPlan(root, cap, by)
+    roms = [p for p in paths if splitZipPath(p)[1] is None and isRom(p)]
+    if len(roms) <= cap:
+        return plan
+    # roms with the same name in different folders get the same shard
+    # folder, the second one there is a conflict
+    byName = sorted((os.path.basename(path), path) for path in roms)
+    folders = shardFolders([name for name, _ in byName], cap, by)
+
+    stems = {}  # source folder -> {stem: names}
+    sources = {}  # source folder -> normalised
+    contents = {}  # target folder -> names there and planned
+    targets = {}
+    for name, path in byName:
+        source = os.path.dirname(path)
+        if source not in stems:
+            stems[source] = _stems(_listFolder(source))
+            sources[source] = os.path.normpath(source)
+        # msu-1 data, tracks, saves and patches go along with the rom
+        group = stems[source].get(os.path.splitext(name)[0], ())
+        if name not in group:  # the index is out of date
+            continue
+        folder = folders[name]
+        plan.folders[folder] = plan.folders.get(folder, 0) + 1
+        if folder not in targets:
+            targets[folder] = os.path.normpath(
+                os.path.join(root, *folder.split('/')))
+        target = targets[folder]
+        if sources[source] == target:
+            continue
+        if target not in contents:
+            contents[target] = set(_listFolder(target))
+        for other in group:
+            src = os.path.join(source, other)
+            dst = os.path.join(target, other)
+            if other in contents[target]:
+                plan.conflicts.append((src, dst))
+                continue
+            contents[target].add(other)
+            plan.moves.append((src, dst))
+    return plan
+
+def applyLayout(plan, progress=None, index=None):
+    """ renames everything in plan, nothing is copied, returns the moves
+    done. folders left empty are removed and index entries follow
+    """
+    done = []
+    sources = set()
+    for i, (src, dst) in enumerate(plan.moves):
+        folder = os.path.dirname(dst)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        os.rename(src, dst)
+        done.append((src, dst))
+        sources.add(os.path.dirname(src))
+        if index is not None:
+            entry = index.roms.pop(index.key(src), None)
+            if entry is not None:
+                index.roms[index.key(dst)] = entry
+        if progress:
+            progress(i + 1, len(plan.moves))
+
+    root = os.path.normpath(plan.root)
+    for folder in sorted(sources, key=len, reverse=True):
+        folder = os.path.normpath(folder)
+        while folder != root and folder.startswith(root):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+    return done
+
+# --------------------------------------------------------------------------- #
+# - Capacity                                                                - #
+# --------------------------------------------------------------------------- #
+
+# cluster sizes fat32 gets formatted with by default, up to each card size
+FAT32_CLUSTERS = (
+    (8 * 1024 ** 3, 4096),
+    (16 * 1024 ** 3, 8192),
+    (32 * 1024 ** 3, 16384),
+)
+PREFERRED_REGIONS = ('USA', 'Europe', 'World', 'Japan')
+
+def defaultCluster(capacity):
+    for limit, cluster in FAT32_CLUSTERS:
+        if capacity <= limit:
+            return cluster
+    return 32768
+
+def cardSpace(folder):
+    """ (capacity, free, cluster size) of the file system folder is on """
+    st = os.statvfs(folder)
+    return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize, st.f_bsize
+
+def onCard(size, cluster):
+    """ bytes a file takes up on the card, whole clusters every time """
+    return -(-size // cluster) * cluster
+
+def capacityEntries(src, cluster, index=None):
+    """ [(entry, bytes on card)] for the games under src as planSync lists
+    them, sizes come from the index where it has them
+    """
+    roms = index.roms if index is not None else {}
+    entries = []
+    for folder in listFolders(src):
+        for entry in listFolder(folder):
+            if isPatch(entry):
+                continue
+            if isMsu(entry):
+                size = sum(onCard(os.path.getsize(f), cluster)
+                           for f in MsuPack(entry).files())
+            else:
+                known = roms.get(RomIndex.key(entry))
+                size = onCard(known['size'] if known else fileSize(entry),
+                              cluster)
+            entries.append((entry, size))
+    return entries
+
+def regionPriority(entry, favorites=(), regions=PREFERRED_REGIONS):
+    """ favorites first, then roms by how early their region is in regions
+    """
+    priority = len(regions) + 1 if entry in favorites else 0
+    region = nameRegion(romName(entry))
+    if region in regions:
+        priority += len(regions) - regions.index(region)
+    return priority
+
+class CapacityPlan(object):
+    """ the games that fit in capacity, picked by priority
+
+    greedy: the highest priority first and the smallest first within a
+    priority, anything that doesn't fit is skipped for the ones after
+    it. pinned games are always in and excluded ones never, fill() is
+    linear so it can run again on every change the user makes
+    """
+
+    def __init__(self, entries, capacity, priority=regionPriority):
+        self.entries = [e for e, _ in entries]
+        self.sizes = [s for _, s in entries]
+        self.capacity = capacity
+        ranks = [priority(e) for e in self.entries]
+        self.order = sorted(range(len(self.entries)),
+                            key=lambda i: (-ranks[i], self.sizes[i]))
+        self.pinned = set()
+        self.excluded = set()
+        self.chosen = set()
+        self.used = 0
+        self.fill()
+
+    def fill(self):
+        sizes = self.sizes
+        chosen = set(self.pinned)
+        used = sum(sizes[i] for i in chosen)
+        room = self.capacity - used
+        for i in self.order:
+            if sizes[i] <= room and i not in chosen \
+                    and i not in self.excluded:
+                chosen.add(i)
+                room -= sizes[i]
+        self.chosen = chosen
+        self.used = self.capacity - room
+        return chosen
+
+    def choose(self, selected):
+        """ the user's picks, selected games the plan left out are pinned
+        and games in the plan that aren't selected are excluded
+        """
+        selected = set(selected)
+        for i in selected - self.chosen:
+            self.pinned.add(i)
+            self.excluded.discard(i)
+        for i in self.chosen - selected:
+            self.excluded.add(i)
+            self.pinned.discard(i)
+        return self.fill()
+
+    def chosenEntries(self):
+        return [self.entries[i] for i in sorted(self.chosen)]
+
+# --------------------------------------------------------------------------- #
+# - Profiles                                                                - #
+# --------------------------------------------------------------------------- #
+
+PROFILES_DIR = os.path.join(CONFIG_DIR, 'cards')
+
+DIFF_MISSING = 'missing'
+DIFF_EXTRA = 'extra'
+DIFF_DIFFERENT = 'different'
+DIFF_STATES = (DIFF_MISSING, DIFF_DIFFERENT, DIFF_EXTRA)
+
+def profilePath(card):
+    """ index file of a card id from cardId """
+    return os.path.join(PROFILES_DIR, re.sub(r'[^\w.-]', '_', card) + '.json')
+
+def knownCard(folder):
+    return os.path.isfile(profilePath(cardId(folder)))
+
+def cardIndex(folder):
+    """ the RomIndex of the card folder is on, keyed by its volume uuid
+    and rooted at where it is mounted now
+    """
+    return RomIndex(profilePath(cardId(folder)), mountPoint(folder))
+
+def reconcile(index, root):
+    """ brings index up to date with root by stat alone, new and changed
+    roms are kept unhashed (sha1 None) and gone ones forgotten. returns
+    the unhashed paths, RomIndex.update hashes them when there's time
+    """
+    seen = set()
+    stale = []
+    for rom in walkRoms(root):
+        key = index.key(rom)
+        seen.add(key)
+        size, mtime = statRom(key)
+        entry = index.roms.get(key)
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            if not entry['sha1']:
+                stale.append(key)
+            continue
+        index.roms[key] = {'size': size, 'mtime': mtime, 'sha1': None}
+        stale.append(key)
+    for key in index.under([root]):
+        if key not in seen:
+            del index.roms[key]
+    return stale
+
+def _byRelative(index, root):
+    """ {path below root as planSync copies it: (key, entry)} """
+    roms = {}
+    for key in index.under([root]):
+        archive, _ = splitZipPath(key)
+        folder = os.path.relpath(os.path.dirname(archive), root)
+        rel = os.path.normpath(os.path.join(folder, romName(key)))
+        roms[rel] = key, index.roms[key]
+    return roms
+
+def diffCard(library, libraryRoot, card, cardRoot):
+    """ [(state, relative path, library path, card path)] of what the card
+    is missing, has extra or has different, sorted by path
+
+    only the two indexes are compared: a rom counts as on the card if its
+    sha1 is anywhere on it, so renamed and sharded roms aren't missing.
+    unhashed card roms are compared by size.
+    """
+    lib = _byRelative(library, libraryRoot)
+    crd = _byRelative(card, cardRoot)
+    libHashes = set(entry['sha1'] for _, entry in lib.values())
+    cardHashes = set(entry['sha1'] for _, entry in crd.values())
+    libHashes.discard(None)
+    cardHashes.discard(None)
+
+    diff = []
+    for rel in set(lib) & set(crd):
+        (libKey, libEntry), (cardKey, cardEntry) = lib[rel], crd[rel]
+        if cardEntry['sha1']:
+            same = cardEntry['sha1'] == libEntry['sha1']
+        else:
+            same = cardEntry['size'] == libEntry['size']
+        if not same:
+            diff.append((DIFF_DIFFERENT, rel, libKey, cardKey))
+    for rel in set(lib) - set(crd):
+        key, entry = lib[rel]
+        if entry['sha1'] not in cardHashes:
+            diff.append((DIFF_MISSING, rel, key, None))
+    for rel in set(crd) - set(lib):
+        key, entry = crd[rel]
+        if entry['sha1'] not in libHashes:
+            diff.append((DIFF_EXTRA, rel, None, key))
+    diff.sort(key=lambda d: (DIFF_STATES.index(d[0]), d[1]))
+    return diff
+
+# --------------------------------------------------------------------------- #
+# - Prefetch                                                                - #
+# --------------------------------------------------------------------------- #
+
+PREFETCH_CACHE = 16
+
+def folderStamp(folder):
+    """ changes when files are added to, removed from or renamed in folder
+    """
+    return os.stat(folder).st_mtime
+
+class Prefetcher(object):
+    """ loads what the user will likely ask for next on a thread of its own
+    and keeps the last few values in an lru
+
+    want() replaces the wish list, keys wanted before it that haven't been
+    started are dropped and one being loaded isn't cached unless it is
+    still wanted. stamp(key) tells when a cached value is out of date,
+    like folderStamp
+    """
+
+    def __init__(self, load, stamp=None, size=PREFETCH_CACHE):
+        self.load = load
+        self.stamp = stamp or (lambda key: None)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self._cache = collections.OrderedDict()  # key -> (stamp, value)
+        self._wanted = []
+        self._window = set()
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def want(self, keys):
+        with self._lock:
+            self._wanted = list(keys)
+            self._window = set(self._wanted)
+            self._lock.notify()
+            if self._thread is None and self._wanted:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def cancel(self):
+        self.want([])
+
+    def get(self, key):
+        """ the value for key, loaded right here when it isn't cached """
+        stamp = self.stamp(key)
+        with self._lock:
+            cached = self._cache.pop(key, None)
+            if cached is not None and cached[0] == stamp:
+                self._cache[key] = cached
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        value = self.load(key)
+        self._put(key, stamp, value)
+        return value
+
+    def _put(self, key, stamp, value):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = stamp, value
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._wanted:
+                    self._lock.wait()
+                key = self._wanted.pop(0)
+                cached = self._cache.get(key)
+            try:
+                stamp = self.stamp(key)
+                if cached is not None and cached[0] == stamp:
+                    continue
+                value = self.load(key)
+            except Exception:
+                # get() loads it again and the caller gets the error
+                continue
+            with self._lock:
+                if key not in self._window:
+                    # the cursor moved on while it loaded, don't let it
+                    # push wanted values out of the cache
+                    self.dropped += 1
+                    continue
+                self._put(key, stamp, value)
+
+# --------------------------------------------------------------------------- #
+# - Facets                                                                  - #
+# --------------------------------------------------------------------------- #
+
+FACETS = ('region', 'mapping', 'coprocessor', 'size', 'save')
+FACET_UNKNOWN = 'Unknown'
+# file size buckets, roms come in powers of two so few land in between
+SIZE_FACETS = ((512 << 10, '<=512K'), (1 << 20, '<=1M'), (2 << 20, '<=2M'),
+               (4 << 20, '<=4M'))
+
+# the set bits of every byte value
+_BYTE_BITS = [tuple(b for b in range(8) if n >> b & 1) for n in range(256)]
+
+def sizeFacet(size):
+    for limit, label in SIZE_FACETS:
+        if size <= limit:
+            return label
+    return '>' + SIZE_FACETS[-1][1][2:]
+
+def romFacets(record):
+    """ {facet: value} of a rom from its RomIndex.header, None for a rom
+    that couldn't be read
+    """
+    info = record and record['info']
+    if not info:
+        facets = dict((facet, FACET_UNKNOWN) for facet in FACETS)
+    else:
+        facets = {'region': info['region'], 'mapping': info['mapping'],
+                  'coprocessor': info['coprocessor'] or 'None',
+                  'save': 'yes' if info['hasSave'] else 'no'}
+    if record:
+        facets['size'] = sizeFacet(record['size'])
+    return facets
+
+def toBitmap(indices):
+    """ an int with bit i set for every i in indices """
+    if not len(indices):
+        return 0
+    buf = bytearray((max(indices) >> 3) + 1)
+    for i in indices:
+        buf[i >> 3] |= 1 << (i & 7)
+    buf.reverse()
+    return int(binascii.hexlify(bytes(buf)), 16)
+
+def bitIndices(bits):
+    """ array of the set bits of a bitmap, lowest first """
+    found = array.array('I')
+    if not bits:
+        return found
+    digits = '%x' % bits
+    raw = bytearray(binascii.unhexlify('0' * (len(digits) & 1) + digits))
+    raw.reverse()
+    for n, byte in enumerate(raw):
+        if byte:
+            found.extend(n << 3 | b for b in _BYTE_BITS[byte])
+    return found
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+class FacetIndex(object):
+    """ a bitmap per facet value over the items of a list, bit i is item i
+
+    chosen values of one facet are or'ed and facets are and'ed, so
+    region USA, region Europe and save yes is a usa or europe game with a
+    save. counts are popcounts of the intersections, 50k items narrowed by
+    three facets take a few milliseconds
+    """
+
+    def __init__(self, values):
+        """ values is a {facet: value} per item, in item order """
+        self.count = len(values)
+        self.all = (1 << self.count) - 1
+        members = {}
+        for i, facets in enumerate(values):
+            for facet, value in facets.items():
+                members.setdefault((facet, value), []).append(i)
+        self.bitmaps = dict(
+            (key, toBitmap(found)) for key, found in members.items())
+        # facet -> its (facet, value) keys, most items first
+        self._keys = {}
+        for key in sorted(members, key=lambda k: (-len(members[k]), k)):
+            self._keys.setdefault(key[0], []).append(key)
+
+    def keys(self, facet):
+        return self._keys.get(facet, [])
+
+    def match(self, chosen, skip=None):
+        """ bitmap of the items with a chosen value of every facet chosen
+        from, chosen is [(facet, value)]. skip leaves a facet out
+        """
+        byFacet = {}
+        for facet, value in chosen:
+            if facet != skip:
+                byFacet[facet] = byFacet.get(facet, 0) | \
+                    self.bitmaps.get((facet, value), 0)
+        bits = self.all
+        for found in byFacet.values():
+            bits &= found
+        return bits
+
+    def counts(self, chosen, base=None):
+        """ {(facet, value): items} with chosen applied, a facet is counted
+        without its own choices so its other values say what picking them
+        adds. base is a bitmap narrowing everything, like the text filter
+        """
+        base = self.all if base is None else base
+        counts = {}
+        for facet, keys in self._keys.items():
+            bits = self.match(chosen, facet) & base
+            for key in keys:
+                counts[key] = popcount(self.bitmaps[key] & bits)
+        return counts
+
+def indexFacets(paths, index, progress=None):
+    """ FacetIndex over paths, headers come from index and only roms it
+    hasn't seen are read. None paths and unreadable roms are unknown
+    """
+    values = []
+    for i, path in enumerate(paths):
+        if progress:
+            progress(i, len(paths))
+        record = None
+        if path:
+            try:
+                record = index.header(path)
+            except (OSError, IOError, KeyError, ValueError,
+                    zipfile.BadZipfile):
+                pass
+        values.append(romFacets(record))
+    return FacetIndex(values)
@@ -8,17 +8,23 @@ import curses.textpad
 import curses.ascii
 import datetime
 import json
+import posixpath
 import subprocess
 import sys
 import tempfile
 import textwrap
+import time
 import traceback
+import unicodedata
 
+from array import array
 from collections import Mapping
 from collections import OrderedDict
 from fnmatch import fnmatch
 from enum import Enum
 
+import sd2snescore as core
+
 curses.initscr()
 
 COLORS = 0
@@ -26,14 +32,38 @@ LOG_PATH = None
 UTF = True
 BORDER_ARGS = [] if UTF else ['|', '|', '_', '_', ' ', ' ', '|', '|']
 SHADOW = curses.ACS_CKBOARD
-SCROLL_PAD_MAX = 20000  # protects against really long lists in the ui
+TAB_CACHE_MAX = 2  # hidden tabs past this many free their buffers
+# let curses scroll what is on screen with scroll regions and insert/delete
+# line instead of sending every row again, see sd2snesbench.py scroll
+HARDWARE_SCROLL = os.environ.get('SD2SNES_HARDWARE_SCROLL', '1') not in (
+    '', '0')
+# for ssh sessions, no shadows or focus fills and at most this many frames a
+# second, L switches it while running
+LOW_BANDWIDTH = os.environ.get('SD2SNES_LOW_BANDWIDTH', '') not in ('', '0')
+core.TRACER.on = os.environ.get('SD2SNES_TRACE', '') not in ('', '0')
+# keys, mouse and resizes are written here, sd2snesbench.py replay plays
+# them back
+RECORD_PATH = os.environ.get('SD2SNES_RECORD')
+RECORDER = None
+LOW_BANDWIDTH_FPS = 10
 APPS = 'this is a list of apps'.split(' ')
 AREAS = os.listdir('/')
 AW = min(max([len(a) for a in AREAS]), 50)
 FILTER_MODE = 'normal'
 WINDOW_SIZE = (100, 100)
+POLL_MS = 100  # how often the main loop checks on background jobs
+CARD_POLL = 1.0  # seconds between looking for a newly mounted card
+ROW_TAG = 5  # width of the job state shown in front of a game
+# folders either side of the stuff pane cursor listed ahead of Enter
+PREFETCH_NEIGHBORS = 2
+USB2SNES = os.environ.get('SD2SNES_USB2SNES', 'localhost:23074')
+CARD_PATH = os.environ.get('SD2SNES_CARD', '/media/sd2snes')
+SHARD_CAP = int(os.environ.get('SD2SNES_SHARD_CAP', core.SHARD_CAP))
+# GB to plan for instead of the size of the card in CARD_PATH
+CARD_SIZE = float(os.environ.get('SD2SNES_CARD_SIZE', 0)) * 1024 ** 3
+LIBRARY_PATH = os.environ.get('SD2SNES_LIBRARY', os.path.expanduser('~/roms'))
            
-with open('/home/Patrick/repos/sd2snestool/sd2snestool.py', 'r') as f:
+with open(os.path.splitext(os.path.abspath(__file__))[0] + '.py') as f:
     HELP = f.read()
 
 class Quit(Exception):
@@ -55,6 +85,50 @@ class Echo(object):
         with open(cls.PATH, "w") as fo:
             fo.write('\n')
 
+class InputRecorder(object):
+    """ timestamped input as json lines, a header with the terminal first
+
+    mouse events carry what getmouse returned and are put back for the
+    code that reads them, resizes carry the new size
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, stdscr):
+        self.start = time.time()
+        self.file = open(path, 'w')
+        self._write(version=self.VERSION, size=stdscr.getmaxyx(),
+                    term=os.environ.get('TERM'))
+
+    def _write(self, **event):
+        self.file.write(json.dumps(event, sort_keys=True) + '\n')
+        # one line a key, losing the end of a session to a crash is worse
+        self.file.flush()
+
+    def record(self, ch, window=None):
+        event = {'t': round(time.time() - self.start, 4), 'key': ch}
+        if ch == curses.KEY_MOUSE:
+            try:
+                mouse = curses.getmouse()
+            except curses.error:
+                mouse = None
+            if mouse:
+                event['mouse'] = mouse
+                curses.ungetmouse(*mouse)
+        elif ch == curses.KEY_RESIZE and window is not None:
+            event['size'] = window.getmaxyx()
+        self._write(**event)
+
+    def close(self):
+        self.file.close()
+
+def readKey(window):
+    """ getch, and the key goes to the recorder when there is one """
+    ch = window.getch()
+    if RECORDER is not None and ch != -1:
+        RECORDER.record(ch, window)
+    return ch
+
 # --------------------------------------------------------------------------- #
 # - Colors
 # --------------------------------------------------------------------------- #
@@ -216,10 +290,37 @@ class Keys(object):
     TAB_ALL = (curses.KEY_F3, ord('3'))
     TAB_SAVED = (curses.KEY_F4, ord('4'))
     TAB_ENVINFO = (curses.KEY_F5, ord('5'))
+    TAB_JOBS = (curses.KEY_F6, ord('6'))
     TAB_PREV = (ord(','),)
     TAB_NEXT = (ord('.'),)
     DUMP_PAK = (ord('D'),)
     EDIT_PAK = (ord('E'),)
+    DEDUPE = (ord('d'),)
+    HASH = (ord('#'),)
+    RETRY = (ord('r'),)
+    PUSH = (ord('p'),)
+    BOOT = (ord('b'),)
+    APPLY_PATCH = (ord('a'),)
+
+    VIEW_FILE = (ord('V'),)
+    LOW_BANDWIDTH = (ord('L'),)
+    BENCH_CARD = (ord('B'),)
+    SHARD = (ord('S'),)
+    FIT = (ord('F'),)
+    CARD_DIFF = (ord('P'),)
+    CANCEL_JOB = (ord('C'),)
+    TRACE = (ord('T'),)
+    FACETS = (ord('R'),)
+
+    JUMP = (ord(':'),)
+    JUMP_HEADER = (ord('H'),)
+    NEXT_MATCH = (ord('n'),)
+    PREV_MATCH = (ord('N'),)
+
+    SELECT = (ord(' '),)
+    SELECT_RANGE = (ord('v'),)
+    SELECT_ALL = (ord('A'),)
+    SELECT_INVERT = (ord('*'),)
 
 def stripRmItmPrefix(string):
     return string
@@ -271,7 +372,35 @@ class Widget(object):
 
     @staticmethod
     def newwin():
-        return curses.newwin(1, 1, 0, 0)
+        window = curses.newwin(1, 1, 0, 0)
+        # the cursor is hidden, don't spend bytes putting it back
+        window.leaveok(1)
+        return window
+
+    @staticmethod
+    def place(window, h, w, y, x):
+        """ resizes and moves window, skipping the calls that would change
+        nothing
+        """
+        if window.getmaxyx() != (h, w):
+            window.resize(h, w)
+        if window.getbegyx() != (y, x):
+            window.mvwin(y, x)
+
+    # bumped by MainWindow.layout, once for every size the terminal takes
+    generation = 0
+    _laidOut = None
+
+    def laidOut(self, *key):
+        """ True when the windows were placed for this terminal size,
+        parent geometry and key already, draws only work out and place
+        their windows when it is False
+        """
+        key = (Widget.generation, self.parentPos(), self.parentSize()) + key
+        if key == self._laidOut:
+            return True
+        self._laidOut = key
+        return False
 
     def parentSize(self):
         return self.parent.getmaxyx()
@@ -282,17 +411,20 @@ class Widget(object):
     def processKeypress(self, ch):
         pass
 
+    def idle(self):
+        """ called between keypresses, return True if it repainted """
+        return False
+
     def getWindow(self):
         """ the thing a child will look to as parent """
         return self.window
 
     def draw(self):
         """ draw function here """
-        y, x = self.parentPos()
-        h, w = self.parentSize()
-
-        self.window.resize(h, w)
-        self.window.mvwin(y, x)
+        if not self.laidOut():
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            self.place(self.window, h, w, y, x)
         self.window.border(*BORDER_ARGS)
 
         _, ww = self.window.getmaxyx()
@@ -303,6 +435,16 @@ class Widget(object):
         """ noutrefresh-es go here"""
         self.window.noutrefresh()
 
+    def touch(self):
+        """ marks what doRefresh copies as changed, so it gets copied to
+        the screen again without drawing it again
+        """
+        self.window.touchwin()
+
+    def evict(self):
+        """ frees what the next draw can rebuild, called when hidden """
+        pass
+
     def mouseEvent(self, bstate, y, x, callback):
         if self.getWindow().enclose(y, x):
             if bstate in (curses.BUTTON1_CLICKED,
@@ -314,14 +456,18 @@ class BlankWid(Widget):
 
     def draw(self):
         """ draw function here """
+        if self.laidOut():
+            return
         y, x = self.parentPos()
         h, w = self.parentSize()
-        self.window.resize(h, w)
-        self.window.mvwin(y, x)
+        self.place(self.window, h, w, y, x)
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
 
+    def touch(self):
+        pass
+
 class CSizeWid(Widget):
     """centered window widget with target size"""
 
@@ -335,6 +481,8 @@ class CSizeWid(Widget):
 
     def draw(self):
         """ draw function here """
+        if self.laidOut(self.targetHeight, self.targetWidth):
+            return
         py, px = self.parentPos()
         ph, pw = self.parentSize()
 
@@ -344,14 +492,17 @@ class CSizeWid(Widget):
         y = ph // 2 - h // 2
         x = pw // 2 - w // 2
 
-        self.window.resize(h, w)
-        self.window.mvwin(y + py, x + px)
+        self.place(self.window, h, w, y + py, x + px)
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
         if self.show:
             self.window.noutrefresh()
 
+    def touch(self):
+        if self.show:
+            self.window.touchwin()
+
 class TabBar(Widget):
 
     def __init__(self, parent):
@@ -375,13 +526,21 @@ class TabBar(Widget):
         h, w = self.parentSize()
         self.itemBounds = []
 
-        self.window.resize(1, w)
-        self.window.mvwin(y, x)
+        # only the tabs that fit, the window is placed once at their width
+        items = []
+        width = 0
+        for item in self.items:
+            item = str(' ' + item + ' ')
+            if width + len(item) > w - 2:
+                break
+            items.append(item)
+            width += len(item)
+
+        self.place(self.window, 1, max(1, width), y, x)
         Color.BG.fillScreen(self.window)
 
-        wh, ww = self.window.getmaxyx()
         curw = 0
-        for i, item in enumerate(self.items):
+        for i, item in enumerate(items):
 
             if i == self.tabIndex:
                 color = Color.TEXT.pair | curses.A_REVERSE
@@ -390,18 +549,14 @@ class TabBar(Widget):
             if self.focus:
                 color |= curses.A_BOLD
 
-            item = str(' ' + item + ' ')
-            if curw + len(item) > ww - 2:
-                left = ww - curw - 2
-                self.window.addnstr(0, curw, item, left, color)
-                break
-            self.window.addstr(0, curw, item, color)
+            try:
+                self.window.addstr(0, curw, item, color)
+            except curses.error:
+                pass  # the lower right corner, the text still gets drawn
             gcurw = curw + x - 1
             self.itemBounds.append((i, gcurw, gcurw + len(item) + 1))
             curw += len(item)
 
-        self.window.resize(1, max(1, curw))
-
     def doRefresh(self):
         """ noutrefresh-es go here"""
         self.window.noutrefresh()
@@ -440,40 +595,46 @@ class DropShadowWid(Widget):
     def draw(self):
         """ draw function here """
 
-        if not self.focus:
+        # a focus fill changes every cell of the window
+        if not self.focus or LOW_BANDWIDTH:
             Color.WINDOW_OFF.fillScreen(self.fg)
         else:
             attrs = curses.A_BOLD
             Color.WINDOW_FOCUSED.fillScreen(self.fg, attrs=attrs)
 
-        y, x = self.parentPos()
-        h, w = self.parentSize()
-
         self.fg.erase()
         self.bg.erase()
         self.contents.erase()
 
-        gh, gw = self.getStdscreen().getmaxyx()
-        wh = h if self.dropShadowOutside else h - 1
-        ww = w if self.dropShadowOutside else w - 1
-        self.fg.resize(wh, ww)
-        self.bg.resize(min(wh, gh - 1), min(ww, gw - 1))
-        self.contents.resize(max(h - 3, 1), max(w - 3, 1))
-
-        self.fg.mvwin(y, x)
-        self.bg.mvwin(y + 1, x + 1)
-        self.contents.mvwin(y + 1, x + 1)
+        if not self.laidOut(self.dropShadowOutside):
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            gh, gw = self.getStdscreen().getmaxyx()
+            wh = h if self.dropShadowOutside else h - 1
+            ww = w if self.dropShadowOutside else w - 1
+            self.place(self.fg, wh, ww, y, x)
+            self.place(
+                self.bg, min(wh, gh - 1), min(ww, gw - 1), y + 1, x + 1)
+            self.place(
+                self.contents, max(h - 3, 1), max(w - 3, 1), y + 1, x + 1)
 
         self.fg.border(*BORDER_ARGS)
 
         if self.title:
-            self.fg.addnstr(0, 1, self.title, w - 1)
+            _, w = self.fg.getmaxyx()
+            attr = curses.A_REVERSE if self.focus and LOW_BANDWIDTH else 0
+            self.fg.addnstr(0, 1, self.title, w - 1, attr)
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
-        self.bg.noutrefresh()
+        if not LOW_BANDWIDTH:
+            self.bg.noutrefresh()
         self.fg.noutrefresh()
 
+    def touch(self):
+        self.bg.touchwin()
+        self.fg.touchwin()
+
 class FrameWid(Widget):
     """ drop shadow wid with now shadow
     """
@@ -496,46 +657,81 @@ class FrameWid(Widget):
     def draw(self):
         """ draw function here """
 
-        if not self.focus:
+        # a focus fill changes every cell of the window
+        if not self.focus or LOW_BANDWIDTH:
             Color.WINDOW_OFF.fillScreen(self.fg)
         else:
             attrs = curses.A_BOLD
             Color.WINDOW_FOCUSED.fillScreen(self.fg, attrs=attrs)
 
-        y, x = self.parentPos()
-        h, w = self.parentSize()
-
         self.fg.erase()
         self.contents.erase()
 
-        self.fg.resize(h, w)
-        self.contents.resize(max(h - 2, 1), max(w - 2, 1))
-
-        self.fg.mvwin(y, x)
-        self.contents.mvwin(y + 1, x + 1)
+        if not self.laidOut():
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            self.place(self.fg, h, w, y, x)
+            self.place(
+                self.contents, max(h - 2, 1), max(w - 2, 1), y + 1, x + 1)
 
         self.fg.border(*BORDER_ARGS)
 
         if self.title:
-            self.fg.addnstr(0, 1, self.title, w - 1)
+            _, w = self.fg.getmaxyx()
+            attr = curses.A_REVERSE if self.focus and LOW_BANDWIDTH else 0
+            self.fg.addnstr(0, 1, self.title, w - 1, attr)
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
         self.fg.noutrefresh()
 
+    def touch(self):
+        self.fg.touchwin()
+
+class ScrollRows(object):
+    """ the visible items of a ScrollWid, items looked up through an array
+    of indices so filtering never copies the strings
+    """
+
+    def __init__(self, items, index):
+        self.items = items
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, row):
+        return self.items[self.index[row]]
+
 class ScrollWid(Widget):
+    """ a scrolling list of items
+
+    items is a list of strings or a core.PackedItems, only the rows on
+    screen are ever drawn, straight to a window the size of the page
+    """
 
     def __init__(self, parent):
 
         self.parentWidget = parent
         self.parent = parent.getWindow()
-        self.pad = self.newpad()
-        self.padPos = [0, 0, 0, 0, 1, 1]
+        self.window = self.newwin()
+        self.window.idlok(HARDWARE_SCROLL)
+        Color.TEXT.fillScreen(self.window)
+        # rows on the page, the last draw's window height
+        self._pageSize = 1
         self._pageScroll = 0
         self._scrollIndex = 0
         self._previousIndex = 0
         self._items = []
-        self._visibleItems = []
+        # indices into _items, so the selection outlives filtering
+        self._visibleIndex = array('I')
+        self._visibleItems = ScrollRows(self._items, self._visibleIndex)
+        # indices of the items the text filter may show, None for all
+        self.only = None
+        self._selected = set()
+        self._anchor = None
+        # decorate(item) -> the text a row shows, room for ROW_TAG more
+        self.decorate = None
         self.filterText = ''
         self.focus = False
         # if true, instead of scrolling by item, the whole page is scrolled and
@@ -544,6 +740,10 @@ class ScrollWid(Widget):
 
     def _addItemStr(self, y, x, text, maxw=None, onlyfocus=False):
 
+        row = y - self._pageScroll
+        if not 0 <= row < self._pageSize:
+            return
+
         if self.pageMode:
             color = 0
         elif self.focus:
@@ -556,15 +756,31 @@ class ScrollWid(Widget):
 
         if y == self._scrollIndex:
             color = color
+        elif self.isSelected(y):
+            color = Color.HIGHLIGHT.pair | curses.A_BOLD
         else:
             color = 0
 
-        self.pad.addstr(y, x, text, color)
+        if self.decorate:
+            text = self.decorate(text)
+        _, w = self.window.getmaxyx()
+        # the row may have held a longer item before
+        self.window.move(row, 0)
+        self.window.clrtoeol()
+        try:
+            self.window.addnstr(row, x, text, w - x, color)
+        except curses.error:
+            pass  # the lower right corner, the text still gets drawn
 
     def currentItem(self):
         if self._visibleItems:
             return self._visibleItems[self._scrollIndex]
 
+    def currentIndex(self):
+        """ index into the items of the current row, None when empty """
+        if self._visibleIndex:
+            return self._visibleIndex[self._scrollIndex]
+
     def getWindow(self):
         return self.parent
 
@@ -583,49 +799,71 @@ class ScrollWid(Widget):
 
     def setItems(self, itemList=None):
 
-        itemList = self._items if itemList is None else itemList
+        span = core.TRACER.on and core.TRACER.begin('setItems')
+        if itemList is None:
+            itemList = self._items
+        elif itemList is not self._items:
+            self._selected = set()
+            self.only = None
+        self._anchor = None
 
         # TODO: keep scroll on filter
         self._pageScroll = 0
         self._scrollIndex = 0
         self._previousIndex = 0
         self._items = itemList
-        self.padPos[0] = self._pageScroll
 
+        self._visibleIndex = self.filterIndex(itemList)
+        self._visibleItems = ScrollRows(itemList, self._visibleIndex)
+        self._paintPage()
+        if span:
+            core.TRACER.end(span, items=len(itemList))
+
+    def filterIndex(self, itemList):
+        """ array of the indices of the items that pass the filter and
+        are in only
+        """
+        index = self.textIndex(itemList)
+        if self.only is None:
+            return index
+        if len(index) == len(itemList):
+            return array('I', self.only)
+        only = set(self.only)
+        return array('I', (i for i in index if i in only))
+
+    def textIndex(self, itemList):
+        """ array of the indices of the items matching filterText """
+        text = self.filterText.strip()
+        if not text:
+            return array('I', range(len(itemList)))
+        span = core.TRACER.on and core.TRACER.begin(
+            'filter', mode=FILTER_MODE)
         if FILTER_MODE == 'regex':
-            self._visibleItems = itemList = filter(self.regexFilter, itemList)
+            match = self.regexFilter
         elif FILTER_MODE == 'glob':
-            self._visibleItems = itemList = filter(self.globFilter, itemList)
+            match = self.globFilter
+        elif isinstance(itemList, core.PackedItems):
+            match = None
         else:
-            self._visibleItems = itemList = filter(self.textFilter, itemList)
-
-        self.pad.erase()
-
-        # resize the pad
-        if itemList:
-            # writing to the lower right corner creates an error in curses
-            # in order to work around this we will add an empty line
-            pad_y = len(itemList) + 1
-            pad_x = max(max([len(i) for i in itemList]), 1)
-            self.pad.resize(min(pad_y, SCROLL_PAD_MAX), pad_x)
-            py, px = self.pad.getmaxyx()
-            if py < 0:
-                Echo ('PAD NEG', pad_y, pad_x)
+            match = self.textFilter
+        if match is None:
+            index = itemList.find(text)
         else:
-            pad_x = 1
-            self.pad.resize(1, 1)
-
-        # get the resized pad, if the list is too long the pad will not be able
-        # to scale up to the size of the pad, and the GUI will error
-        py, px = self.pad.getmaxyx()
-        for i, thing in enumerate(itemList):
-            if i >= py:  # the pad wasn't big enough, time to bail
-                # Echo ('Warning: too many items, list incomplete.')
-                # Echo ('items=%s padsizey=%s len(itemList)=%s' % (
-                #       i, py, len(itemList)))
-                break
-
-            self._addItemStr(i, 0, thing, pad_x)
+            index = array('I', (i for i, item in enumerate(itemList)
+                                if match(item)))
+        if span:
+            core.TRACER.end(span, found=len(index))
+        return index
+
+    def _paintPage(self):
+        """ writes the rows on screen, the rest of the page is cleared """
+        start = self._pageScroll
+        end = min(start + self._pageSize, len(self._visibleItems))
+        for i in range(start, end):
+            self._addItemStr(i, 0, self._visibleItems[i])
+        if end - start < self._pageSize:
+            self.window.move(max(end - start, 0), 0)
+            self.window.clrtobot()
 
     def getItems(self, visibleOnly=False):
 
@@ -634,34 +872,81 @@ class ScrollWid(Widget):
         else:
             return self._items
 
-    @staticmethod
-    def newpad():
+    def isSelected(self, row):
+        """ row is an index into the visible items """
+        if not self._selected or row >= len(self._visibleIndex):
+            return False
+        return self._visibleIndex[row] in self._selected
 
-        pad = curses.newpad(1, 1)
-        Color.TEXT.fillScreen(pad)
-        return pad
+    def selectedItems(self):
+        """ selected items in list order, hidden ones included """
+        return [self._items[i] for i in sorted(self._selected)]
 
-    def draw(self, onlyfocus=False):
-        """ draw function here """
+    def selection(self):
+        """ indices into the items of the selected ones """
+        return set(self._selected)
 
-        y, x = self.parentPos()
-        h, w = self.parentSize()
+    def setSelection(self, indices):
+        if indices != self._selected:
+            self._selected = set(indices)
+            self._redrawRows()
 
-        pminrow = self._pageScroll
-        pmincol = 0
-        sminrow = y
-        smincol = x
-        smaxrow = h + y - 1
-        smaxcol = w + x - 1
+    def clearSelection(self):
+        self._selected = set()
+        self._anchor = None
+        self._redrawRows()
 
-        if onlyfocus:
-            smaxrow -= 3
+    def toggleSelected(self):
+        if not self._visibleIndex:
+            return
+        self._selected ^= set([self._visibleIndex[self._scrollIndex]])
+        self._anchor = self._scrollIndex
+        self._redrawRows(self._scrollIndex, self._scrollIndex + 1)
 
-        self.padPos = [
-            pminrow, pmincol,  # real position of pad
-            sminrow, smincol,  # draw start
-            smaxrow, smaxcol]  # draw end
+    def selectRange(self):
+        """ selects the visible rows between the last toggle and here """
+        if not self._visibleIndex:
+            return
+        anchor = self._scrollIndex if self._anchor is None else self._anchor
+        start, end = sorted((anchor, self._scrollIndex))
+        self._selected.update(self._visibleIndex[start:end + 1])
+        self._redrawRows(start, end + 1)
+
+    def selectAllVisible(self):
+        self._selected.update(self._visibleIndex)
+        self._redrawRows()
+
+    def invertSelection(self):
+        """ flips the visible rows, hidden selections are left alone """
+        self._selected.symmetric_difference_update(self._visibleIndex)
+        self._redrawRows()
+
+    def repaintPage(self):
+        """ writes the rows on screen again, for when decorate changed """
+        self._redrawRows(self._pageScroll, self._pageScroll + self.pageSize())
+
+    def _redrawRows(self, start=0, end=None):
+        """ writes the visible rows from start to end that are on screen """
+        start = max(start, self._pageScroll)
+        end = self._pageScroll + self._pageSize if end is None else end
+        end = min(end, self._pageScroll + self._pageSize,
+                  len(self._visibleItems))
+        for i in range(start, end):
+            self._addItemStr(i, 0, self._visibleItems[i])
 
+    def draw(self, onlyfocus=False):
+        """ draw function here """
+
+        if not self.laidOut(onlyfocus):
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            if onlyfocus:
+                h = max(h - 3, 1)
+            self.place(self.window, h, w, y, x)
+            self._pageSize = h
+        # the page may have grown past the end of the list
+        self.pageScroll(0)
+        self._paintPage()
         if self._visibleItems:
             self._addItemStr(
                 self._scrollIndex, 0,
@@ -670,37 +955,7 @@ class ScrollWid(Widget):
 
     def pageSize(self):
 
-        (scroll, pmincol,
-         sminrow, smincol,
-         smaxrow, smaxcol) = self.padPos
-        return smaxrow - sminrow + 1
-
-    def pageScrollRemaining(self):
-        """return the number of items that can be on screen
-
-             -----------------
-        0x0-> padx or padx    1    pad of 7x4
-        1   | xxxx    xxxx    2    h = 11
-        2   | xxxx    xxxx    3    padh = 7
-        3   | xxxx    xxxx    4
-        4   | xxxx    xxxx    5
-        etc | xxxx    xxxx    6
-            | xxxx    xxxx    7
-            | xxxx      -4    8
-            | xxxx      -3  <----- margin
-            | xxxx      -2    10
-            | xxxx      -1    11
-             -xxxx-------0----
-              xxxx       1  <----- leftover
-              xxxx       2
-
-        """
-        scroll = self._pageScroll
-        contentH, _ = self.pad.getmaxyx()
-        pageSize = self.pageSize()
-        margin = max(pageSize - contentH, 0)
-        leftover = margin + contentH - pageSize
-        return leftover - scroll
+        return self._pageSize
 
     def scroll(self, amount):
 
@@ -709,7 +964,6 @@ class ScrollWid(Widget):
             return
 
         pageSize = self.pageSize()
-        h, w = self.pad.getmaxyx()
 
         if not self._visibleItems:
             return
@@ -717,7 +971,7 @@ class ScrollWid(Widget):
         self._previousIndex = self._scrollIndex
         self._scrollIndex += amount
         self._scrollIndex = max(self._scrollIndex, 0)
-        self._scrollIndex = min(self._scrollIndex, h - 2)
+        self._scrollIndex = min(self._scrollIndex, len(self._visibleItems) - 1)
 
         pageStart = self._pageScroll
         pageEnd = self._pageScroll + pageSize - 1
@@ -738,21 +992,16 @@ class ScrollWid(Widget):
 
     def pageScroll(self, amount):
 
-        self._pageScroll += amount
-
         # keep the items on the page
-        self._pageScroll = max(self._pageScroll, 0)
-        self._pageScroll += min(0, self.pageScrollRemaining())
-
-        self.padPos[0] = self._pageScroll
-        self.pad.redrawwin()
-
-    def doRefresh(self):
-        """ noutrefresh-es go here"""
-        try:
-            self.pad.noutrefresh(*self.padPos)
-        except curses.error as e:
-            Echo('Invalid Scroll Size', e)
+        last = max(len(self._visibleItems) - self._pageSize, 0)
+        top = min(max(self._pageScroll + amount, 0), last)
+        if top == self._pageScroll:
+            return
+        self._pageScroll = top
+        self._paintPage()
+        if not HARDWARE_SCROLL:
+            # sends every row again, even when the page moved one line
+            self.window.redrawwin()
 
     def index(self):
         return self._scrollIndex
@@ -760,7 +1009,7 @@ class ScrollWid(Widget):
     def processKeypress(self, ch):
 
         y, x = self.getWindow().getmaxyx()
-        contentH, _ = self.pad.getmaxyx()
+        contentH = len(self._visibleItems)
 
         if ch in Keys.PAGE_UP:
             self.scroll(-y)
@@ -787,6 +1036,21 @@ class ScrollWid(Widget):
                 self.filterText = result
                 self.setItems()
 
+        elif self.pageMode:
+            return
+
+        elif ch in Keys.SELECT:
+            self.toggleSelected()
+
+        elif ch in Keys.SELECT_RANGE:
+            self.selectRange()
+
+        elif ch in Keys.SELECT_ALL:
+            self.selectAllVisible()
+
+        elif ch in Keys.SELECT_INVERT:
+            self.invertSelection()
+
             # self.doRefresh()
             # self.draw()
             # self.doRefresh()
@@ -795,13 +1059,198 @@ class ScrollWid(Widget):
         if bstate in (curses.BUTTON1_CLICKED,
                       curses.BUTTON1_DOUBLE_CLICKED):
             py, _ = self.parentPos()
-            targetIndex = y - py + self.padPos[0]
+            targetIndex = y - py + self._pageScroll
             self.scroll(targetIndex - self._scrollIndex)
         elif bstate == Keys.KEY_WHEEL_UP:
             curses.ungetch(Keys.UP[0])
         elif bstate == Keys.KEY_WHEEL_DOWN:
             curses.ungetch(Keys.DOWN[0])
 
+class ViewWid(Widget):
+    """ draws only the rows of source that are on screen
+
+    source is anything with a len that can be indexed by row, a list or
+    something that formats rows on demand like core.HexDump
+
+    f searches the rows on a background thread, n/N go through the matches
+    as they come in and only the matches on screen get highlighted
+    """
+
+    def __init__(self, parent):
+
+        self.parentWidget = parent
+        self.parent = parent.getWindow()
+        self.window = self.newwin()
+        self.source = []
+        self.top = 0
+        self.focus = False
+        # highlight(first, last) -> {row: attr} for the rows on screen,
+        # replaces the search highlighting
+        self.highlight = None
+        self.search = None
+        self.match = None
+
+        self.window.idlok(HARDWARE_SCROLL)
+        Color.TEXT.fillScreen(self.window)
+
+    def getWindow(self):
+        return self.parent
+
+    def setSource(self, source):
+        self.cancelSearch()
+        self.source = source
+        self.top = 0
+
+    def find(self, text):
+        """ starts a search for text, an empty text clears the search """
+        self.cancelSearch()
+        if text:
+            self.search = core.LineSearch(self.source, text)
+
+    def cancelSearch(self):
+        if self.search:
+            self.search.cancel()
+        self.search = None
+        self.match = None
+
+    def status(self):
+        if not self.search:
+            return ''
+        return '[%s matches%s] ' % (
+            len(self.search.matches), '' if self.search.done else '...')
+
+    def showMatch(self, row):
+        """ moves the page to a match unless it is on screen already """
+        if row is None:
+            return
+        self.match = row
+        page = self.pageSize()
+        if not self.top <= row < self.top + page:
+            self.scrollTo(row - page // 2)
+
+    def _searchMarks(self, first, last):
+        marks = {}
+        if self.search:
+            for row in self.search.between(first, last):
+                marks[row] = curses.A_BOLD
+            if self.match is not None:
+                marks[self.match] = curses.A_REVERSE
+        return marks
+
+    @staticmethod
+    def _columns(text):
+        """ screen columns of unicode text, east asian wide ones take two """
+        return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1
+                   for c in text)
+
+    def _markText(self, y, text, needle, attr, w):
+        """ applies attr to the needles in a line that is drawn already
+
+        the line and needle are utf-8, matches are found in characters and
+        turned into screen columns, a byte offset is off by one for every
+        multi-byte character before the match
+        """
+        text = text.decode('utf-8', 'replace')
+        needle = needle.decode('utf-8', 'replace').lower()
+        low = text.lower()
+        found = low.find(needle)
+        while found != -1:
+            x = self._columns(text[:found])
+            if x >= w:
+                break
+            width = self._columns(text[found:found + len(needle)])
+            try:
+                self.window.chgat(y, x, min(width, w - x), attr)
+            except curses.error:
+                pass
+            found = low.find(needle, found + len(needle))
+
+    def pageSize(self):
+        h, _ = self.window.getmaxyx()
+        return h
+
+    def scrollTo(self, row):
+        last = max(len(self.source) - self.pageSize(), 0)
+        self.top = min(max(row, 0), last)
+
+    def scroll(self, amount):
+        self.scrollTo(self.top + amount)
+
+    def draw(self):
+        """ draw function here """
+        if not self.laidOut():
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            self.place(self.window, h, w, y, x)
+        h, w = self.window.getmaxyx()
+        self.window.erase()
+
+        # the page may have grown since the last scroll
+        self.scrollTo(self.top)
+        last = min(self.top + h, len(self.source))
+        needle = None
+        if self.highlight:
+            marks = self.highlight(self.top, last)
+        else:
+            marks = self._searchMarks(self.top, last)
+            if self.search:
+                needle = self.search.text
+                if isinstance(needle, unicode):
+                    needle = needle.encode('utf-8')
+
+        for i, row in enumerate(range(self.top, last)):
+            text = self.source[row]
+            if isinstance(text, unicode):
+                text = text.encode('utf-8', 'replace')
+            attr = marks.get(row, 0)
+            try:
+                self.window.addnstr(i, 0, text, w, 0 if needle else attr)
+            except curses.error:
+                pass  # the lower right corner, the text still gets drawn
+            if needle and attr:
+                self._markText(i, text, needle, attr, w)
+
+    def doRefresh(self):
+        """ noutrefresh-es go here"""
+        self.window.noutrefresh()
+
+    def processKeypress(self, ch):
+        """ returns True for keys it has no use for """
+
+        page = self.pageSize()
+        here = self.top - 1 if self.match is None else self.match
+
+        if ch in Keys.UP:
+            self.scroll(-1)
+        elif ch in Keys.DOWN:
+            self.scroll(1)
+        elif ch in Keys.PAGE_UP:
+            self.scroll(-page)
+        elif ch in Keys.PAGE_DOWN:
+            self.scroll(page)
+        elif ch in Keys.TOP:
+            self.scrollTo(0)
+        elif ch in Keys.BOTTOM:
+            self.scrollTo(len(self.source))
+        elif ch in Keys.FIND:
+            popup = PopupEnterText(self)
+            popup.title = 'Find'
+            self.find(popup.execute().strip())
+        elif ch in Keys.NEXT_MATCH + Keys.PREV_MATCH:
+            # without a search there is nothing to go to, stay open
+            if self.search and ch in Keys.NEXT_MATCH:
+                self.showMatch(self.search.nextMatch(here))
+            elif self.search:
+                self.showMatch(self.search.prevMatch(here))
+        else:
+            return True
+
+    def mouseEvent(self, bstate, y, x, callback):
+        if bstate == Keys.KEY_WHEEL_UP:
+            self.scroll(-3)
+        elif bstate == Keys.KEY_WHEEL_DOWN:
+            self.scroll(3)
+
 class TextBox(Widget):
 
     def __init__(self, parent):
@@ -813,6 +1262,7 @@ class TextBox(Widget):
         self._text = ''
 
         self.window = self.newwin()
+        self.window.leaveok(0)
         self.textpad = curses.textpad.Textbox(self.window)
 
     def getWindow(self):
@@ -821,11 +1271,10 @@ class TextBox(Widget):
 
     def draw(self):
         """ draw function here """
-        y, x = self.parentPos()
-        h, w = self.parentSize()
-
-        self.window.resize(h, w)
-        self.window.mvwin(y, x)
+        if not self.laidOut():
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            self.place(self.window, h, w, y, x)
 
         wh, ww = self.window.getmaxyx()
         message = '< Enter Some Text >'
@@ -846,6 +1295,8 @@ class TextBox(Widget):
 
     def validate(self, key):
 
+        if RECORDER is not None:
+            RECORDER.record(key)
         stopKey = ord(curses.ascii.ctrl('g'))
 
         if key == curses.ascii.ESC:
@@ -883,6 +1334,8 @@ class HLayout(Widget):
 
     def draw(self):
         """ draw function here """
+        if self.laidOut(len(self.windows)):
+            return
         y, x = self.parentPos()
         h, w = self.parentSize()
 
@@ -898,19 +1351,30 @@ class HLayout(Widget):
             winx = x + winw * i
             if i + 1 == winnum:
                 winw += missingCols
-            window.resize(winh, winw)
-            window.mvwin(y, winx)
+            self.place(window, winh, winw, y, winx)
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
 
+    def touch(self):
+        pass
+
 class StackedWidget(Widget):
+    """ shows one of its widgets at a time
+
+    hidden widgets keep what they drew, so going back to one that was
+    drawn at the current size only copies it to the screen again, past
+    TAB_CACHE_MAX the least recently shown ones free their buffers
+    """
 
     def __init__(self, parent):
 
         self.parentWidget = parent
         self.parent = parent.getWindow()
         self._currentIndex = 0
+        self._widgets = []
+        # index -> geometry it was drawn at, least recently shown first
+        self._drawn = OrderedDict()
 
     def index(self):
         return self._currentIndex
@@ -921,12 +1385,34 @@ class StackedWidget(Widget):
     def setWidgets(self, widgets):
         self._widgets = widgets
 
-    def setCurrent(self, index):
+    def setCurrent(self, index, redraw=False):
 
-        if self._widgets and index < len(self._widgets):
-            self._currentIndex = index
+        if not self._widgets or index >= len(self._widgets):
+            return
+        self._currentIndex = index
+        geometry = self.parentPos(), self.parentSize()
+        if redraw or self._drawn.get(index) != geometry:
             self.draw()
-            self.doRefresh()
+        else:
+            self._widgets[index].touch()
+            self._shown(index, geometry)
+        self.doRefresh()
+
+    def _shown(self, index, geometry):
+        """ moves index to the back of the lru and evicts the oldest """
+        self._drawn.pop(index, None)
+        self._drawn[index] = geometry
+        while len(self._drawn) > TAB_CACHE_MAX:
+            oldest = next(iter(self._drawn))
+            del self._drawn[oldest]
+            self._widgets[oldest].evict()
+
+    def invalidate(self, widget=None):
+        """ widget, or all of them, gets drawn the next time it is shown """
+        if widget is None:
+            self._drawn.clear()
+        else:
+            self._drawn.pop(self._widgets.index(widget), None)
 
     def getWindow(self):
         """ the thing a child will look to as parent """
@@ -936,12 +1422,18 @@ class StackedWidget(Widget):
         """ draw function here """
         if self._widgets:
             self._widgets[self._currentIndex].draw()
+            self._shown(
+                self._currentIndex, (self.parentPos(), self.parentSize()))
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
         if self._widgets:
             self._widgets[self._currentIndex].doRefresh()
 
+    def touch(self):
+        if self._widgets:
+            self._widgets[self._currentIndex].touch()
+
     def processKeypress(self, ch):
 
         if self._widgets:
@@ -1019,7 +1511,7 @@ class PopupOkCancel(Widget):
 
         self.scroll.focus = True
         areas = ['Ok', 'Cancel']
-        areas = reversed(areas) if cancelFirst else areas
+        areas = areas[::-1] if cancelFirst else areas
         self.scroll.setItems(areas)
 
     def execute(self):
@@ -1043,7 +1535,9 @@ class PopupOkCancel(Widget):
             # ch = chwindow.getch()
 
             # I'll stick with the hack for now
-            ch = self.getStdscreen().getch()
+            ch = readKey(self.getStdscreen())
+            if ch == -1:  # the main loop polls for jobs
+                continue
             self.scroll.processKeypress(ch)
 
             self.draw()
@@ -1113,7 +1607,8 @@ class PopupTextWin(PopupOkCancel):
         curses.doupdate()
         while True:
             chwindow = curses.newwin(1, 1)
-            ch = chwindow.getch()
+            chwindow.keypad(1)
+            ch = readKey(chwindow)
             if self.processKeypress(ch):
                 break
             self.draw()
@@ -1123,7 +1618,7 @@ class PopupTextWin(PopupOkCancel):
     def processKeypress(self, ch):
 
         y, x = self.scroll.getWindow().getmaxyx()
-        contentH, _ = self.scroll.pad.getmaxyx()
+        contentH = len(self.scroll.getItems(True))
 
         if ch in Keys.UP:
             self.scroll.pageScroll(-1)
@@ -1141,6 +1636,7 @@ class PopupTextWin(PopupOkCancel):
             _id, x, y, z, bstate = curses.getmouse()
             self.scroll.mouseEvent(bstate, y, x, None)
         elif ch == Keys.KEY_RESIZE:
+            Widget.generation += 1
             Color.BG.fillScreen(self.getStdscreen(), ' ')
             self.refreshTop()
         else:
@@ -1161,6 +1657,193 @@ class PopupTextWin(PopupOkCancel):
         self.dsw.doRefresh()
         self.scroll.doRefresh()
 
+class PopupViewWin(PopupTextWin):
+    """ popup around a ViewWid, for text that is too big to go in a pad
+
+    the title gets status() appended, whenever that changes while no keys
+    are pressed the popup repaints, so background work can show progress
+    """
+
+    def __init__(self, parent, source, h=45, w=160):
+
+        self.parentWidget = parent
+        self.parent = parent.getWindow()
+        self.window = curses.newwin(0, 0)
+        self.title = ''
+        self.source = source
+        self._status = None
+
+        # popup
+        self.popup = CSizeWid(self)
+        self.popup.targetHeight = h
+        self.popup.targetWidth = w
+        self.dsw = DropShadowWid(self.popup)
+        self.scroll = ViewWid(self.dsw)
+        self.scroll.setSource(source)
+
+    def status(self):
+        """ shown after the title """
+        return self.scroll.status()
+
+    def close(self):
+        """ called once the popup is done, release the source here """
+        self.scroll.cancelSearch()
+
+    def execute(self):
+
+        self.draw()
+        self.doRefresh()
+        curses.doupdate()
+        chwindow = curses.newwin(1, 1)
+        # without keypad the arrows and pages come in as escape sequences
+        # and their ESC closes the popup
+        chwindow.keypad(1)
+        chwindow.timeout(POLL_MS)
+        try:
+            while True:
+                ch = readKey(chwindow)
+                if ch == -1:
+                    if self.status() == self._status:
+                        continue
+                elif self.processKeypress(ch):
+                    break
+                self.draw()
+                self.doRefresh()
+                curses.doupdate()
+        finally:
+            self.close()
+
+    def _ask(self, title):
+        popup = PopupEnterText(self)
+        popup.title = title
+        return popup.execute().strip()
+
+    def processKeypress(self, ch):
+
+        if ch == Keys.KEY_MOUSE:
+            _id, x, y, z, bstate = curses.getmouse()
+            self.scroll.mouseEvent(bstate, y, x, None)
+        elif ch == Keys.KEY_RESIZE:
+            Widget.generation += 1
+            Color.BG.fillScreen(self.getStdscreen(), ' ')
+            self.refreshTop()
+        else:
+            return self.scroll.processKeypress(ch)
+
+    def draw(self):
+        """ draw function here """
+
+        self._status = self.status()
+        self.dsw.title = self.title + self._status
+        self.dsw.focus = True
+        self.popup.draw()
+        self.dsw.draw()
+        self.scroll.draw()
+
+class PopupHexWin(PopupViewWin):
+    """ hex dump of a file, the file is mmapped and only the rows on
+    screen are ever formatted
+
+    : jumps to an offset, H to the snes header, f searches for bytes
+    (a9 00 8d or "text") in the background and n/N go through the matches
+    """
+
+    def __init__(self, parent, path, h=45, w=80):
+
+        PopupViewWin.__init__(self, parent, core.HexDump(path), h, w)
+        self.path = path
+        self.dump = self.source
+        self.search = None
+        self.match = None
+        self.scroll.highlight = self._highlight
+
+    def status(self):
+        if not self.search:
+            return ''
+        return '[%s matches%s] ' % (
+            len(self.search.matches), '' if self.search.done else '...')
+
+    def close(self):
+        if self.search:
+            self.search.cancel()
+        self.dump.close()
+
+    def _highlight(self, first, last):
+        """ attrs for the rows on screen that hold a match """
+        if not self.search:
+            return {}
+        width = self.dump.WIDTH
+        rows = {}
+        for offset in self.search.between(first * width, last * width):
+            rows[offset // width] = curses.A_BOLD
+        if self.match is not None:
+            rows[self.match // width] = curses.A_REVERSE
+        return rows
+
+    def _showMatch(self, offset):
+        if offset is None:
+            return
+        self.match = offset
+        row = self.dump.rowOf(offset)
+        top, page = self.scroll.top, self.scroll.pageSize()
+        if not top <= row < top + page:
+            self.scroll.scrollTo(row - page // 2)
+
+    def processKeypress(self, ch):
+
+        here = self.scroll.top * self.dump.WIDTH - 1
+        if self.match is not None:
+            here = self.match
+
+        if ch in Keys.JUMP:
+            try:
+                offset = int(self._ask('Offset (hex)'), 16)
+            except ValueError:
+                return
+            self.scroll.scrollTo(self.dump.rowOf(offset))
+        elif ch in Keys.JUMP_HEADER:
+            info = core.readHeader(self.path)
+            if info:
+                self.scroll.scrollTo(self.dump.rowOf(info.offset))
+        elif ch in Keys.FIND:
+            text = self._ask('Find bytes')
+            if self.search:
+                self.search.cancel()
+            self.search = None
+            self.match = None
+            if text:
+                pattern = core.parsePattern(text)
+                self.search = core.Search(self.dump.data, pattern)
+        elif ch in Keys.NEXT_MATCH + Keys.PREV_MATCH:
+            if self.search and ch in Keys.NEXT_MATCH:
+                self._showMatch(self.search.nextMatch(here))
+            elif self.search:
+                self._showMatch(self.search.prevMatch(here))
+        else:
+            return PopupViewWin.processKeypress(self, ch)
+
+class PopupFileWin(PopupViewWin):
+    """ text file viewer for logs and dat files of any size
+
+    the file is mmapped and its lines are indexed in the background, the
+    first page shows up before the index is done
+    """
+
+    def __init__(self, parent, path, h=45, w=160):
+
+        PopupViewWin.__init__(self, parent, core.LineIndex(path), h, w)
+        self.path = path
+
+    def status(self):
+        status = PopupViewWin.status(self)
+        if self.source.done:
+            return status
+        return '[indexing %s lines] %s' % (len(self.source), status)
+
+    def close(self):
+        PopupViewWin.close(self)
+        self.source.close()
+
 # --------------------------------------------------------------------------- #
 # - Windows                                                                 - #
 # --------------------------------------------------------------------------- #
@@ -1173,7 +1856,25 @@ class GameWidget(Widget):
         self.parent = parent.getWindow()
         self.title = 'Paks'
         self.appVersionMode = False
-
+        # the games pane lists a folder unless one of these is shown
+        self.dupeGroups = None
+        self.shardPlan = None
+        self.capacityPlan = None
+        self.cardDiff = None
+        # the stuff pane lists facets of the games while this is set
+        self.facets = None
+        self._facetRows = []
+        self._paks = []
+        self.folder = None
+        # label -> path for items whose label isn't just the file name
+        self._paths = {}
+
+        self.scheduler = None
+        self._jobFuncs = {}
+        # path -> the last job run on it, shown on its row
+        self._rowJobs = {}
+        self.listings = core.Prefetcher(self.listFolder, core.folderStamp)
+        self._prefetched = None
         self._widgets = []
         self._focusGroups = []
         self._focusIndex = 0
@@ -1185,6 +1886,7 @@ class GameWidget(Widget):
 
         lShadow.title = 'Stuff'
         rShadow.title = 'Games'
+        self.gamesFrame = rShadow
 
         hlay = HLayout(topGrp)
         hlay.addChild(lShadow)
@@ -1192,6 +1894,7 @@ class GameWidget(Widget):
 
         self.scroll1 = s1 = ScrollWid(lShadow)
         self.scroll2 = s2 = ScrollWid(rShadow)
+        s2.decorate = self.rowState
 
         self.addWidget(topGrp)
         self.addWidget(hlay)
@@ -1221,12 +1924,595 @@ class GameWidget(Widget):
         # else:
             # index = 0
 
+        self._paks = items
+        if self.facets is not None:
+            return
         self.scroll1.setItems(items)
         # self.scroll1.scroll(index)
+        self.prefetchNear()
+
+    def prefetchNear(self):
+        """ lists the folders around the stuff pane cursor in the
+        background, so Enter usually finds the list ready
+        """
+        items = self.scroll1.getItems(True)
+        row = self.scroll1.index()
+        if self.appVersionMode or self.facets is not None or not items:
+            return
+        if (row, len(items)) == self._prefetched:
+            return
+        self._prefetched = row, len(items)
+        rows = [row]
+        for n in range(1, PREFETCH_NEIGHBORS + 1):
+            rows.extend(r for r in (row + n, row - n) if 0 <= r < len(items))
+        self.listings.want(
+            [os.path.join(LIBRARY_PATH, items[r]) for r in rows])
 
     def addWidget(self, widget):
         self._widgets.append(widget)
 
+    def openFolder(self, folder):
+        """ lists the roms in folder in the games pane, zips are listed
+        from their central directory and never extracted
+        """
+        self.folder = folder
+        self.clearViews()
+        self._rowJobs = dict(
+            (p, j) for p, j in self._rowJobs.items() if not j.finished)
+        try:
+            entries, items, paths = self.listings.get(folder)
+        except OSError as e:
+            Echo('Could not list', folder, e)
+            entries, items, paths = [], core.PackedItems([]), {}
+        self._paths = dict(paths)
+
+        self.gamesFrame.title = 'Games'
+        self.scroll2.filterText = ''
+        self.scroll2.setItems(items)
+        return entries
+
+    @classmethod
+    def listFolder(cls, folder):
+        """ (entries, packed items, {label: path}) for the games pane,
+        runs on the prefetch thread so it must not touch curses
+        """
+        entries = core.listFolder(folder)
+        items = []
+        paths = {}
+        names = None
+        for entry in entries:
+            item = os.path.relpath(entry, folder)
+            if core.isMsu(entry):
+                names = os.listdir(folder) if names is None else names
+                item = cls.msuLabel(core.MsuPack(entry, names))
+                paths[item] = entry
+            items.append(item)
+        return entries, core.PackedItems(items), paths
+
+    def clearViews(self):
+        self.dupeGroups = None
+        self.shardPlan = None
+        self.capacityPlan = None
+        self.cardDiff = None
+        if self.facets is not None:
+            self.closeFacets()
+
+    def listingFolder(self):
+        """ True unless duplicates, a plan or a diff are shown """
+        return (self.dupeGroups is None and self.shardPlan is None and
+                self.capacityPlan is None and self.cardDiff is None)
+
+    @staticmethod
+    def msuLabel(pack):
+        """ the one line an msu-1 pack gets in the games pane """
+        label = '%s [MSU-1 %s tracks, %s]' % (
+            pack.name, len(pack.tracks), core.formatSize(pack.size))
+        problems = pack.problems()
+        if problems:
+            label += ' ' + ', '.join(problems)
+        return label
+
+    def gamePath(self, item):
+        """ full path of a games pane item, None for group headers """
+        if not item or item.startswith('#') or self.folder is None:
+            return None
+        if self.shardPlan is not None or self.cardDiff is not None:
+            return None
+        if item in self._paths:
+            return self._paths[item]
+        return os.path.join(self.folder, item.strip())
+
+    def currentGamePath(self):
+        return self.gamePath(self.scroll2.currentItem())
+
+    def selectedGamePaths(self):
+        """ selected games, or the current one when nothing is selected """
+        items = self.scroll2.selectedItems() or [self.scroll2.currentItem()]
+        return [p for p in map(self.gamePath, items) if p]
+
+    def setJobFunc(self, verb, func, resource='cpu', priority=0,
+                   confirm=False, onDone=None, blocking=True):
+        """ func(job, path) is run by the scheduler for every game the verb
+        is used on, onDone(batch) runs on the ui thread once all are done
+
+        blocking funcs, anything that reads or writes whole roms or talks
+        to usb, run on the scheduler's threads. the rest run right away on
+        the ui thread, which waits for them, but report the same way
+        """
+        self._jobFuncs[verb] = (
+            func, resource, priority, confirm, onDone, blocking)
+
+    def runBatch(self, verb, paths=None):
+        """ submits a job per selected game to the scheduler as one batch
+
+        batches of more than one game are confirmed once up front
+        """
+        paths = self.selectedGamePaths() if paths is None else paths
+        if not paths or verb not in self._jobFuncs or not self.scheduler:
+            return
+        func, resource, priority, confirm, onDone, blocking = (
+            self._jobFuncs[verb])
+
+        if confirm or len(paths) > 1:
+            title = '%s %s games?' % (verb, len(paths))
+            popup = PopupOkCancel(self.parentWidget, title, True)
+            result = popup.execute()
+            self.refreshTop()
+            if result != 'Ok':
+                return
+
+        self.scroll2.clearSelection()
+        jobs = [core.Job('%s %s' % (verb, core.romName(p)), func, (p,),
+                         resource, priority) for p in paths]
+        self._rowJobs.update(zip(paths, jobs))
+        if blocking:
+            return self.scheduler.submitBatch(verb, jobs, onDone)
+        batch = core.Batch(verb, jobs, onDone)
+        for job in jobs:
+            self.scheduler.runNow(job)
+        return batch
+
+    JOB_TAGS = {
+        core.Job.QUEUED: 'wait',
+        core.Job.DONE: 'done',
+        core.Job.FAILED: 'FAIL',
+        core.Job.CANCELLED: 'stop',
+    }
+
+    def rowState(self, item):
+        """ item with the state of the last job run on it in front """
+        job = self._rowJobs.get(self.gamePath(item)) if self._rowJobs else None
+        if job is None:
+            return item
+        if job.state == job.RUNNING:
+            done, total = job.progress or (0, 0)
+            tag = '%3d%%' % (100 * done // total) if total else ' ...'
+        else:
+            tag = self.JOB_TAGS[job.state]
+        return '%-*s%s' % (ROW_TAG, tag, item)
+
+    def updateRows(self):
+        """ repaints the rows with jobs after the scheduler changed """
+        if self._rowJobs:
+            self.scroll2.repaintPage()
+            self.scroll2.doRefresh()
+
+    def cancelRows(self):
+        """ stops the jobs of the selected games """
+        for path in self.selectedGamePaths():
+            job = self._rowJobs.get(path)
+            if job is not None and not job.finished:
+                job.cancel()
+
+    @staticmethod
+    def _dupeJob(job, root):
+        stats = core.DupeStats()
+        groups = core.findDuplicates(core.walkRoms(root), stats, job.update)
+        return groups, stats
+
+    def showDuplicates(self, root=None):
+        """ finds duplicate roms on the card in a job and lists them in
+        the games pane, the first rom in a group is the one that is kept
+        """
+        root = root or CARD_PATH
+        if not self.scheduler:
+            return
+
+        title = self.gamesFrame.title
+        busy = 'Finding duplicates on %s' % root
+
+        def found(job):
+            if job.state == job.DONE:
+                self.listDuplicates(root, *job.result)
+            elif self.gamesFrame.title == busy:
+                # failed or cancelled, the pane still lists what it did
+                self.gamesFrame.title = title
+                self.draw()
+                self.doRefresh()
+
+        self.gamesFrame.title = busy
+        self.draw()
+        self.doRefresh()
+        return self.scheduler.submit(core.Job(
+            'Find duplicates', self._dupeJob, (root,), 'card', 1,
+            onDone=found))
+
+    def listDuplicates(self, root, groups, stats):
+        self.folder = root
+        self.clearViews()
+        self.dupeGroups = groups
+
+        items = []
+        for group in self.dupeGroups:
+            size = core.formatSize(core.romSize(group[0]))
+            items.append('# %sx %s' % (len(group), size))
+            items.extend('  ' + os.path.relpath(p, root) for p in group)
+
+        self.gamesFrame.title = 'Duplicates (hashed %s of %s)' % (
+            core.formatSize(stats.bytesRead),
+            core.formatSize(stats.bytesTotal))
+        self.scroll2.filterText = ''
+        self.scroll2.setItems(core.PackedItems(items))
+        self.draw()
+        self.doRefresh()
+
+    @staticmethod
+    def _deleteExtrasJob(job, groups):
+        return '%s copies removed' % len(core.deleteExtras(groups))
+
+    def deleteDuplicates(self):
+
+        extras = sum(len(g) - 1 for g in self.dupeGroups)
+        if not extras or not self.scheduler:
+            return
+        popup = PopupOkCancel(
+            self.parentWidget, 'Delete %s extra copies?' % extras, True)
+        result = popup.execute()
+        self.refreshTop()
+        if result != 'Ok':
+            return
+
+        root = self.folder
+
+        def deleted(job):
+            if self.dupeGroups is not None:
+                self.showDuplicates(root)
+
+        return self.scheduler.submit(core.Job(
+            'Delete duplicates', self._deleteExtrasJob, (self.dupeGroups,),
+            'card', 1, onDone=deleted))
+
+    @staticmethod
+    def _shardJob(job, root, by):
+        # the index knows what is on the card without walking it
+        paths = core.RomIndex().under([root]) or list(core.walkRoms(root))
+        return core.planLayout(root, paths, SHARD_CAP, by)
+
+    def showShardPlan(self, root=None, by=None):
+        """ plans in a job how the roms on the card would be split into
+        folders of at most SHARD_CAP, every other press tries the next way
+        of splitting them. only roms that change folder are listed
+        """
+        root = root or CARD_PATH
+        if not self.scheduler:
+            return
+        if by is None:
+            by = core.SHARD_BY[0]
+            if self.shardPlan is not None:
+                modes = core.SHARD_BY
+                by = modes[(modes.index(self.shardPlan.by) + 1) % len(modes)]
+
+        title = self.gamesFrame.title
+        busy = 'Planning split by %s of %s' % (by, root)
+
+        def planned(job):
+            if job.state == job.DONE:
+                self.listShardPlan(job.result)
+            elif self.gamesFrame.title == busy:
+                self.gamesFrame.title = title
+                self.draw()
+                self.doRefresh()
+
+        self.gamesFrame.title = busy
+        self.draw()
+        self.doRefresh()
+        return self.scheduler.submit(core.Job(
+            'Plan split', self._shardJob, (root, by), 'card', 1,
+            onDone=planned))
+
+    def listShardPlan(self, plan):
+        root, by = plan.root, plan.by
+        moved = {}
+        for src, dst in plan.moves:
+            folder = os.path.relpath(os.path.dirname(dst), root)
+            moved.setdefault(folder, []).append(
+                '  %s -> %s' % (os.path.relpath(src, root),
+                                os.path.relpath(dst, root)))
+        items = []
+        for folder in sorted(plan.folders):
+            lines = moved.get(folder.replace('/', os.sep), [])
+            items.append('# %s (%s roms, %s moves)' % (
+                folder, plan.folders[folder], len(lines)))
+            items.extend(lines)
+        items.extend('! %s exists' % os.path.relpath(dst, root)
+                     for src, dst in plan.conflicts)
+
+        self.folder = root
+        self.clearViews()
+        self.shardPlan = plan
+        if plan.moves:
+            self.gamesFrame.title = (
+                'Split by %s: %s moves, Enter applies, S next' % (
+                    by, len(plan.moves)))
+        else:
+            self.gamesFrame.title = 'Split by %s: nothing to move' % by
+        self.scroll2.filterText = ''
+        self.scroll2.setItems(core.PackedItems(items))
+        self.draw()
+        self.doRefresh()
+        if self._focusIndex == 0:
+            self.focusOffset(1)
+
+    @staticmethod
+    def _layoutJob(job, plan):
+        index = core.RomIndex()
+        try:
+            done = core.applyLayout(plan, job.update, index)
+        finally:
+            index.save()
+        return '%s files moved into %s folders' % (
+            len(done), len(plan.folders))
+
+    def applyShardPlan(self):
+        """ moves the roms into the previewed folders, on the card the
+        files are only renamed so nothing is copied again
+        """
+        plan = self.shardPlan
+        if not plan or not plan.moves or not self.scheduler:
+            return
+        popup = PopupOkCancel(
+            self.parentWidget, 'Move %s files?' % len(plan.moves), True)
+        result = popup.execute()
+        self.refreshTop()
+        if result != 'Ok':
+            return
+
+        def moved(job):
+            if self.shardPlan is plan:
+                self.showShardPlan(plan.root, plan.by)
+
+        job = core.Job('Split %s' % plan.root, self._layoutJob, (plan,),
+                       'card', 1, onDone=moved)
+        return self.scheduler.submit(job)
+
+    @staticmethod
+    def _capacityJob(job, capacity, cluster):
+        entries = core.capacityEntries(
+            LIBRARY_PATH, cluster, core.RomIndex())
+        return core.CapacityPlan(entries, capacity)
+
+    def showCapacityPlan(self):
+        """ plans in a job which games of the library fit on the card and
+        lists the library with them selected
+
+        selecting or unselecting games pins them in or out and the rest of
+        the card is filled again, Enter copies the plan to the card
+        """
+        if not self.scheduler:
+            return
+        capacity, cluster = CARD_SIZE, 0
+        if os.path.isdir(CARD_PATH):
+            size, _, cluster = core.cardSpace(CARD_PATH)
+            capacity = capacity or size
+        if not capacity:
+            self.gamesFrame.title = 'Fit: no card, set SD2SNES_CARD_SIZE'
+            self.draw()
+            self.doRefresh()
+            return
+        cluster = cluster or core.defaultCluster(capacity)
+
+        title = self.gamesFrame.title
+        busy = 'Fit: sizing %s' % LIBRARY_PATH
+
+        def planned(job):
+            if job.state == job.DONE:
+                self.listCapacityPlan(job.result)
+            elif self.gamesFrame.title == busy:
+                self.gamesFrame.title = title
+                self.draw()
+                self.doRefresh()
+
+        self.gamesFrame.title = busy
+        self.draw()
+        self.doRefresh()
+        return self.scheduler.submit(core.Job(
+            'Plan fit', self._capacityJob, (capacity, cluster), 'cpu', 1,
+            onDone=planned))
+
+    def listCapacityPlan(self, plan):
+        self._paths = {}
+        items = []
+        for entry in plan.entries:
+            item = os.path.relpath(entry, LIBRARY_PATH)
+            if core.isMsu(entry):
+                item = self.msuLabel(core.MsuPack(entry))
+                self._paths[item] = entry
+            items.append(item)
+
+        self.folder = LIBRARY_PATH
+        self.clearViews()
+        self.capacityPlan = plan
+        self.scroll2.filterText = ''
+        self.scroll2.setItems(core.PackedItems(items))
+        self.scroll2.setSelection(plan.chosen)
+        self.updateCapacityPlan()
+        if self._focusIndex == 0:
+            self.focusOffset(1)
+
+    def updateCapacityPlan(self):
+        """ fills the card again around what the user picked """
+        plan = self.capacityPlan
+        plan.choose(self.scroll2.selection())
+        self.scroll2.setSelection(plan.chosen)
+        self.gamesFrame.title = 'Fit: %s games, %s of %s, Enter copies' % (
+            len(plan.chosen), core.formatSize(plan.used),
+            core.formatSize(plan.capacity))
+        self.draw()
+        self.doRefresh()
+
+    @staticmethod
+    def _syncJob(job, src, dst, entries):
+        job.phase('plan')
+        plan = [(entry, target) for entry, target, state
+                in core.planSync(src, dst, entries)
+                if state != core.SYNC_SAME]
+        job.phase('copy')
+        for i, (entry, target) in enumerate(plan):
+            job.update(i, len(plan))
+            core.syncEntry(entry, target)
+        return '%s of %s games copied' % (len(plan), len(entries))
+
+    def syncCapacityPlan(self):
+        """ copies the planned games the card is missing in one job """
+        entries = self.capacityPlan.chosenEntries()
+        if not entries or not self.scheduler:
+            return
+        job = core.Job('Fit %s games' % len(entries), self._syncJob,
+                       (LIBRARY_PATH, CARD_PATH, entries), 'card', 1)
+        return self.scheduler.submit(job)
+
+    @staticmethod
+    def _diffJob(job, hashStale):
+        """ the card's profile brought up to date by stat, then diffed
+        against the library index. with hashStale the roms it had to guess
+        about are hashed and the profile saved
+        """
+        job.phase('stat')
+        card = core.cardIndex(CARD_PATH)
+        stale = core.reconcile(card, CARD_PATH)
+        job.phase('diff')
+        library = core.RomIndex()
+        diff = core.diffCard(library, LIBRARY_PATH, card, CARD_PATH)
+        if hashStale:
+            job.phase('hash')
+            for i, key in enumerate(stale):
+                job.update(i, len(stale))
+                card.update(key)
+            diff = core.diffCard(library, LIBRARY_PATH, card, CARD_PATH)
+        job.phase('save')
+        card.save()
+        return diff
+
+    def showCardDiff(self):
+        """ what the card is missing, has extra and has different from
+        the library, from the indexes only
+
+        the first diff comes from a stat of the card, a second job hashes
+        what changed since the card was last seen and diffs again
+        """
+        if not self.scheduler or not os.path.isdir(CARD_PATH):
+            return
+
+        def diffed(job):
+            if job.state != job.DONE:
+                return
+            hashed, = job.args
+            if not hashed or self.cardDiff is not None:
+                self.listCardDiff(job.result)
+            if not hashed:
+                self.scheduler.submit(core.Job(
+                    'Hash card', self._diffJob, (True,), 'card',
+                    onDone=diffed))
+
+        return self.scheduler.submit(core.Job(
+            'Diff card', self._diffJob, (False,), 'card', 1, onDone=diffed))
+
+    def listCardDiff(self, diff):
+        self.clearViews()
+        self.folder = CARD_PATH
+        self.cardDiff = {}
+        counts = dict((state, 0) for state in core.DIFF_STATES)
+        items = []
+        for state, rel, libPath, cardPath in diff:
+            if not counts[state]:
+                items.append('# %s' % state)
+            counts[state] += 1
+            item = '  %s' % rel
+            self.cardDiff[item] = state, libPath, cardPath
+            items.append(item)
+
+        self.gamesFrame.title = (
+            'Card: %(missing)s missing, %(different)s different, '
+            '%(extra)s extra, Enter copies, x deletes' % counts)
+        self.scroll2.filterText = ''
+        self.scroll2.setItems(core.PackedItems(items))
+        self.draw()
+        self.doRefresh()
+
+    def diffPaths(self, states, side):
+        """ library (side 1) or card (side 2) paths of the selected diff
+        items in states
+        """
+        items = self.scroll2.selectedItems() or [self.scroll2.currentItem()]
+        paths = []
+        for item in items:
+            found = self.cardDiff.get(item)
+            if found and found[0] in states and found[side]:
+                paths.append(found[side])
+        return paths
+
+    @staticmethod
+    def _patchJob(job, base, patches, overwrite):
+        outputs = core.writePatched(
+            base, patches, job.update, overwrite=overwrite)
+        return ', '.join(os.path.basename(o) for o in outputs)
+
+    def applyPatches(self):
+        """ applies the selected ips/bps patches to a base rom in one job
+
+        the base is the rom selected with the patches, or the rom whose
+        name the first patch starts with
+        """
+        paths = self.selectedGamePaths()
+        patches = [p for p in paths if core.isPatch(p)]
+        roms = [p for p in paths if not core.isPatch(p)]
+        if not patches or not self.scheduler:
+            return
+        base = roms[0] if len(roms) == 1 else core.findPatchBase(patches[0])
+        if not base:
+            self.gamesFrame.title = 'Games (select the base rom too)'
+            self.draw()
+            self.doRefresh()
+            return
+
+        targets = [core.patchedPath(base, p) for p in patches]
+        if os.path.abspath(core.splitZipPath(base)[0]) in targets:
+            self.gamesFrame.title = 'Games (a patch would replace the base)'
+            self.draw()
+            self.doRefresh()
+            return
+        existing = [t for t in targets if os.path.exists(t)]
+        if existing:
+            popup = PopupOkCancel(
+                self.parentWidget,
+                'Overwrite %s patched roms?' % len(existing), True)
+            result = popup.execute()
+            self.refreshTop()
+            if result != 'Ok':
+                return
+
+        def patched(job):
+            if self.folder and self.listingFolder():
+                self.openFolder(self.folder)
+                self.draw()
+                self.doRefresh()
+
+        self.scroll2.clearSelection()
+        job = core.Job('Patch %s' % core.romName(base), self._patchJob,
+                       (base, patches, bool(existing)), 'cpu',
+                       onDone=patched)
+        return self.scheduler.submit(job)
+
     def draw(self):
 
         for i, group in enumerate(self._focusGroups):
@@ -1239,6 +2525,85 @@ class GameWidget(Widget):
         for widget in self._widgets:
             widget.draw()
 
+    @staticmethod
+    def _facetJob(job, paths):
+        index = core.RomIndex()
+        try:
+            return core.indexFacets(paths, index, job.update)
+        finally:
+            index.save()
+
+    def showFacets(self):
+        """ lists region, mapping, coprocessor, size and save facets of
+        the games in the stuff pane, headers the index hasn't seen are read
+        in a job first. selecting facets narrows the games pane
+        """
+        if not self.listingFolder() or not self.scheduler:
+            return
+        items = self.scroll2.getItems()
+        paths = [self.gamePath(item) for item in items]
+
+        def indexed(job):
+            if job.state != job.DONE or not self.listingFolder() or \
+                    self.scroll2.getItems() is not items:
+                return
+            self.facets = job.result
+            self.scroll1.filterText = ''
+            self.scroll1.setItems([])
+            self.updateFacets()
+            if self._focusIndex == 1:
+                self.focusOffset(-1)
+
+        return self.scheduler.submit(core.Job(
+            'Facets %s' % self.folder, self._facetJob, (paths,), 'cpu', 1,
+            onDone=indexed))
+
+    def updateFacets(self):
+        """ narrows the games pane to the selected facets and counts
+        again what picking any other one would leave
+        """
+        facets = self.facets
+        chosen = [self._facetRows[i] for i in sorted(self.scroll1.selection())
+                  if self._facetRows[i]]
+        text = self.scroll2.textIndex(self.scroll2.getItems())
+        base = core.toBitmap(text) if len(text) < facets.count else None
+        counts = facets.counts(chosen, base)
+
+        items = []
+        self._facetRows = []
+        for facet in core.FACETS:
+            keys = facets.keys(facet)
+            if keys:
+                items.append('# %s' % facet)
+                self._facetRows.append(None)
+            for key in keys:
+                items.append('  %s (%s)' % (key[1], counts[key]))
+                self._facetRows.append(key)
+        row, selected = self.scroll1.index(), self.scroll1.selection()
+        self.scroll1.setItems(items)
+        self.scroll1.setSelection(selected)
+        self.scroll1.scroll(row)
+
+        self.scroll2.only = None
+        if chosen:
+            self.scroll2.only = core.bitIndices(facets.match(chosen))
+        self.scroll2.setItems()
+        self.gamesFrame.title = 'Games: %s of %s, R closes facets' % (
+            len(self.scroll2.getItems(True)), facets.count)
+        self.draw()
+        self.doRefresh()
+
+    def closeFacets(self):
+        """ the paks back in the stuff pane and all games shown """
+        self.facets = None
+        self._facetRows = []
+        self._prefetched = None
+        self.scroll1.setItems(self._paks)
+        self.prefetchNear()
+        self.scroll2.only = None
+        self.scroll2.setItems()
+        self.gamesFrame.title = 'Games'
+
     def focusOffset(self, offset):
 
         items = len(self._focusGroups)
@@ -1258,6 +2623,11 @@ class GameWidget(Widget):
         for widget in self._widgets:
             widget.doRefresh()
 
+    def touch(self):
+
+        for widget in self._widgets:
+            widget.touch()
+
     def getCurrentPakApp(self):
 
         if self._focusIndex == 0:
@@ -1267,9 +2637,13 @@ class GameWidget(Widget):
 
     def processKeypress(self, ch):
 
+        selectKeys = (Keys.SELECT + Keys.SELECT_RANGE + Keys.SELECT_ALL +
+                      Keys.SELECT_INVERT)
+
         # send keypress to the section in focus
         if self._focusIndex == 0:
             self.scroll1.processKeypress(ch)
+            self.prefetchNear()
         elif self._focusIndex == 1:
             self.scroll2.processKeypress(ch)
         # elif self._focusIndex == 2:
@@ -1284,31 +2658,94 @@ class GameWidget(Widget):
 
         # if the find key was hit stuff changed by now
         elif ch in Keys.FIND:
+            if self.facets is not None:
+                self.updateFacets()
             self.draw()
             self.doRefresh()
 
+        elif ch in Keys.FACETS:
+            if self.facets is None:
+                self.showFacets()
+            else:
+                self.closeFacets()
+                self.draw()
+                self.doRefresh()
+
+        elif self.facets is not None and self._focusIndex == 0 and (
+                ch in selectKeys):
+            self.updateFacets()
+
         elif ch in Keys.ENTER:
 
-            if self._focusIndex == 0:
+            if self._focusIndex == 0 and self.facets is not None:
+                self.focusOffset(1)
+
+            elif self._focusIndex == 0:
                 pak = self.scroll1.currentItem()
                 if self.appVersionMode:
                     pak = 'SpecialPakName'
-                self.scroll2.filterText = ''
-                versions = 'this is a test'.split(' ')
-                self.scroll2.setItems(versions)
+                if pak is None:
+                    return
+                versions = self.openFolder(os.path.join(LIBRARY_PATH, pak))
                 self.draw()
                 self.doRefresh()
                 if versions:
                     self.focusOffset(1)
 
-            elif self._focusIndex == 1:
-                for func in self._addVersionFuncs:
-                    func(self.scroll2.currentItem())
+            elif self._focusIndex == 1 and self.shardPlan is not None:
+                self.applyShardPlan()
+
+            elif self._focusIndex == 1 and self.capacityPlan is not None:
+                self.syncCapacityPlan()
+
+            elif self._focusIndex == 1 and self.cardDiff is not None:
+                self.runBatch('Copy', self.diffPaths(
+                    (core.DIFF_MISSING, core.DIFF_DIFFERENT), 1))
+
+            elif self._focusIndex == 1 and self.dupeGroups is None:
+                self.runBatch('Copy')
 
-        elif ch in Keys.DELETE:
-            if self._focusIndex == 0:
-                for func in self._delVersionFuncs:
-                    func(self.scroll1.currentItem())
+        elif ch in Keys.DELETE and self._focusIndex == 1:
+            if self.dupeGroups is not None:
+                self.deleteDuplicates()
+            elif self.cardDiff is not None:
+                self.runBatch('Delete', self.diffPaths(
+                    (core.DIFF_EXTRA,), 2))
+            elif self.capacityPlan is None:
+                self.runBatch('Delete')
+
+        elif self.capacityPlan is not None and self._focusIndex == 1 and (
+                ch in selectKeys):
+            self.updateCapacityPlan()
+
+        elif ch in Keys.HASH and self._focusIndex == 1:
+            self.runBatch('Hash')
+
+        elif ch in Keys.PUSH and self._focusIndex == 1:
+            self.runBatch('Push')
+
+        elif ch in Keys.APPLY_PATCH and self._focusIndex == 1:
+            self.applyPatches()
+
+        elif ch in Keys.BOOT and self._focusIndex == 1:
+            path = self.currentGamePath()
+            if path:
+                self.runBatch('Boot', [path])
+
+        elif ch in Keys.DEDUPE and self._focusIndex == 1:
+            self.showDuplicates()
+
+        elif ch in Keys.SHARD:
+            self.showShardPlan()
+
+        elif ch in Keys.FIT:
+            self.showCapacityPlan()
+
+        elif ch in Keys.CARD_DIFF:
+            self.showCardDiff()
+
+        elif ch in Keys.CANCEL_JOB and self._focusIndex == 1:
+            self.cancelRows()
 
     def mouseEvent(self, bstate, y, x, callback):
 
@@ -1335,34 +2772,47 @@ class HelpWin(Widget):
 
         # Color.WINDOW_OFF.fillScreen(self.window)
 
-        self.scrollArea = ScrollWid(self.frame)
-        self.scrollArea.pageMode = True
+        self.scrollArea = ViewWid(self.frame)
+        self.scrollArea.setSource(HELP.strip().split('\n'))
+        self._status = ''
 
     def getWindow(self):
         return self.window
 
     def processKeypress(self, ch):
         self.scrollArea.processKeypress(ch)
-        self.scrollArea.doRefresh()
+        if ch in Keys.FIND:
+            # the find popup was drawn over everything
+            self.refreshTop()
+        else:
+            self.scrollArea.draw()
+            self.scrollArea.doRefresh()
+
+    def idle(self):
+        """ repaints while a search is still finding things """
+        if self.scrollArea.status() == self._status:
+            return False
+        self.draw()
+        self.doRefresh()
+        return True
 
     def draw(self):
         """ draw function here """
-        y, x = self.parentPos()
-        h, w = self.parentSize()
-
-        self.window.resize(h - 1, w)
-        self.window.mvwin(y + 1, x)
+        if not self.laidOut():
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            self.place(self.window, h - 1, w, y + 1, x)
         self.window.border(*BORDER_ARGS)
 
         wh, ww = self.window.getmaxyx()
         # message = self.title or 'Example Widget'
         # self.window.addnstr(0, 1, message, ww - 1)
 
-        self.frame.title = self.title
+        self._status = self.scrollArea.status()
+        self.frame.title = self.title + ' ' + self._status
         self.frame.draw()
 
         self.scrollArea.draw()
-        self.scrollArea.setItems(HELP.strip().split('\n'))
 
     def doRefresh(self):
         """ noutrefresh-es go here"""
@@ -1370,6 +2820,92 @@ class HelpWin(Widget):
         self.frame.doRefresh()
         self.scrollArea.doRefresh()
 
+    def touch(self):
+        self.frame.touch()
+        self.scrollArea.touch()
+
+class JobsWin(Widget):
+    """ what the job scheduler is up to
+
+    delete cancels the current job, r retries it and c clears finished jobs
+    """
+
+    def __init__(self, parent, scheduler):
+
+        self.parentWidget = parent
+        self.parent = parent.getWindow()
+        self.window = self.newwin()
+        self.title = 'Jobs'
+        self.scheduler = scheduler
+        self._jobs = []
+
+        self.frame = FrameWid(self)
+        self.scrollArea = ScrollWid(self.frame)
+
+    def getWindow(self):
+        return self.window
+
+    @staticmethod
+    def jobLine(job):
+
+        if job.state == job.RUNNING and job.progress:
+            done, total = job.progress
+            detail = '%d%%' % (100 * done // total) if total else done
+        elif job.state == job.DONE and job.result is not None:
+            detail = job.result
+        elif job.state == job.FAILED:
+            detail = job.error
+        else:
+            detail = ''
+        if job.attempts > 1:
+            detail = '%s (try %s)' % (detail, job.attempts)
+        return '%-9s %-40s %s' % (job.state, job.name, detail)
+
+    def currentJob(self):
+        # the row is in the filtered list, the index is into all the jobs
+        index = self.scrollArea.currentIndex()
+        if index is not None and index < len(self._jobs):
+            return self._jobs[index]
+
+    def update(self):
+        """ re-reads the jobs, keeping the cursor where it was """
+        index = self.scrollArea.index()
+        self._jobs = list(self.scheduler.jobs)
+        self.scrollArea.setItems([self.jobLine(j) for j in self._jobs])
+        self.scrollArea.scroll(index)
+
+    def processKeypress(self, ch):
+
+        self.scrollArea.processKeypress(ch)
+        job = self.currentJob()
+
+        if ch in Keys.DELETE and job:
+            job.cancel()
+        elif ch in Keys.RETRY and job:
+            self.scheduler.retry(job)
+        elif ch in Keys.CLEAR_SCREEN:
+            self.scheduler.clearFinished()
+
+    def draw(self):
+        """ draw function here """
+        if not self.laidOut():
+            y, x = self.parentPos()
+            h, w = self.parentSize()
+            self.place(self.window, h - 1, w, y + 1, x)
+
+        self.frame.title = self.title
+        self.frame.draw()
+        self.scrollArea.draw()
+
+    def doRefresh(self):
+        """ noutrefresh-es go here"""
+        self.frame.doRefresh()
+        self.scrollArea.doRefresh()
+
+    def touch(self):
+        self.frame.touch()
+        self.scrollArea.touch()
+
 # --------------------------------------------------------------------------- #
 # - Main                                                                    - #
 # --------------------------------------------------------------------------- #
@@ -1382,10 +2918,25 @@ class MainWindow(object):
         self._mouseWidgets = []
         self._run = True
         self._bottomFocus = False
+        self._jobsVersion = None
+        # a resize is laid out once the terminal stops sending them
+        self._resized = False
+        self._lastFrame = 0
+        self._cardDevice = None
+        self._cardChecked = 0
         self.stdscr = stdscr
         self.stdscr.nodelay(False)
+        self.scheduler = core.JobScheduler()
 
-        appNames = 'app names would go here'.split(' ')
+        try:
+            host, port = core.parseAddress(USB2SNES)
+        except ValueError as e:
+            Echo(e, 'using localhost:%s' % core.USB2SNES_PORT)
+            host, port = 'localhost', core.USB2SNES_PORT
+        self.usb = core.Usb2Snes(host, port)
+
+        appNames = [os.path.relpath(f, LIBRARY_PATH)
+                    for f in core.listFolders(LIBRARY_PATH)]
 
         marg = CSizeWid(self)
         marg.targetHeight = WINDOW_SIZE[0]
@@ -1403,10 +2954,23 @@ class MainWindow(object):
         self.pakWin = GameWidget(dsw)
         self.pakWin.title = 'All Paks'
         self.pakWin.populate(appNames)
+        self.pakWin.scheduler = self.scheduler
+        self.pakWin.setJobFunc('Copy', self.addPak, 'card', 1)
+        # deleting only unlinks, the pane waits for it
+        self.pakWin.setJobFunc(
+            'Delete', self.removePak, 'card', 1, True, self._pakRemoved,
+            blocking=False)
+        self.pakWin.setJobFunc('Hash', self.hashPak, 'cpu')
+        self.pakWin.setJobFunc('Push', self.pushPak, 'usb', 1)
+        self.pakWin.setJobFunc('Boot', self.bootPak, 'usb', 2)
+
+        # Jobs
+        self.jobsWin = JobsWin(dsw, self.scheduler)
 
         windows = [
             self.helpWin,
             self.pakWin,
+            self.jobsWin,
         ]
         self.stack = StackedWidget(dsw)
         self.stack.setWidgets(windows)
@@ -1414,7 +2978,7 @@ class MainWindow(object):
         self.stack._currentIndex = 1
 
         self.tabs = TabBar(self.stack)
-        self.tabs.items = ['F1:Help', 'F2:All']
+        self.tabs.items = ['F1:Help', 'F2:All', 'F6:Jobs']
         self.tabs.tabIndex = 1
 
         self.addWidget(marg)
@@ -1422,11 +2986,103 @@ class MainWindow(object):
         self.addWidget(self.stack)
         self.addWidget(self.tabs)
 
-    def addPak(self, pak):
-        pass
+    @staticmethod
+    def _libraryFolder(pak):
+        """ folder of a library rom relative to the library """
+        archive, _ = core.splitZipPath(pak)
+        return os.path.relpath(os.path.dirname(archive), LIBRARY_PATH)
 
-    def removePak(self, pak):
-        pass
+    @staticmethod
+    def _pakFiles(pak):
+        """ every file that makes up a pak, msu-1 packs have lots """
+        if core.isMsu(pak):
+            return core.MsuPack(pak).files()
+        return [pak]
+
+    @staticmethod
+    def _pakRom(pak):
+        """ the rom of a pak, an msu-1 pack may not have one """
+        if core.isMsu(pak):
+            rom = core.MsuPack(pak).rom
+            if rom is None:
+                raise IOError('No rom in msu-1 pack: %s' % pak)
+            return rom
+        return pak
+
+    def addPak(self, job, pak):
+        """ copies a library rom to the same folder on the card, roms in
+        zips are decompressed straight to the card
+
+        msu-1 packs are copied as a whole and resume where they stopped
+        """
+        folder = os.path.normpath(
+            os.path.join(CARD_PATH, self._libraryFolder(pak)))
+        if core.isMsu(pak):
+            pack = core.MsuPack(pak)
+            tuning = core.copyTuning(CARD_PATH, pack.size)
+            workers = core.copyMsuPack(
+                pack, folder, job.update, tuning.workers, tuning.bufsize,
+                tuning.syncBytes)
+            return '%s (%s at a time)' % (folder, workers)
+        dst = os.path.join(folder, core.romName(pak))
+        tuning = core.copyTuning(CARD_PATH, core.fileSize(pak))
+        core.copyRom(pak, dst, tuning.bufsize, job.update, tuning.syncBytes)
+        return dst
+
+    def benchCard(self):
+        """ benchmarks the card in the background, copies use the result
+        """
+        job = core.Job('Benchmark card', self._benchCard, (), 'card')
+        self.scheduler.submit(job)
+
+    @staticmethod
+    def _benchCard(job):
+        stats = core.benchmarkCard(CARD_PATH, progress=job.update)
+        core.saveCard(stats)
+        block = core.bestBlock(stats)
+        return 'write %s/s read %s/s at %s, %d files/s' % (
+            core.formatSize(stats['write'][str(block)]),
+            core.formatSize(stats['read'][str(block)]),
+            core.formatSize(block), stats['smallFiles'])
+
+    def remotePath(self, pak):
+        """ where a library rom goes on the cart when sent over usb """
+        folder = self._libraryFolder(pak).replace(os.sep, '/')
+        return posixpath.normpath(
+            posixpath.join('/', folder, core.romName(pak)))
+
+    def pushPak(self, job, pak):
+        """ uploads a rom to the running cart through usb2snes """
+        for path in self._pakFiles(pak):
+            self.usb.putFile(path, self.remotePath(path), job.update)
+        return self.remotePath(pak)
+
+    def bootPak(self, job, pak):
+        """ boots a rom on the cart, uploading it first if it is missing """
+        remote = self.remotePath(self._pakRom(pak))
+        for path in self._pakFiles(pak):
+            if not self.usb.exists(self.remotePath(path)):
+                self.usb.putFile(path, self.remotePath(path), job.update)
+        self.usb.boot(remote)
+        return remote
+
+    def removePak(self, job, pak):
+
+        archive, member = core.splitZipPath(pak)
+        if member is not None:
+            raise IOError('Can not delete inside an archive: %s' % pak)
+        for path in self._pakFiles(pak):
+            job.update()
+            os.remove(path)
+
+    def hashPak(self, job, pak):
+        return core.hashRom(self._pakRom(pak))
+
+    def _pakRemoved(self, batch):
+        if self.pakWin.folder:
+            self.pakWin.openFolder(self.pakWin.folder)
+        self.stack.invalidate(self.pakWin)
+        self.draw(refresh=True)
 
     def getWindow(self):
         return self.stdscr
@@ -1441,6 +3097,7 @@ class MainWindow(object):
 
         # no sense in taking down the whole
         # application beacuse of a size error
+        span = core.TRACER.on and core.TRACER.begin('draw')
         try:
             if erase:
                 self.stdscr.erase()
@@ -1451,18 +3108,78 @@ class MainWindow(object):
         except curses.error as e:
             tb = traceback.format_exc()
             Echo(tb)
+        if span:
+            core.TRACER.end(span, erase=erase)
 
     def doRefresh(self):
 
+        span = core.TRACER.on and core.TRACER.begin('doRefresh')
         self.stdscr.noutrefresh()
         for widget in self._widgets:
             widget.doRefresh()
+        if span:
+            core.TRACER.end(span)
+
+    def flush(self):
+        """ sends the frame to the terminal
+
+        in low bandwidth mode frames closer together than LOW_BANDWIDTH_FPS
+        wait for the rest of the interval, keys that come in meanwhile
+        are drawn into the same frame
+        """
+        now = time.time()
+        wait = self._lastFrame + 1.0 / LOW_BANDWIDTH_FPS - now
+        if LOW_BANDWIDTH and wait > 0:
+            self.stdscr.timeout(max(1, int(wait * 1000)))
+            return
+        span = core.TRACER.on and core.TRACER.begin('doupdate')
+        curses.doupdate()
+        if span:
+            core.TRACER.end(span)
+        self._lastFrame = now
+        self.stdscr.timeout(POLL_MS)
+
+    def toggleTrace(self):
+        """ starts tracing, or stops it and writes the trace """
+        tracer = core.TRACER
+        tracer.on = not tracer.on
+        if tracer.on:
+            tracer.events.clear()
+            Echo('Tracing')
+            return
+        try:
+            Echo('Trace of %s spans written to' % tracer.export(),
+                 core.TRACE_PATH)
+        except (IOError, OSError) as e:
+            self._popupError(e)
+
+    def toggleLowBandwidth(self):
+        global LOW_BANDWIDTH
+        LOW_BANDWIDTH = not LOW_BANDWIDTH
+        Echo('Low bandwidth', LOW_BANDWIDTH)
+        # the shadows have to go, or come back
+        self.layout()
+
+    def layout(self):
+        """ fits everything to the terminal, the one draw that moves and
+        resizes windows, hidden tabs get laid out when they are shown
+        """
+        self._resized = False
+        Widget.generation += 1
+        self.stack.invalidate()
+        self.draw(refresh=True, erase=True)
 
     def setPage(self, index):
-        self.stdscr.erase()
+        """ redraws the tab bar, the page comes from the stack's cache """
         self.stack.setCurrent(index)
+        if self.stack.currentWidget() is self.jobsWin:
+            # jobs only repaint while they are on screen
+            self.jobsWin.update()
+            self.stack.draw()
+            self.stack.doRefresh()
         self.tabs.tabIndex = index
-        self.draw(refresh=True)
+        self.tabs.draw()
+        self.tabs.doRefresh()
 
     def mainLoop(self):
         """ to check for keys we must ignore catch key errors """
@@ -1474,12 +3191,71 @@ class MainWindow(object):
         self.doRefresh()
         curses.doupdate()
 
+        self.stdscr.timeout(POLL_MS)
         while self._run:
-            ch = self.stdscr.getch()
-            ch = self.processKeypress(ch)
-            self.stack.processKeypress(ch)
-
-            curses.doupdate()
+            ch = readKey(self.stdscr)
+            if ch == Keys.KEY_RESIZE:
+                # dragging an edge sends dozens of these, only the size
+                # the terminal settles on gets laid out
+                self._resized = True
+                continue
+            if self._resized:
+                self.layout()
+            if ch == -1:
+                self.idle()
+            else:
+                span = core.TRACER.on and core.TRACER.begin('key', key=ch)
+                ch = self.processKeypress(ch)
+                self.stack.processKeypress(ch)
+                if span:
+                    core.TRACER.end(span)
+
+            self.flush()
+
+        # don't leave half copied files on the card
+        self.scheduler.cancelAll()
+        self.scheduler.wait(5)
+        self.usb.close()
+        if core.TRACER.on:
+            core.TRACER.export()
+
+    def idle(self):
+        """ runs job callbacks on the ui thread and repaints job state """
+        self.stack.currentWidget().idle()
+        self.watchCard()
+        span = core.TRACER.on and core.TRACER.begin('callbacks')
+        if self.scheduler.runPosted() and span:
+            core.TRACER.end(span)
+        if self.scheduler.version == self._jobsVersion:
+            return
+        self._jobsVersion = self.scheduler.version
+
+        active = len(self.scheduler.active())
+        self.tabs.items[2] = 'F6:Jobs %s' % active if active else 'F6:Jobs'
+        self.tabs.draw()
+        self.tabs.doRefresh()
+        if self.stack.currentWidget() is self.jobsWin:
+            self.jobsWin.update()
+            self.stack.draw()
+            self.stack.doRefresh()
+        elif self.stack.currentWidget() is self.pakWin:
+            self.pakWin.updateRows()
+
+    def watchCard(self):
+        """ diffs a card with a profile as soon as it is mounted """
+        now = time.time()
+        if now - self._cardChecked < CARD_POLL:
+            return
+        self._cardChecked = now
+        try:
+            device = os.stat(CARD_PATH).st_dev
+        except OSError:
+            device = None
+        if device == self._cardDevice:
+            return
+        self._cardDevice = device
+        if device is not None and core.knownCard(CARD_PATH):
+            self.pakWin.showCardDiff()
 
     def _popupError(self, e):
 
@@ -1494,9 +3270,32 @@ class MainWindow(object):
 
     def viewPakDump(self):
 
-        json = HELP
-        popup = PopupTextWin(self, json)
-        popup.title = 'Pak Dump %s ' % pak
+        pak = self.pakWin.currentGamePath()
+        if not pak:
+            return
+        archive, member = core.splitZipPath(pak)
+        if member is not None:
+            self._popupError(IOError('Can not dump inside an archive'))
+            return
+        popup = PopupHexWin(self, pak)
+        popup.title = 'Pak Dump %s ' % core.romName(pak)
+        popup.execute()
+        self.draw(refresh=True, erase=True)
+
+    def viewFile(self):
+        """ asks for a text file to look at, nothing opens the log """
+        ask = PopupEnterText(self)
+        ask.title = 'View File'
+        path = os.path.expanduser(ask.execute().strip()) or Echo.PATH
+        self.draw(refresh=True, erase=True)
+        if not path:
+            return
+        try:
+            popup = PopupFileWin(self, path)
+        except (IOError, OSError) as e:
+            self._popupError(e)
+            return
+        popup.title = '%s ' % os.path.basename(path)
         popup.execute()
         self.draw(refresh=True, erase=True)
 
@@ -1522,6 +3321,24 @@ class MainWindow(object):
         elif ch in Keys.TAB_CURRENT:
             self.setPage(1)
 
+        elif ch in Keys.TAB_JOBS:
+            self.setPage(2)
+
+        elif ch in Keys.DUMP_PAK:
+            self.viewPakDump()
+
+        elif ch in Keys.VIEW_FILE:
+            self.viewFile()
+
+        elif ch in Keys.LOW_BANDWIDTH:
+            self.toggleLowBandwidth()
+
+        elif ch in Keys.TRACE:
+            self.toggleTrace()
+
+        elif ch in Keys.BENCH_CARD:
+            self.benchCard()
+
         elif ch in Keys.TAB_PREV:
             i = self.tabs.tabIndex
             i -= 1
@@ -1534,10 +3351,6 @@ class MainWindow(object):
             i = 0 if len(self.tabs.items) - 1 < i else i
             self.setPage(i)
 
-        elif ch == Keys.KEY_RESIZE:
-            self.stdscr.clear()
-            self.draw(refresh=True)
-
         elif ch == Keys.KEY_MOUSE:
             _id, x, y, z, bstate = curses.getmouse()
 
@@ -1558,6 +3371,7 @@ class MainWindow(object):
     def appStart(cls):
         """ modified curses.wrapper
         """
+        global RECORDER
         msg = None
         try:
             Echo('Started', datetime.datetime.now())
@@ -1571,6 +3385,7 @@ class MainWindow(object):
             # curses.mouseinterval(600)
             # needed for arrow keys
             stdscr.keypad(1)
+            stdscr.idlok(HARDWARE_SCROLL)
             setCursor(0)
             curses.mousemask(
                 curses.ALL_MOUSE_EVENTS |
@@ -1578,6 +3393,8 @@ class MainWindow(object):
 
             Color.initPairs()
 
+            if RECORD_PATH:
+                RECORDER = InputRecorder(RECORD_PATH, stdscr)
             app = cls(stdscr)
             app.mainLoop()
             msg = 'Canceled'
@@ -1591,6 +3408,8 @@ class MainWindow(object):
             msg = tb
 
         finally:
+            if RECORDER is not None:
+                RECORDER.close()
             # Set everything back to normal
             if 'stdscr' in locals():
                 stdscr.keypad(0)
@@ -0,0 +1,1092 @@
+""" tests for sd2snescore, run with python -m pytest or python -m unittest
+"""
+
+import array
+import io
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+import zlib
+
+import sd2snescore as core
+import sd2snescli as cli
+
+try:
+    from StringIO import StringIO
+except ImportError:  # python 3
+    from io import StringIO
+
+class TempFolderCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data=b''):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+# --------------------------------------------------------------------------- #
+# - Duplicates                                                              - #
+# --------------------------------------------------------------------------- #
+
+def romData(seed, size=2 * core.HASH_BLOCK):
+    return bytes(bytearray((seed + i) % 251 for i in range(size)))
+
+class FindDuplicatesTest(TempFolderCase):
+
+    def test_copier_header(self):
+        data = romData(1)
+        plain = self.write('Game.sfc', data)
+        headered = self.write('Game.smc', b'\0' * core.COPIER_HEADER + data)
+        # same size, only the last byte differs
+        other = self.write('Other.sfc', data[:-1] + b'\0')
+        self.assertEqual(core.findDuplicates([plain, headered, other]),
+                         [[plain, headered]])
+
+    def test_unique_sizes_not_read(self):
+        paths = [self.write('%s.sfc' % i, romData(i, 1024 * (i + 1)))
+                 for i in range(3)]
+        stats = core.DupeStats()
+        self.assertEqual(core.findDuplicates(paths, stats), [])
+        self.assertEqual(stats.files, 3)
+        self.assertEqual(stats.bytesTotal, 1024 * 6)
+        self.assertEqual(stats.bytesRead, 0)
+
+    def test_prefix_splits(self):
+        paths = [self.write('%s.sfc' % i, romData(i)) for i in range(3)]
+        stats = core.DupeStats()
+        self.assertEqual(core.findDuplicates(paths, stats), [])
+        # the first block told them apart, the rest was never read
+        self.assertEqual(stats.bytesRead, 3 * core.HASH_BLOCK)
+
+    def test_progress(self):
+        paths = [self.write('%s.sfc' % i, romData(0)) for i in range(2)]
+        calls = []
+        groups = core.findDuplicates(
+            paths, progress=lambda *a: calls.append(a))
+        self.assertEqual(groups, [paths])
+        self.assertIn((0,), calls)
+        self.assertIn((0, 4 * core.HASH_BLOCK), calls)
+
+# --------------------------------------------------------------------------- #
+# - Zip archives                                                            - #
+# --------------------------------------------------------------------------- #
+
+class ZipTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        self.data = romData(3)
+        self.archive = os.path.join(self.folder, 'Games.zip')
+        zf = zipfile.ZipFile(self.archive, 'w', zipfile.ZIP_DEFLATED)
+        zf.writestr('Game.sfc', self.data)
+        zf.writestr('readme.txt', b'not a rom')
+        zf.close()
+
+    def test_list(self):
+        member = core.zipPath(self.archive, 'Game.sfc')
+        self.assertEqual(core.listZip(self.archive), [member])
+        self.assertEqual(core.splitZipPath(member), (self.archive, 'Game.sfc'))
+        self.assertEqual(core.fileSize(member), len(self.data))
+        self.assertEqual(core.romName(member), 'Game.sfc')
+        loose = self.write('Loose.sfc')
+        self.assertEqual(core.listFolder(self.folder), [member, loose])
+        self.assertEqual(core.listFolder(self.folder, zips=False), [loose])
+
+    def test_bad_zip_skipped(self):
+        self.write('Broken.zip', b'PK not really')
+        self.assertEqual(list(core.walkRoms(self.folder, zips=True)),
+                         [core.zipPath(self.archive, 'Game.sfc')])
+
+    def test_copy(self):
+        dst = os.path.join(self.folder, 'out', 'Game.sfc')
+        calls = []
+        core.copyRom(core.zipPath(self.archive, 'Game.sfc'), dst,
+                     bufsize=4096, progress=lambda *a: calls.append(a))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(calls[-1], (len(self.data), len(self.data)))
+
+    def test_copy_missing_member(self):
+        dst = os.path.join(self.folder, 'Gone.sfc')
+        self.assertRaises(KeyError, core.copyRom,
+                          core.zipPath(self.archive, 'Gone.sfc'), dst)
+        self.assertFalse(os.path.exists(dst))
+
+# --------------------------------------------------------------------------- #
+# - Tracing                                                                 - #
+# --------------------------------------------------------------------------- #
+
+class TracerTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        self.tracer = core.Tracer(3)
+        self.tracer.on = True
+        self.path = os.path.join(self.folder, 'traces', 'trace.json')
+
+    def export(self):
+        """ (spans, thread names) of the exported trace """
+        count = self.tracer.export(self.path)
+        with open(self.path) as f:
+            events = json.load(f)['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(len(spans), count)
+        names = dict((e['tid'], e['args']['name'])
+                     for e in events if e['ph'] == 'M')
+        return spans, names
+
+    def test_export(self):
+        span = self.tracer.begin('draw', rows=2)
+        self.tracer.end(span, bytes=10)
+        self.tracer.add('queued', 1.0, 1.5, 'queue')
+        spans, names = self.export()
+        draw, queued = spans
+        self.assertEqual((draw['name'], draw['cat'], draw['args']),
+                         ('draw', 'ui', {'rows': 2, 'bytes': 10}))
+        self.assertEqual((queued['ts'], queued['dur']), (1000000, 500000))
+        self.assertEqual(draw['pid'], os.getpid())
+        self.assertEqual(names, {draw['tid']:
+                                 threading.current_thread().name})
+        self.assertFalse(os.path.exists(self.path + core.PART_EXT))
+
+    def test_oldest_dropped(self):
+        for i in range(5):
+            self.tracer.add(str(i), i, i + 1)
+        spans, _ = self.export()
+        self.assertEqual([s['name'] for s in spans], ['2', '3', '4'])
+
+    def test_jobs(self):
+        tracer, core.TRACER = core.TRACER, core.Tracer()
+        self.addCleanup(setattr, core, 'TRACER', tracer)
+        self.tracer = core.TRACER
+        self.tracer.on = True
+
+        def steps(job):
+            job.phase('read')
+            job.phase('write')
+        scheduler = core.JobScheduler({'cpu': 1})
+        scheduler.submit(core.Job('copy', steps))
+        scheduler.wait(5)
+        spans, names = self.export()
+        self.assertEqual(sorted((s['name'], s['cat']) for s in spans), [
+            ('copy', 'job'), ('copy: read', 'phase'),
+            ('copy: write', 'phase'), ('queued', 'queue')])
+        job = [s for s in spans if s['cat'] == 'job'][0]
+        self.assertEqual(job['args'], {'state': core.Job.DONE,
+                                       'resource': 'cpu'})
+        self.assertNotEqual(names[job['tid']],
+                            threading.current_thread().name)
+
+# --------------------------------------------------------------------------- #
+# - Jobs                                                                    - #
+# --------------------------------------------------------------------------- #
+
+def until(test, timeout=5):
+    deadline = time.time() + timeout
+    while not test():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.001)
+
+class JobSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = core.JobScheduler({'card': 1, 'cpu': 2})
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+
+    def job(self, name, resource='cpu', priority=0, func=None, **kwargs):
+        func = func or (lambda job: self.gate.wait(5))
+        return core.Job(name, func, (), resource, priority, **kwargs)
+
+    def running(self):
+        return [j for j in self.scheduler.jobs if j.state == j.RUNNING]
+
+    def test_limits(self):
+        jobs = [self.job(i) for i in range(3)]
+        card = self.scheduler.submit(self.job('card', 'card'))
+        for job in jobs:
+            self.scheduler.submit(job)
+        until(lambda: len(self.running()) == 3)
+        time.sleep(0.01)
+        self.assertEqual(len(self.running()), 3)
+        self.assertEqual(jobs[2].state, core.Job.QUEUED)
+        self.assertEqual(card.state, core.Job.RUNNING)
+        self.gate.set()
+        self.assertTrue(self.scheduler.wait(5))
+        self.assertEqual([j.state for j in self.scheduler.jobs],
+                         [core.Job.DONE] * 4)
+        # the workers are gone once the queue is empty
+        until(lambda: not any(self.scheduler._workers.values()))
+
+    def test_priority(self):
+        order = []
+        record = lambda job: order.append(job.name)
+        self.scheduler.submit(self.job('first', 'card'))
+        for name, priority in (('low', 0), ('high', 5), ('mid', 1)):
+            self.scheduler.submit(
+                self.job(name, 'card', priority, func=record))
+        self.gate.set()
+        self.scheduler.wait(5)
+        self.assertEqual(order, ['high', 'mid', 'low'])
+
+    def test_cancel(self):
+        def loop(job):
+            while True:
+                job.update()
+                time.sleep(0.001)
+        running = self.scheduler.submit(self.job('loop', 'card', func=loop))
+        queued = self.scheduler.submit(self.job('queued', 'card'))
+        until(lambda: running.state == running.RUNNING)
+        queued.cancel()
+        self.assertEqual(queued.state, core.Job.CANCELLED)
+        running.cancel()
+        self.scheduler.wait(5)
+        self.assertEqual(running.state, core.Job.CANCELLED)
+
+    def test_retry(self):
+        def flaky(job):
+            if job.attempts < 2:
+                raise IOError('busy')
+            return 'ok'
+        job = self.scheduler.submit(self.job('flaky', func=flaky, retries=1))
+        self.scheduler.wait(5)
+        self.assertEqual((job.state, job.attempts, job.result),
+                         (core.Job.DONE, 2, 'ok'))
+
+        job = self.scheduler.submit(self.job('once', func=flaky))
+        self.scheduler.wait(5)
+        self.assertEqual(job.state, core.Job.FAILED)
+        self.assertTrue(isinstance(job.error, IOError))
+        self.scheduler.retry(job)
+        self.scheduler.wait(5)
+        # attempts start over on a retry, so it fails the same way
+        self.assertEqual((job.state, job.attempts), (core.Job.FAILED, 1))
+
+    def test_callbacks_posted(self):
+        done = []
+        version = self.scheduler.version
+        jobs = [self.job(i, func=lambda job: None) for i in range(2)]
+        self.scheduler.submitBatch('both', jobs, onDone=done.append)
+        self.scheduler.wait(5)
+        self.assertEqual(done, [])
+        self.assertGreater(self.scheduler.version, version)
+        self.assertEqual(self.scheduler.runPosted(), 1)
+        self.assertEqual(done, [jobs[0].batch])
+
+    def test_run_now(self):
+        done = []
+        threads = []
+        record = lambda job: threads.append(threading.current_thread())
+        job = self.job('now', 'card', func=record, onDone=done.append)
+        # the card is busy, a job run now doesn't wait for it
+        self.scheduler.submit(self.job('card', 'card'))
+        self.assertIs(self.scheduler.runNow(job), job)
+        self.assertEqual(job.state, core.Job.DONE)
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(done, [])
+        self.scheduler.runPosted()
+        self.assertEqual(done, [job])
+
+# --------------------------------------------------------------------------- #
+# - Viewers                                                                 - #
+# --------------------------------------------------------------------------- #
+
+class HexDumpTest(TempFolderCase):
+
+    def test_rows(self):
+        dump = core.HexDump(self.write('Game.sfc', b'SNES\x00\xff' * 3))
+        self.addCleanup(dump.close)
+        self.assertEqual(len(dump), 2)
+        self.assertEqual(dump.rowOf(17), 1)
+        self.assertEqual(dump[1], '00000010  %-47s  ..' % '00 FF')
+        self.assertTrue(dump[0].endswith('  SNES..SNES..SNES'))
+
+    def test_empty(self):
+        dump = core.HexDump(self.write('Empty.sfc'))
+        self.addCleanup(dump.close)
+        self.assertEqual(len(dump), 0)
+
+class SearchTest(unittest.TestCase):
+
+    def test_patterns(self):
+        self.assertEqual(core.parsePattern('a9 00 8d'), b'\xa9\x00\x8d')
+        self.assertEqual(core.parsePattern('"a9"'), b'a9')
+        self.assertEqual(core.parsePattern('SNES'), b'SNES')
+        self.assertEqual(core.parsePattern('abc'), b'abc')
+
+    def test_across_chunks(self):
+        data = b'..ab' * 10
+        search = core.Search(data, b'ab', chunk=3)
+        self.assertTrue(search.wait(5))
+        self.assertEqual(search.matches, list(range(2, 40, 4)))
+        self.assertEqual(search.nextMatch(2), 6)
+        self.assertEqual(search.nextMatch(38), 2)
+        self.assertEqual(search.prevMatch(2), 38)
+        self.assertEqual(search.between(5, 15), [6, 10, 14])
+
+    def test_no_pattern(self):
+        search = core.Search(b'data', b'')
+        search.wait(5)
+        self.assertEqual(search.nextMatch(0), None)
+
+class LineIndexTest(TempFolderCase):
+
+    def index(self, data, chunk=core.SEARCH_CHUNK):
+        lines = core.LineIndex(self.write('log.txt', data), chunk)
+        self.addCleanup(lines.close)
+        self.assertTrue(lines.wait(5))
+        return lines
+
+    def test_lines(self):
+        lines = self.index(b'one\r\ntwo\n\tthree\nfour', chunk=4)
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(list(lines.offsets), [0, 5, 9, 16])
+        self.assertEqual(lines.line(0), b'one')
+        self.assertEqual(lines[2], '        three')
+        self.assertEqual(lines[3], 'four')
+
+    def test_trailing_newline(self):
+        self.assertEqual(len(self.index(b'one\ntwo\n')), 2)
+        self.assertEqual(len(self.index(b'')), 0)
+
+    def test_bad_utf8(self):
+        self.assertEqual(self.index(b'caf\xe9\n')[0], u'caf\ufffd')
+
+class LineSearchTest(TempFolderCase):
+
+    def search(self, source, text):
+        search = core.LineSearch(source, text)
+        self.addCleanup(search.cancel)
+        self.assertTrue(search.wait(5))
+        return search.matches
+
+    def test_list(self):
+        lines = ['Mario', 'zelda', 'MARIO kart', 'metroid']
+        self.assertEqual(self.search(lines, 'mario'), [0, 2])
+        self.assertEqual(self.search(lines, ''), [])
+
+    def test_index(self):
+        path = self.write('log.txt', b'Mario\nzelda mario MARIO\nmetroid\n'
+                          b'kart\nmario')
+        lines = core.LineIndex(path)
+        self.addCleanup(lines.close)
+        # found while the index may still be building, each line once
+        self.assertEqual(self.search(lines, 'MARIO'), [0, 1, 4])
+        self.assertEqual(self.search(lines, 'luigi'), [])
+
+# --------------------------------------------------------------------------- #
+# - Item lists                                                              - #
+# --------------------------------------------------------------------------- #
+
+class PackedItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.names = ['Super Mario World.sfc', 'zelda.smc', 'MARIO Kart',
+                      'Metroid', '']
+        self.items = core.PackedItems(self.names)
+
+    def test_list(self):
+        self.assertEqual(len(self.items), 5)
+        self.assertEqual(list(self.items), self.names)
+        self.assertEqual(self.items[-2], 'Metroid')
+
+    def test_find(self):
+        self.assertEqual(list(self.items.find('mario')), [0, 2])
+        self.assertEqual(list(self.items.find('')), [0, 1, 2, 3, 4])
+        self.assertEqual(list(self.items.find('luigi')), [])
+        # a match may not run on into the next item
+        self.assertEqual(list(self.items.find('smcmario')), [])
+        self.assertEqual(list(self.items.find('.s')), [0, 1])
+
+    @unittest.skipIf(str is bytes, 'python 2 names are bytes')
+    def test_find_unicode(self):
+        names = [u'Pok\xe9mon', u'POK\xc9MON Stadium', u'Pokemon']
+        items = core.PackedItems(names)
+        self.assertEqual(list(items), names)
+        self.assertEqual(list(items.find(u'pok\xe9')), [0, 1])
+
+# --------------------------------------------------------------------------- #
+# - MSU-1                                                                   - #
+# --------------------------------------------------------------------------- #
+
+def pcm(loop=0, samples=4):
+    return core.PCM_MAGIC + struct.pack('<I', loop) + b'\0' * 4 * samples
+
+class MsuPackTest(TempFolderCase):
+
+    def test_problems_gap(self):
+        self.write('Game.sfc', b'\0' * 1024)
+        msu = self.write('Game.msu')
+        for track in (1, 2, 5, 7):
+            self.write('Game-%s.pcm' % track, pcm())
+        pack = core.MsuPack(msu)
+        self.assertEqual(pack.missingTracks(), [3, 4, 6])
+        self.assertEqual(pack.problems(), ['missing tracks 3-4,6'])
+
+    def test_problems_bad_and_no_rom(self):
+        msu = self.write('Game.msu')
+        self.write('Game-1.pcm', pcm())
+        self.write('Game-2.pcm', b'RIFF')
+        self.write('Game-3.pcm', pcm(loop=99))
+        self.assertEqual(core.MsuPack(msu).problems(),
+                         ['no rom', 'bad tracks 2-3'])
+
+    def test_files(self):
+        rom = self.write('Game.sfc', b'\0' * 1024)
+        msu = self.write('Game.msu', b'data')
+        tracks = [self.write('Game-%s.pcm' % i, pcm()) for i in (2, 1, 10)]
+        self.write('Game-x.pcm', pcm())
+        self.write('Other-1.pcm', pcm())
+        pack = core.MsuPack(msu)
+        self.assertEqual(pack.files(), [rom, msu] + [tracks[i]
+                                                     for i in (1, 0, 2)])
+        self.assertEqual(pack.size, 1024 + 4 + 3 * len(pcm()))
+
+    def test_copy_resumes(self):
+        src = self.write('Game.msu', romData(5, 10000))
+        dst = os.path.join(self.folder, 'card', 'Game.msu')
+        os.makedirs(os.path.dirname(dst))
+        with open(dst + core.PART_EXT, 'wb') as f:
+            f.write(romData(5, 4000))
+        self.assertEqual(core.copyResumable(src, dst, bufsize=1024), 6000)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), romData(5, 10000))
+        self.assertFalse(os.path.exists(dst + core.PART_EXT))
+        # already there, nothing copied
+        self.assertEqual(core.copyResumable(src, dst), 0)
+
+    def test_copy_pack(self):
+        self.write('Game.sfc', romData(1, 2048))
+        msu = self.write('Game.msu', romData(2, 100))
+        for track in range(1, 6):
+            self.write('Game-%s.pcm' % track, pcm(samples=track * 100))
+        pack = core.MsuPack(msu)
+        card = os.path.join(self.folder, 'card')
+        calls = []
+        workers = core.copyMsuPack(pack, card, lambda *a: calls.append(a),
+                                   workers=2, bufsize=256)
+        self.assertEqual(workers, 2)
+        self.assertEqual(max(calls), (pack.size, pack.size))
+        copied = core.MsuPack(os.path.join(card, 'Game.msu'))
+        self.assertEqual([os.path.basename(f) for f in copied.files()],
+                         [os.path.basename(f) for f in pack.files()])
+        self.assertEqual(copied.size, pack.size)
+
+    def test_shard_ranges(self):
+        names = ['%s%03d.sfc' % (c, i) for c in 'ABC' for i in range(4)]
+        folders = core.shardFolders(names, cap=5)
+        for folder in set(folders.values()):
+            self.assertLessEqual(
+                sum(1 for f in folders.values() if f == folder), 5)
+
+# --------------------------------------------------------------------------- #
+# - Patches                                                                 - #
+# --------------------------------------------------------------------------- #
+
+def ips(offset, data):
+    return (b'PATCH' + struct.pack('>I', offset)[1:] +
+            struct.pack('>H', len(data)) + data + b'EOF')
+
+def varint(number):
+    out = bytearray()
+    while True:
+        bits, number = number & 0x7F, number >> 7
+        if not number:
+            out.append(0x80 | bits)
+            return bytes(out)
+        out.append(bits)
+        number -= 1
+
+def bps(source, target, keep):
+    """ keeps the first keep bytes of source, the rest comes from the patch
+    """
+    body = (core.BPS_MAGIC + varint(len(source)) + varint(len(target)) +
+            varint(0) + varint((keep - 1) << 2) +
+            varint((len(target) - keep - 1) << 2 | 1) + target[keep:])
+    body += struct.pack('<II', zlib.crc32(source) & 0xFFFFFFFF,
+                        zlib.crc32(target) & 0xFFFFFFFF)
+    return body + struct.pack('<I', zlib.crc32(body) & 0xFFFFFFFF)
+
+class ApplyPatchTest(unittest.TestCase):
+
+    def ips(self, source, patch):
+        return bytes(core.applyIps(source, io.BytesIO(patch)))
+
+    def bps(self, source, patch):
+        return bytes(core.applyBps(source, io.BytesIO(patch), len(patch)))
+
+    def test_ips(self):
+        self.assertEqual(self.ips(b'\0' * 8, ips(2, b'ab')),
+                         b'\0\0ab\0\0\0\0')
+        # records past the end grow the rom
+        self.assertEqual(self.ips(b'', ips(2, b'ab')), b'\0\0ab')
+        rle = b'PATCH\0\0\1\0\0\0\3xEOF'
+        self.assertEqual(self.ips(b'\0' * 5, rle), b'\0xxx\0')
+        # lunar ips truncation after the eof marker
+        self.assertEqual(self.ips(b'\0' * 8, ips(0, b'a') + b'\0\0\2'),
+                         b'a\0')
+
+    def test_ips_rejected(self):
+        self.assertRaises(ValueError, self.ips, b'', b'BPS1')
+        # cut off after a whole record, so before the eof marker
+        self.assertRaises(ValueError, self.ips, b'\0' * 8,
+                          ips(2, b'ab')[:-3])
+        self.assertRaises(ValueError, self.ips, b'\0' * 8,
+                          ips(2, b'ab')[:-4])
+
+    def test_bps(self):
+        source, target = b'snes' * 8, b'snes' * 4 + b'SNES' * 5
+        patch = bps(source, target, 16)
+        self.assertEqual(self.bps(source, patch), target)
+        self.assertEqual(bytes(core.applyBps(
+            source, io.BytesIO(patch), len(patch),
+            zlib.crc32(source) & 0xFFFFFFFF)), target)
+
+    def test_bps_crc_rejected(self):
+        source, target = b'snes' * 8, b'snes' * 4 + b'SNES' * 5
+        patch = bps(source, target, 16)
+        wrong = b'SNES' + source[4:]
+        self.assertRaises(core.PatchError, self.bps, wrong, patch)
+        damaged = patch[:-20] + b'X' + patch[-19:]
+        self.assertRaises(core.PatchError, self.bps, source, damaged)
+        self.assertRaises(core.PatchError, self.bps, source[:-1], patch)
+        self.assertRaises(core.PatchError, self.bps, source, patch[:-1])
+
+class WritePatchedTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        self.base = self.write('Game.sfc', b'\0' * 1024)
+        self.patch = self.write('Game.ips', ips(16, b'\xff'))
+        self.cache = core.PatchCache(os.path.join(self.folder, 'cache'))
+
+    def test_base_kept(self):
+        outputs = core.writePatched(self.base, [self.patch], cache=self.cache)
+        self.assertEqual(outputs, [os.path.join(
+            self.folder, 'Game' + core.PATCHED_SUFFIX + '.sfc')])
+        with open(self.base, 'rb') as f:
+            self.assertEqual(f.read(), b'\0' * 1024)
+        with open(outputs[0], 'rb') as f:
+            self.assertEqual(f.read()[16:17], b'\xff')
+
+    def test_no_overwrite(self):
+        core.writePatched(self.base, [self.patch], cache=self.cache)
+        self.assertRaises(ValueError, core.writePatched, self.base,
+                          [self.patch], cache=self.cache)
+        core.writePatched(self.base, [self.patch], cache=self.cache,
+                          overwrite=True)
+
+    def test_not_onto_base(self):
+        base = self.write('Game (patched).sfc', b'\0' * 1024)
+        self.assertRaises(ValueError, core.writePatched, base,
+                          [self.patch], cache=self.cache, overwrite=True)
+
+# --------------------------------------------------------------------------- #
+# - Usb2Snes                                                                - #
+# --------------------------------------------------------------------------- #
+
+class NoDevices(core.MockUsb2Snes):
+
+    def handle(self, ws, opcode, operands):
+        if opcode == 'DeviceList':
+            return []
+        return core.MockUsb2Snes.handle(self, ws, opcode, operands)
+
+class HangsUp(core.MockUsb2Snes):
+
+    def handle(self, ws, opcode, operands):
+        if opcode == 'Info':
+            raise socket.error('gone')
+        return core.MockUsb2Snes.handle(self, ws, opcode, operands)
+
+class Usb2SnesTest(TempFolderCase):
+
+    def connect(self, mock=core.MockUsb2Snes):
+        server = mock().start()
+        self.addCleanup(server.stop)
+        client = core.Usb2Snes(server.host, server.port)
+        self.addCleanup(client.close)
+        return server, client
+
+    def test_attach(self):
+        server, client = self.connect()
+        self.assertEqual(client.connect(), 'MOCK SD2SNES')
+        self.assertTrue(client.connected)
+        self.assertEqual(client.info()[1], 'MOCK')
+        self.assertEqual(server.commands[:3], ['DeviceList', 'Attach', 'Name'])
+
+    def test_list(self):
+        server, client = self.connect()
+        server.dirs.add('/roms')
+        server.files['/roms/a.sfc'] = b''
+        self.assertEqual(client.list('/'), [(True, 'roms')])
+        self.assertEqual(client.list('/roms'), [(False, 'a.sfc')])
+        # cached until asked for fresh
+        server.files['/roms/b.sfc'] = b''
+        self.assertEqual(len(client.list('/roms')), 1)
+        self.assertEqual(len(client.list('/roms', fresh=True)), 2)
+
+    def test_put_get(self):
+        server, client = self.connect()
+        data = bytes(bytearray(range(256))) * 20
+        src = self.write('Game.sfc', data)
+        client.putFile(src, '/roms/new/Game.sfc', chunk=512)
+        self.assertEqual(server.files['/roms/new/Game.sfc'], data)
+        self.assertIn('/roms/new', server.dirs)
+        self.assertTrue(client.exists('/roms/new/Game.sfc'))
+        self.assertEqual(client.getFile('/roms/new/Game.sfc'), data)
+        client.remove('/roms/new/Game.sfc')
+        self.assertFalse(client.exists('/roms/new/Game.sfc'))
+
+    def test_no_devices(self):
+        server, client = self.connect(NoDevices)
+        self.assertRaises(core.Usb2SnesError, client.connect)
+        self.assertFalse(client.connected)
+
+    def test_connection_lost(self):
+        server, client = self.connect(HangsUp)
+        client.connect()
+        self.assertRaises(IOError, client.info)
+        self.assertFalse(client.connected)
+
+    def test_refused(self):
+        server, client = self.connect()
+        server.stop()
+        self.assertRaises(socket.error, client.connect)
+
+    def test_address(self):
+        self.assertEqual(core.parseAddress('host:1234'), ('host', 1234))
+        self.assertEqual(core.parseAddress('host'),
+                         ('host', core.USB2SNES_PORT))
+        self.assertRaises(ValueError, core.parseAddress, 'host:port')
+
+# --------------------------------------------------------------------------- #
+# - Card                                                                    - #
+# --------------------------------------------------------------------------- #
+
+MB = 1024 * 1024
+
+class CopyTuningTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        self.cards = os.path.join(self.folder, 'cards.json')
+
+    def save(self, parallel, write):
+        """ a benchmark of parallel and {block: rate} writes """
+        stats = {'card': core.cardId(self.folder), 'parallelWrite': parallel,
+                 'write': dict((str(b), r) for b, r in write.items())}
+        core.saveCard(stats, self.cards)
+        return stats
+
+    def tuning(self, size=None):
+        return core.copyTuning(self.folder, size, self.cards)
+
+    def test_never_benched(self):
+        tuning = self.tuning()
+        self.assertEqual((tuning.bufsize, tuning.workers, tuning.syncBytes),
+                         (core.COPY_BLOCK, None, None))
+
+    def test_best_block(self):
+        stats = self.save(10 * MB, {65536: 5 * MB, 262144: 10 * MB,
+                                    1048576: 10 * MB})
+        # the smaller block wins a tie
+        self.assertEqual(core.bestBlock(stats), 262144)
+        tuning = self.tuning()
+        self.assertEqual(tuning.bufsize, 262144)
+        self.assertEqual(tuning.workers, 1)
+        self.assertEqual(tuning.syncBytes, 10 * MB * core.SYNC_SECONDS)
+
+    def test_small_files_and_parallel(self):
+        self.save(20 * MB, {65536: 1 * MB, 4194304: 10 * MB})
+        tuning = self.tuning(100 * 1024)
+        self.assertEqual(tuning.bufsize, 128 * 1024)
+        self.assertEqual(tuning.workers, 2)
+        self.assertEqual(self.tuning(1).bufsize, 65536)
+
+    def test_benchmark(self):
+        stats = core.benchmarkCard(self.folder, 256 * 1024)
+        self.assertEqual(sorted(stats['write']),
+                         sorted(str(b) for b in core.BENCH_BLOCKS))
+        for key in ('randomRead', 'randomWrite', 'parallelWrite',
+                    'smallFiles'):
+            self.assertGreater(stats[key], 0)
+        self.assertEqual(os.listdir(self.folder), [])
+
+# --------------------------------------------------------------------------- #
+# - Layout                                                                  - #
+# --------------------------------------------------------------------------- #
+
+class LayoutTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        os.makedirs(os.path.join(self.folder, 'sub'))
+        for name in ('Alpha.sfc', 'Bravo.sfc', 'Bravo.msu', 'Bravo-1.pcm',
+                     'Charlie.sfc', os.path.join('sub', 'Alpha.sfc')):
+            self.write(name, b'x')
+
+    def path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    def plan(self):
+        paths = list(core.walkRoms(self.folder))
+        return core.planLayout(self.folder, paths, 2, 'letter')
+
+    def test_plan(self):
+        plan = self.plan()
+        self.assertEqual(sorted(plan.moves), [
+            (self.path('Alpha.sfc'), self.path('A', 'Alpha.sfc')),
+            (self.path('Bravo-1.pcm'), self.path('B', 'Bravo-1.pcm')),
+            (self.path('Bravo.msu'), self.path('B', 'Bravo.msu')),
+            (self.path('Bravo.sfc'), self.path('B', 'Bravo.sfc')),
+            (self.path('Charlie.sfc'), self.path('C', 'Charlie.sfc'))])
+        # the same name in another folder isn't lost
+        self.assertEqual(plan.conflicts, [
+            (self.path('sub', 'Alpha.sfc'), self.path('A', 'Alpha.sfc'))])
+        self.assertEqual(len(plan.movedRoms()), 3)
+
+    def test_under_cap(self):
+        paths = list(core.walkRoms(self.folder))
+        plan = core.planLayout(self.folder, paths, len(paths), 'letter')
+        self.assertEqual((plan.moves, plan.conflicts), ([], []))
+
+    def test_apply(self):
+        index = core.RomIndex(self.path('index.json'))
+        index.roms[index.key(self.path('Bravo.sfc'))] = {'sha1': 'b'}
+        plan = self.plan()
+        self.assertEqual(core.applyLayout(plan, index=index), plan.moves)
+        self.assertEqual(sorted(os.listdir(self.path('B'))),
+                         ['Bravo-1.pcm', 'Bravo.msu', 'Bravo.sfc'])
+        self.assertEqual(index.get(self.path('B', 'Bravo.sfc')),
+                         {'sha1': 'b'})
+        self.assertTrue(os.path.exists(self.path('sub', 'Alpha.sfc')))
+        # nothing left to move, the conflict stays
+        plan = self.plan()
+        self.assertEqual(plan.moves, [])
+        self.assertEqual(len(plan.conflicts), 1)
+
+# --------------------------------------------------------------------------- #
+# - Capacity                                                                - #
+# --------------------------------------------------------------------------- #
+
+class CapacityTest(TempFolderCase):
+
+    def test_on_card(self):
+        self.assertEqual([core.onCard(size, 4096)
+                          for size in (0, 1, 4096, 4097)],
+                         [0, 4096, 4096, 8192])
+
+    def test_entries(self):
+        usa = self.write('Game (USA).sfc', b'x' * 5000)
+        japan = self.write('Game (Japan).sfc', b'x' * 100)
+        self.write('Game (USA).ips', b'PATCH')
+        self.write('Pack.sfc', b'x')
+        pack = self.write('Pack.msu', b'x')
+        self.write('Pack-1.pcm', pcm())
+        index = core.RomIndex(os.path.join(self.folder, 'index.json'))
+        # the index is trusted over the file
+        index.roms[index.key(japan)] = {'size': 9000}
+        self.assertEqual(
+            sorted(core.capacityEntries(self.folder, 4096, index)),
+            [(japan, 12288), (usa, 8192), (pack, 12288)])
+
+    def test_region_priority(self):
+        regions = ('USA', 'Japan')
+        usa, japan, other = 'A (USA).sfc', 'B (Japan).sfc', 'C (Europe).sfc'
+        self.assertEqual(
+            [core.regionPriority(e, (), regions) for e in (usa, japan, other)],
+            [2, 1, 0])
+        self.assertEqual(core.regionPriority(other, (other,), regions), 3)
+
+    def test_plan(self):
+        ranks = {'a': 0, 'b': 1, 'c': 1}
+        plan = core.CapacityPlan([('a', 10), ('b', 20), ('c', 30)], 40,
+                                 ranks.get)
+        # b first, c doesn't fit after it and a fills the gap
+        self.assertEqual((plan.chosen, plan.used), (set([0, 1]), 30))
+        # picking c alone pins it and leaves a and b out
+        self.assertEqual(plan.choose([2]), set([2]))
+        self.assertEqual(plan.used, 30)
+        self.assertEqual(plan.choose([0, 2]), set([0, 2]))
+        self.assertEqual(plan.chosenEntries(), ['a', 'c'])
+
+# --------------------------------------------------------------------------- #
+# - Profiles                                                                - #
+# --------------------------------------------------------------------------- #
+
+class ReconcileTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        self.index = core.RomIndex(os.path.join(self.folder, 'card.json'))
+        self.card = os.path.join(self.folder, 'card')
+        os.makedirs(self.card)
+        self.a = self.write(os.path.join('card', 'A.sfc'), b'a')
+        self.b = self.write(os.path.join('card', 'B.sfc'), b'b')
+
+    def test_stat_only(self):
+        self.assertEqual(core.reconcile(self.index, self.card),
+                         [self.a, self.b])
+        self.assertEqual(self.index.get(self.a)['sha1'], None)
+        # hashed and unchanged roms are left alone
+        self.index.roms[self.a]['sha1'] = 'a'
+        self.assertEqual(core.reconcile(self.index, self.card), [self.b])
+
+    def test_changed_and_gone(self):
+        core.reconcile(self.index, self.card)
+        self.index.roms[self.a]['sha1'] = 'a'
+        self.write(os.path.join('card', 'A.sfc'), b'aa')
+        os.remove(self.b)
+        self.assertEqual(core.reconcile(self.index, self.card), [self.a])
+        self.assertEqual(self.index.get(self.a),
+                         {'size': 2, 'mtime': core.statRom(self.a)[1],
+                          'sha1': None})
+        self.assertEqual(self.index.under([self.card]), [self.a])
+
+class DiffCardTest(unittest.TestCase):
+
+    library = os.path.abspath('library')
+    card = os.path.abspath('card')
+
+    def index(self, root, roms):
+        """ a RomIndex of {path below root: (sha1, size)} """
+        index = core.RomIndex(os.path.join(root, 'missing.json'))
+        for rel, (sha1, size) in roms.items():
+            index.roms[os.path.join(root, *rel.split('/'))] = {
+                'sha1': sha1, 'size': size}
+        return index
+
+    def test_diff(self):
+        library = self.index(self.library, {
+            'USA/A.sfc': ('a', 1), 'B.sfc': ('b', 2), 'C.sfc': ('c', 3),
+            'D.sfc': ('d', 4), 'F.sfc': ('f', 6)})
+        card = self.index(self.card, {
+            'USA/A.sfc': ('a', 1), 'B.sfc': ('x', 2),
+            # moved into a shard folder, found by its hash
+            'C-D/C.sfc': ('c', 3),
+            # not hashed yet, compared by size
+            'D.sfc': (None, 5), 'E.sfc': ('e', 7)})
+        path = os.path.join
+        self.assertEqual(
+            core.diffCard(library, self.library, card, self.card), [
+                (core.DIFF_MISSING, 'F.sfc', path(self.library, 'F.sfc'),
+                 None),
+                (core.DIFF_DIFFERENT, 'B.sfc', path(self.library, 'B.sfc'),
+                 path(self.card, 'B.sfc')),
+                (core.DIFF_DIFFERENT, 'D.sfc', path(self.library, 'D.sfc'),
+                 path(self.card, 'D.sfc')),
+                (core.DIFF_EXTRA, 'E.sfc', None, path(self.card, 'E.sfc'))])
+
+# --------------------------------------------------------------------------- #
+# - Prefetch                                                                - #
+# --------------------------------------------------------------------------- #
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.stamps = {}
+        self.gate = threading.Event()
+        self.gate.set()
+        self.addCleanup(self.gate.set)
+        self.prefetcher = core.Prefetcher(self.load, self.stamps.get, 2)
+
+    def load(self, key):
+        self.loads.append(key)
+        self.gate.wait(5)
+        return key.upper()
+
+    def cached(self):
+        return list(self.prefetcher._cache)
+
+    def test_get(self):
+        self.assertEqual(self.prefetcher.get('a'), 'A')
+        self.assertEqual(self.prefetcher.get('a'), 'A')
+        self.assertEqual((self.prefetcher.hits, self.prefetcher.misses),
+                         (1, 1))
+        # a new stamp loads it again
+        self.stamps['a'] = 1
+        self.prefetcher.get('a')
+        self.assertEqual(self.loads, ['a', 'a'])
+
+    def test_lru(self):
+        for key in 'abca':
+            self.prefetcher.get(key)
+        self.assertEqual(self.cached(), ['c', 'a'])
+
+    def test_want(self):
+        self.prefetcher.want(['a', 'b'])
+        until(lambda: self.cached() == ['a', 'b'])
+        self.assertEqual(self.prefetcher.get('b'), 'B')
+        self.assertEqual(self.prefetcher.misses, 0)
+
+    def test_moved_away(self):
+        self.gate.clear()
+        self.prefetcher.want(['a', 'b'])
+        until(lambda: self.loads == ['a'])
+        # b is dropped before it starts, a is dropped once it is loaded
+        self.prefetcher.want(['c'])
+        self.gate.set()
+        until(lambda: self.cached() == ['c'])
+        self.assertEqual(self.loads, ['a', 'c'])
+        self.assertEqual(self.prefetcher.dropped, 1)
+        self.prefetcher.cancel()
+
+# --------------------------------------------------------------------------- #
+# - Facets                                                                  - #
+# --------------------------------------------------------------------------- #
+
+class BitmapTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for indices in ([], [0], [7, 8], [3, 64, 1000]):
+            bits = core.toBitmap(indices)
+            self.assertEqual(bits, sum(1 << i for i in indices))
+            self.assertEqual(list(core.bitIndices(bits)), indices)
+            self.assertEqual(core.popcount(bits), len(indices))
+
+    def test_array(self):
+        self.assertEqual(core.toBitmap(array.array('I')), 0)
+        self.assertEqual(core.toBitmap(array.array('I', [1, 2])), 6)
+
+def header(region='USA', mapping='LoROM', coprocessor=None, save=False,
+           size=1 << 20):
+    return {'size': size, 'info': {
+        'region': region, 'mapping': mapping, 'coprocessor': coprocessor,
+        'hasSave': save}}
+
+class FacetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.values = [core.romFacets(r) for r in (
+            header(), header('Japan', save=True), header(save=True),
+            header('Europe', 'HiROM', 'SA-1', size=3 << 20), None)]
+        self.index = core.FacetIndex(self.values)
+
+    def test_rom_facets(self):
+        self.assertEqual(self.values[3], {
+            'region': 'Europe', 'mapping': 'HiROM', 'coprocessor': 'SA-1',
+            'save': 'no', 'size': '<=4M'})
+        self.assertEqual(self.values[0]['coprocessor'], 'None')
+        unknown = dict((f, core.FACET_UNKNOWN) for f in core.FACETS)
+        self.assertEqual(self.values[4], unknown)
+        self.assertEqual(core.romFacets({'size': 1, 'info': None}),
+                         dict(unknown, size='<=512K'))
+        self.assertEqual(core.sizeFacet(8 << 20), '>4M')
+
+    def test_match(self):
+        match = self.index.match
+        self.assertEqual(match([]), 0b11111)
+        # values of a facet are or'ed, facets and'ed
+        usaOrJapan = [('region', 'USA'), ('region', 'Japan')]
+        self.assertEqual(list(core.bitIndices(match(usaOrJapan))),
+                         [0, 1, 2])
+        self.assertEqual(
+            list(core.bitIndices(match(usaOrJapan + [('save', 'yes')]))),
+            [1, 2])
+        self.assertEqual(match([('region', 'Mars')]), 0)
+
+    def test_counts(self):
+        chosen = [('region', 'USA')]
+        counts = self.index.counts(chosen)
+        # a facet is counted without its own choices
+        self.assertEqual(counts[('region', 'Japan')], 1)
+        self.assertEqual(counts[('save', 'yes')], 1)
+        self.assertEqual(counts[('mapping', 'HiROM')], 0)
+        counts = self.index.counts(chosen, base=core.toBitmap([0]))
+        self.assertEqual(counts[('save', 'yes')], 0)
+
+    def test_keys(self):
+        self.assertEqual(self.index.keys('region')[0], ('region', 'USA'))
+        self.assertEqual(self.index.keys('nothing'), [])
+
+    def test_index_facets(self):
+        index = core.RomIndex(os.path.abspath('missing.json'))
+        facets = core.indexFacets([None, os.path.abspath('missing.sfc')],
+                                  index)
+        self.assertEqual(facets.count, 2)
+        self.assertEqual(facets.match([('region', core.FACET_UNKNOWN)]), 3)
+
+# --------------------------------------------------------------------------- #
+# - Command line                                                            - #
+# --------------------------------------------------------------------------- #
+
+class CliTest(TempFolderCase):
+
+    def setUp(self):
+        TempFolderCase.setUp(self)
+        self.library = os.path.join(self.folder, 'roms')
+        os.makedirs(os.path.join(self.library, 'USA'))
+        self.rom = self.write(os.path.join('roms', 'USA', 'Game.sfc'),
+                              romData(1, 4096))
+        self.index = os.path.join(self.folder, 'index.json')
+
+    def cli(self, *argv):
+        """ (exit code, json records) """
+        out, sys.stdout = sys.stdout, StringIO()
+        try:
+            code = cli.main(['--index', self.index] + list(argv))
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = out
+        return code, [json.loads(line) for line in lines]
+
+    def test_fit_without_card(self):
+        missing = os.path.join(self.folder, 'no card')
+        code, records = self.cli('sync', self.library, missing,
+                                 '--fit', '4', '--dry-run')
+        self.assertEqual(code, cli.EXIT_OK)
+        self.assertEqual(records[0]['games'], 1)
+        self.assertEqual(records[1]['action'], 'copy')
+
+        code, records = self.cli('sync', self.library, missing, '--fit', '0')
+        self.assertEqual(code, cli.EXIT_ERROR)
+        self.assertEqual(records[0]['path'], missing)
+
+    def test_uncaught_error(self):
+        code, records = self.cli(
+            'sync', self.library, self.folder, '--fit', '4', '--favorites',
+            os.path.join(self.folder, 'missing.txt'))
+        self.assertEqual(code, cli.EXIT_ERROR)
+        self.assertIn('error', records[-1])
+
+    def test_verify_bad_zip(self):
+        archive = os.path.join(self.library, 'Games.zip')
+        zf = zipfile.ZipFile(archive, 'w')
+        zf.writestr('Zipped.sfc', romData(2, 4096))
+        zf.close()
+        self.assertEqual(self.cli('index', self.library)[0], cli.EXIT_OK)
+        with open(archive, 'wb') as f:
+            f.write(b'PK broken')
+        code, records = self.cli('verify', self.library)
+        self.assertEqual(code, cli.EXIT_ERROR)
+        self.assertEqual(
+            [(r['path'], 'error' in r) for r in records],
+            [(core.zipPath(archive, 'Zipped.sfc'), True), (self.rom, False)])
+
+    def test_dedupe_delete(self):
+        copy = self.write(os.path.join('roms', 'Copy.sfc'), romData(1, 4096))
+        code, records = self.cli('dedupe', self.library, '--delete')
+        self.assertEqual(code, cli.EXIT_OK)
+        self.assertEqual(records[0]['removed'], [self.rom])
+        self.assertEqual(records[0]['size'], 4096)
+        self.assertTrue(os.path.exists(copy))
+
+if __name__ == '__main__':
+    unittest.main()